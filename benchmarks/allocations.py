@@ -0,0 +1,110 @@
+"""
+Compares the memory allocated while building a Purchase request from the
+prebuilt ``RequestSpec`` against the previous implementation, which rebuilt
+its field map and required keys and recompiled its patterns on every call.
+
+Run from the project root with::
+
+    python -m benchmarks.allocations
+"""
+import re
+import timeit
+import tracemalloc
+
+from paymentexpress.gateway import Gateway, Request, FIELDS, PURCHASE
+
+NUMBER = 20000
+
+KWARGS = {
+    'card_holder': 'A Anderson',
+    'card_number': '4111111111111111',
+    'card_expiry': '1299',
+    'cvc2': '123',
+    'merchant_ref': '100001_PURCHASE_1_2008',
+    'enable_add_bill_card': 1,
+    'amount': 1.23,
+}
+
+
+def legacy_check_kwargs(kwargs, required_keys):
+    for key in required_keys:
+        if key not in kwargs:
+            raise ValueError('You must provide a "%s" argument' % key)
+    for key in kwargs:
+        value = kwargs[key]
+        if key == 'currency' and not re.match(r'^[A-Z]{3}$', value):
+            raise ValueError('Currency code must be a 3 character code')
+        if key == 'amount' and value == 0:
+            raise ValueError('Amount must be non-zero')
+        if key in ('card_issue_date', 'card_expiry') \
+            and value is not None \
+            and not re.match(r'^(0[1-9]|1[012])([0-9]{2})$', value):
+            raise ValueError('%s must be in format mmyy' % key)
+
+
+def legacy_build_request(gateway, kwargs):
+    """
+    ``Gateway._purchase_on_new_card`` and ``_fetch_response``'s checks as
+    they used to be
+    """
+    required_keys = ['card_holder', 'card_number', 'card_expiry', 'cvc2',
+                     'merchant_ref', 'enable_add_bill_card']
+    required_keys.append('amount')
+    legacy_check_kwargs(kwargs, required_keys)
+    request = Request(gateway.username, gateway.password, gateway.currency,
+                      PURCHASE, kwargs.get('amount'))
+    # What ``Request.__init__`` used to build for every request
+    request_keys = ['username', 'password', 'amount', 'currency',
+                    'txn_type', 'amount']
+    field_map = dict(FIELDS)
+    for key in required_keys:
+        request.set_element(key, kwargs.get(key))
+    legacy_check_kwargs(request.data, request_keys)
+    return request, field_map
+
+
+def spec_build_request(gateway, kwargs):
+    return gateway._build_request(gateway.purchase_spec, kwargs)
+
+
+def measure_allocations(func, number=1000):
+    """
+    Return the blocks and bytes allocated by each call of ``func``, and the
+    peak traced size of a single call.  Results are kept alive until the
+    snapshot so that transient and retained allocations are both counted.
+    """
+    func()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        results = [func() for _ in range(number)]
+        after = tracemalloc.take_snapshot()
+        stats = after.compare_to(before, 'filename')
+        blocks = sum(stat.count_diff for stat in stats)
+        size = sum(stat.size_diff for stat in stats)
+        del results
+        tracemalloc.clear_traces()
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return float(blocks) / number, float(size) / number, peak
+
+
+def main():
+    gateway = Gateway('http://localhost/', 'TestUsername', 'TestPassword',
+                      'AUD')
+    candidates = (
+        ('legacy', lambda: legacy_build_request(gateway, KWARGS)),
+        ('spec', lambda: spec_build_request(gateway, KWARGS)),
+    )
+    for name, func in candidates:
+        blocks, size, peak = measure_allocations(func)
+        best = min(timeit.repeat(func, number=NUMBER, repeat=3))
+        print("%-8s %6.1f blocks/op %8.0f bytes/op  peak %6d bytes  "
+              "%6.2f us/op" % (name + ':', blocks, size, peak,
+                               best / NUMBER * 1e6))
+
+
+if __name__ == '__main__':
+    main()
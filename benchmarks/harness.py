@@ -0,0 +1,96 @@
+"""
+Timing, reporting and comparison of benchmark results.
+"""
+import json
+import platform
+import sys
+import time
+
+try:
+    _clock = time.perf_counter
+except AttributeError:
+    _clock = time.time
+
+# A benchmark counts as regressed when its median latency grows by more
+# than this fraction of the baseline
+DEFAULT_TOLERANCE = 0.1
+
+
+def percentile(samples, fraction):
+    """
+    Return the value below which ``fraction`` of the sorted ``samples`` fall
+    """
+    index = min(len(samples) - 1, int(round(fraction * (len(samples) - 1))))
+    return samples[index]
+
+
+def measure(func, iterations, warmup=None):
+    """
+    Call ``func`` ``iterations`` times, after a few untimed warm-up calls, and
+    return its throughput and latency percentiles
+    """
+    if warmup is None:
+        warmup = max(1, iterations // 20)
+    for _ in range(warmup):
+        func()
+    samples = []
+    for _ in range(iterations):
+        start = _clock()
+        func()
+        samples.append(_clock() - start)
+    samples.sort()
+    total = sum(samples)
+    return {
+        'iterations': iterations,
+        'ops_per_sec': iterations / total if total else float('inf'),
+        'p50_us': percentile(samples, 0.5) * 1e6,
+        'p99_us': percentile(samples, 0.99) * 1e6,
+    }
+
+
+def run(benchmarks, scale=1.0, stream=sys.stdout):
+    """
+    Run ``(name, func, iterations)`` benchmarks, printing each result as it
+    completes, and return the results keyed by name
+    """
+    results = {}
+    for name, func, iterations in benchmarks:
+        result = measure(func, max(1, int(iterations * scale)))
+        results[name] = result
+        stream.write("%-32s %12.1f ops/s  p50 %9.1f us  p99 %9.1f us\n" % (
+            name, result['ops_per_sec'], result['p50_us'],
+            result['p99_us']))
+        stream.flush()
+    return results
+
+
+def save_results(results, path):
+    data = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'results': results,
+    }
+    with open(path, 'w') as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+
+
+def load_results(path):
+    with open(path) as f:
+        return json.load(f)['results']
+
+
+def compare(baseline, results, tolerance=DEFAULT_TOLERANCE):
+    """
+    Return ``(name, baseline p50, current p50)`` for each benchmark whose
+    median latency has regressed beyond ``tolerance``
+    """
+    regressions = []
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        before = baseline[name]['p50_us']
+        after = results[name]['p50_us']
+        if after > before * (1 + tolerance):
+            regressions.append((name, before, after))
+    return regressions
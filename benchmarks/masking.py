@@ -0,0 +1,52 @@
+"""
+Measures masking throughput over a large logged payload, comparing the
+single-pass masking engine against the three regexes
+``OrderTransaction.save`` used to compile and apply on every insert.
+
+Run from the project root with::
+
+    python -m benchmarks.masking
+"""
+import re
+import timeit
+
+from paymentexpress.masking import mask_xml
+from tests import SAMPLE_PURCHASE_REQUEST
+
+NUMBER = 20
+# Roughly 1MB of logged requests
+PAYLOAD = SAMPLE_PURCHASE_REQUEST * 2500
+
+
+def legacy_mask(request_xml):
+    """
+    The masking ``OrderTransaction.save`` used to do
+    """
+    cc_regex = re.compile(r'\d{12}')
+    request_xml = cc_regex.sub('XXXXXXXXXXXX', request_xml)
+    ccv_regex = re.compile(r'<Cvc2>\d+</Cvc2>')
+    request_xml = ccv_regex.sub('<Cvc2>XXX</Cvc2>', request_xml)
+    pw_regex = re.compile(r'<PostPassword>.*</PostPassword>')
+    return pw_regex.sub('<PostPassword>XXX</PostPassword>', request_xml)
+
+
+def main():
+    megabytes = len(PAYLOAD) / 1e6
+    print("Payload: %.2fMB" % megabytes)
+    results = {}
+    for name, func in (('legacy', legacy_mask), ('engine', mask_xml)):
+        best = min(timeit.repeat(lambda: func(PAYLOAD), number=NUMBER,
+                                 repeat=3))
+        results[name] = best
+        print("%-7s %8.2f MB/s" % (name + ':', megabytes * NUMBER / best))
+
+    # Per-insert cost, where the legacy version recompiled its patterns
+    single = SAMPLE_PURCHASE_REQUEST
+    for name, func in (('legacy', legacy_mask), ('engine', mask_xml)):
+        best = min(timeit.repeat(lambda: func(single), number=20000,
+                                 repeat=3))
+        print("%-7s %8.2f us/insert" % (name + ':', best / 20000 * 1e6))
+
+
+if __name__ == '__main__':
+    main()
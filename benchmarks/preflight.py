@@ -0,0 +1,57 @@
+"""
+Measures the per-call cost of the local card checks, alone and as part of
+building a Purchase request, against building the request without them.
+
+Run from the project root with::
+
+    python -m benchmarks.preflight
+"""
+import timeit
+
+from paymentexpress.cards import InvalidCard, check_card
+from paymentexpress.gateway import Gateway
+
+NUMBER = 100000
+
+KWARGS = {
+    'card_holder': 'A Anderson',
+    'card_number': '4111111111111111',
+    'card_expiry': '1299',
+    'cvc2': '123',
+    'merchant_ref': '100001_PURCHASE_1_2008',
+    'enable_add_bill_card': 1,
+    'amount': 1.23,
+}
+
+
+def rejected(card_number, expiry):
+    def run():
+        try:
+            check_card(card_number, expiry, '123')
+        except InvalidCard:
+            pass
+    return run
+
+
+def main():
+    checked = Gateway('http://localhost/', 'TestUsername', 'TestPassword',
+                      'AUD')
+    unchecked = Gateway('http://localhost/', 'TestUsername', 'TestPassword',
+                        'AUD', preflight=False)
+    candidates = (
+        ('check_card', lambda: check_card('4111111111111111', '1299',
+                                          '123')),
+        ('luhn failure', rejected('4111111111111112', '1299')),
+        ('expired', rejected('4111111111111111', '0115')),
+        ('build', lambda: unchecked._build_request(unchecked.purchase_spec,
+                                                   KWARGS)),
+        ('build+check', lambda: checked._build_request(checked.purchase_spec,
+                                                       KWARGS)),
+    )
+    for name, func in candidates:
+        best = min(timeit.repeat(func, number=NUMBER, repeat=3))
+        print("%-14s %6.2f us/op" % (name + ':', best / NUMBER * 1e6))
+
+
+if __name__ == '__main__':
+    main()
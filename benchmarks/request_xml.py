@@ -0,0 +1,66 @@
+"""
+Compares building request XML with the template serializer against the
+previous minidom implementation.
+
+Run from the project root with::
+
+    python -m benchmarks.request_xml
+"""
+import timeit
+from xml.dom.minidom import Document
+
+from paymentexpress.gateway import Request, FIELDS
+
+NUMBER = 20000
+
+
+def minidom_request_xml(request):
+    """
+    The minidom implementation ``Request.request_xml`` used to have
+    """
+    field_map = dict(FIELDS)
+    doc = Document()
+    root = doc.createElement('Txn')
+    doc.appendChild(root)
+    for key, value in request.data.items():
+        ele = doc.createElement(field_map.get(key))
+        root.appendChild(ele)
+        if value:
+            ele.appendChild(doc.createTextNode(str(value)))
+    return doc.toxml()
+
+
+def build_request():
+    request = Request('TestUsername', 'TestPassword', 'AUD', 'Purchase', 1.23)
+    request.set_element('card_holder', 'A Anderson')
+    request.set_element('card_number', '4111111111111111')
+    request.set_element('card_expiry', '1015')
+    request.set_element('cvc2', '123')
+    request.set_element('merchant_ref', '100001_PURCHASE_1_2008')
+    request.set_element('enable_add_bill_card', 1)
+    return request
+
+
+def main():
+    request = build_request()
+
+    def minidom():
+        minidom_request_xml(request)
+
+    def template():
+        request._xml = None
+        request.request_xml
+
+    def cached():
+        request.request_xml
+
+    baseline = min(timeit.repeat(minidom, number=NUMBER, repeat=3))
+    print("minidom:   %8.2f us/op" % (baseline / NUMBER * 1e6))
+    for name, func in (('template', template), ('cached', cached)):
+        best = min(timeit.repeat(func, number=NUMBER, repeat=3))
+        print("%-10s %8.2f us/op  (%.1fx faster)" % (
+            name + ':', best / NUMBER * 1e6, baseline / best))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+"""
+Compares the CPU time spent on each reply when it is read through
+``requests``' ``Response.text``, which runs character set detection when PX
+POST sends no charset header, against parsing ``Response.content`` as the
+raw bytes.
+
+Run from the project root with::
+
+    python -m benchmarks.response_bytes
+"""
+import time
+
+import requests
+
+from paymentexpress.gateway import Response
+from tests import SAMPLE_SUCCESSFUL_RESPONSE, SAMPLE_DECLINED_RESPONSE
+
+NUMBER = 2000
+
+try:
+    _cpu_clock = time.process_time
+except AttributeError:
+    _cpu_clock = time.clock
+
+
+def make_reply(body):
+    """
+    A ``requests`` response as received from PX POST, with no charset
+    """
+    reply = requests.models.Response()
+    reply._content = body.encode('utf-8')
+    reply.status_code = 200
+    return reply
+
+
+def via_text(body):
+    # ``text`` is worked out afresh from the bytes on every access, as a new
+    # reply would be
+    reply = make_reply(body)
+
+    def run():
+        reply.encoding = None
+        response = Response('', reply.text)
+        response.data
+        return response.response_xml
+    return run
+
+
+def via_bytes(body):
+    reply = make_reply(body)
+
+    def run():
+        response = Response('', reply.content)
+        response.data
+        return response.response_xml
+    return run
+
+
+def cpu_time(func, number=NUMBER):
+    func()
+    start = _cpu_clock()
+    for _ in range(number):
+        func()
+    return (_cpu_clock() - start) / number
+
+
+def main():
+    for name, body in (('successful', SAMPLE_SUCCESSFUL_RESPONSE),
+                       ('declined', SAMPLE_DECLINED_RESPONSE)):
+        text = cpu_time(via_text(body))
+        content = cpu_time(via_bytes(body))
+        print("%-10s text: %8.1f us  bytes: %8.1f us  saved %8.1f us "
+              "(%.1fx)" % (name, text * 1e6, content * 1e6,
+                           (text - content) * 1e6, text / content))
+
+
+if __name__ == '__main__':
+    main()
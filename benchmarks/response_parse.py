@@ -0,0 +1,74 @@
+"""
+Compares the single-pass expat response parser against the previous minidom
+implementation, which walked the whole tree once per extracted field.
+
+Run from the project root with::
+
+    python -m benchmarks.response_parse
+"""
+import timeit
+from xml.dom.minidom import parseString
+
+from paymentexpress.gateway import Response
+from tests import (SAMPLE_SUCCESSFUL_RESPONSE, SAMPLE_DECLINED_RESPONSE,
+                   SAMPLE_ERROR_RESPONSE)
+
+NUMBER = 5000
+
+
+def _element_text(doc, tag):
+    elements = doc.getElementsByTagName(tag)
+    if not elements or elements[0].firstChild is None:
+        return ''
+    return elements[0].firstChild.data
+
+
+def _transaction_attribute(doc, attr):
+    elements = doc.getElementsByTagName('Transaction')
+    if not elements or elements[0].attributes is None:
+        return ''
+    return elements[0].attributes.get(attr).value
+
+
+def minidom_extract_data(response_xml):
+    """
+    The minidom implementation ``Response._extract_data`` used to have
+    """
+    doc = parseString(response_xml)
+    success = _transaction_attribute(doc, 'success')
+    authorised = _element_text(doc, 'Authorized')
+    return {
+        'success': int(success) if success else 0,
+        'response_code': _transaction_attribute(doc, 'reco'),
+        'response_text': _transaction_attribute(doc, 'responseText'),
+        'authorised': int(authorised) if authorised else 0,
+        'auth_code': _element_text(doc, 'AuthCode'),
+        'txn_ref': _element_text(doc, 'TxnRef'),
+        'dps_txn_ref': _element_text(doc, 'DpsTxnRef'),
+        'card_holder_help_text': _element_text(doc, 'CardHolderHelpText'),
+        'card_holder_response_text': _element_text(
+            doc, 'CardHolderResponseText'),
+        'help_text': _element_text(doc, 'HelpText'),
+        'dps_billing_id': _element_text(doc, 'DpsBillingId'),
+    }
+
+
+def main():
+    response = Response('', '')
+    for name, body in (('successful', SAMPLE_SUCCESSFUL_RESPONSE),
+                       ('declined', SAMPLE_DECLINED_RESPONSE),
+                       ('error', SAMPLE_ERROR_RESPONSE)):
+        legacy = minidom_extract_data(body)
+        data = response._extract_data(body)
+        assert legacy == dict((key, data[key]) for key in legacy)
+        baseline = min(timeit.repeat(lambda: minidom_extract_data(body),
+                                     number=NUMBER, repeat=3))
+        best = min(timeit.repeat(lambda: response._extract_data(body),
+                                 number=NUMBER, repeat=3))
+        print("%-10s minidom: %8.2f us/op  expat: %8.2f us/op  "
+              "(%.1fx faster)" % (name, baseline / NUMBER * 1e6,
+                                  best / NUMBER * 1e6, baseline / best))
+
+
+if __name__ == '__main__':
+    main()
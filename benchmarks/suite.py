@@ -0,0 +1,75 @@
+"""
+The benchmarks run by ``run_benchmarks.py``.  They exercise the recorded
+PX POST payloads from ``tests`` and need Django to be configured with the
+``paymentexpress`` tables created.
+"""
+from django.test.utils import override_settings
+
+from paymentexpress.facade import Facade
+from paymentexpress.gateway import Request, Response, PURCHASE
+from paymentexpress.models import OrderTransaction
+from tests import (SAMPLE_SUCCESSFUL_RESPONSE, SAMPLE_DECLINED_RESPONSE,
+                   SAMPLE_ERROR_RESPONSE, SAMPLE_PURCHASE_REQUEST,
+                   CARD_VISA)
+
+RESPONSES = (
+    ('successful', SAMPLE_SUCCESSFUL_RESPONSE),
+    ('declined', SAMPLE_DECLINED_RESPONSE),
+    ('error', SAMPLE_ERROR_RESPONSE),
+)
+
+
+def build_request():
+    request = Request('TestUsername', 'TestPassword', 'AUD', PURCHASE, 29.95)
+    for key, value in (('card_holder', 'Frankie'),
+                       ('card_number', CARD_VISA),
+                       ('card_expiry', '1015'),
+                       ('cvc2', '123'),
+                       ('merchant_ref', '100001_PURCHASE_1_2008'),
+                       ('enable_add_bill_card', 1)):
+        request.set_element(key, value)
+    return request.request_xml
+
+
+def parse_response(response_xml):
+    response = Response('', response_xml)
+    return lambda: response._extract_data(response_xml)
+
+
+def mask_transaction():
+    txn = OrderTransaction(request_xml=SAMPLE_PURCHASE_REQUEST,
+                           response_xml=SAMPLE_SUCCESSFUL_RESPONSE)
+    txn.mask_request_xml()
+
+
+def save_transaction():
+    OrderTransaction(order_number='100001', txn_type=PURCHASE,
+                     txn_ref='000000030884cdc6', amount=29.95,
+                     response_code='00', response_message='APPROVED',
+                     request_xml=SAMPLE_PURCHASE_REQUEST,
+                     response_xml=SAMPLE_SUCCESSFUL_RESPONSE).save()
+
+
+def facade_purchase(post_url):
+    # Coalescing would answer every call after the first from its cache
+    with override_settings(PAYMENTEXPRESS_POST_URL=post_url,
+                           PAYMENTEXPRESS_COALESCE=False):
+        facade = Facade()
+    return lambda: facade.purchase('100001', 29.95, '0000080023748351')
+
+
+def get_benchmarks(post_url):
+    """
+    Return ``(name, func, iterations)`` for each benchmark.  ``post_url`` is
+    where the Facade round-trip is sent, normally a ``StubPxPostServer``.
+    """
+    benchmarks = [('request.build', build_request, 20000)]
+    for name, response_xml in RESPONSES:
+        benchmarks.append(('response.parse.%s' % name,
+                           parse_response(response_xml), 10000))
+    benchmarks.extend([
+        ('transaction.mask', mask_transaction, 20000),
+        ('transaction.save', save_transaction, 2000),
+        ('facade.purchase', facade_purchase(post_url), 1000),
+    ])
+    return benchmarks
@@ -0,0 +1,123 @@
+"""
+Compares the transports in ``paymentexpress.transport`` by sending billing
+purchases through a ``Gateway`` on each, from a number of threads, to a
+local stub PX POST server (or ``--url``), and reporting throughput and tail
+latency.  The in-memory transport, which answers from a simulator without a
+network round-trip, gives the cost of the rest of the request path.
+
+Run from the project root with::
+
+    python -m benchmarks.transports --requests=5000 --threads=8
+"""
+import argparse
+import sys
+import threading
+import time
+
+from benchmarks.harness import percentile
+from paymentexpress.gateway import Gateway
+from paymentexpress.transport import TRANSPORTS, get_transport_class
+from tests import StubPxPostServer
+
+DEFAULT_REQUESTS = 2000
+DEFAULT_THREADS = 4
+
+try:
+    _clock = time.perf_counter
+except AttributeError:
+    _clock = time.time
+
+
+def run_transport(name, url, requests, threads):
+    """
+    Send ``requests`` purchases through a new transport called ``name``,
+    shared by ``threads`` threads, and return the throughput and latency
+    percentiles
+    """
+    transport = get_transport_class(name)(pool_maxsize=threads)
+    gateway = Gateway(url, 'TestUsername', 'TestPassword', 'AUD',
+                      session=transport)
+    samples = []
+    errors = []
+
+    def purchase():
+        gateway.purchase(amount=1.23, dps_billing_id='0000080023748351')
+
+    def worker(count):
+        timings = []
+        try:
+            for _ in range(count):
+                start = _clock()
+                purchase()
+                timings.append(_clock() - start)
+        except Exception as e:
+            errors.append(e)
+        samples.extend(timings)
+
+    # Opens each thread's connections before timing starts
+    warmup = [threading.Thread(target=worker, args=(5,))
+              for _ in range(threads)]
+    for thread in warmup:
+        thread.start()
+    for thread in warmup:
+        thread.join()
+    del samples[:]
+
+    workers = [threading.Thread(target=worker,
+                                args=(requests // threads,))
+               for _ in range(threads)]
+    start = _clock()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = _clock() - start
+    transport.close()
+    if errors:
+        raise errors[0]
+    samples.sort()
+    return {
+        'requests': len(samples),
+        'ops_per_sec': len(samples) / elapsed,
+        'p50_us': percentile(samples, 0.5) * 1e6,
+        'p99_us': percentile(samples, 0.99) * 1e6,
+        'p999_us': percentile(samples, 0.999) * 1e6,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--requests', type=int, default=DEFAULT_REQUESTS,
+                        help="Purchases sent through each transport")
+    parser.add_argument('--threads', type=int, default=DEFAULT_THREADS,
+                        help="Threads sharing each transport")
+    parser.add_argument('--url',
+                        help="PX POST URL to send to instead of a local "
+                             "stub server")
+    parser.add_argument('transports', nargs='*',
+                        default=sorted(TRANSPORTS),
+                        help="Transports to compare (default all)")
+    options = parser.parse_args(argv)
+
+    server = None
+    url = options.url
+    if url is None:
+        server = StubPxPostServer().__enter__()
+        url = server.url
+    try:
+        for name in options.transports:
+            result = run_transport(name, url, options.requests,
+                                   options.threads)
+            sys.stdout.write(
+                "%-12s %10.1f ops/s  p50 %8.1f us  p99 %8.1f us  "
+                "p99.9 %8.1f us\n" % (
+                    name, result['ops_per_sec'], result['p50_us'],
+                    result['p99_us'], result['p999_us']))
+            sys.stdout.flush()
+    finally:
+        if server is not None:
+            server.__exit__(None, None, None)
+
+
+if __name__ == '__main__':
+    main()
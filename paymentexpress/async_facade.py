@@ -0,0 +1,290 @@
+"""
+asyncio variant of the facade, for use under ASGI workers.
+"""
+import asyncio
+import functools
+import weakref
+
+from django.conf import settings
+from paymentexpress import instrumentation
+from paymentexpress.async_gateway import (AsyncGateway, TRANSPORT_ERRORS,
+                                          DEFAULT_CONCURRENCY_LIMIT)
+from paymentexpress.cards import InvalidCard
+from paymentexpress.facade import Facade
+from paymentexpress.gateway import (
+    AUTH, COMPLETE, PURCHASE, REFUND, VALIDATE
+)
+from paymentexpress.policy import GatewayUnavailable, is_connect_failure
+from paymentexpress.reference import generate_txn_id
+from paymentexpress.registry import get_pool_config
+
+from oscar.apps.payment.exceptions import UnableToTakePayment
+import requests
+
+try:
+    from asgiref.sync import sync_to_async
+except ImportError:
+    sync_to_async = None
+
+# Identical calls in flight, per event loop, as (future, txn_id) pairs
+_calls = weakref.WeakKeyDictionary()
+
+
+async def run_sync(func, *args, **kwargs):
+    """
+    Run a blocking, database-touching callable without blocking the event
+    loop.  Django's ``sync_to_async`` is used where available so that ORM
+    calls are serialised onto the thread that owns the connection.
+    """
+    if sync_to_async is not None:
+        return await sync_to_async(func)(*args, **kwargs)
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, functools.partial(func, *args,
+                                                              **kwargs))
+
+
+def _unavailable(name):
+    def method(self, *args, **kwargs):
+        raise NotImplementedError(
+            "%s is not available on AsyncFacade; use Facade" % name)
+    method.__name__ = name
+    return method
+
+
+class AsyncFacade(Facade):
+    """
+    A bridge between oscar's objects and the asyncio gateway object.
+
+    Mirrors ``Facade`` for the default account, but every transaction method
+    is a coroutine.  The PX POST round-trip is awaited on the event loop
+    while the audit trail is written through ``run_sync``.
+    """
+
+    def __init__(self):
+        super(AsyncFacade, self).__init__()
+        # Requests count against the same rate limits, and cards are checked
+        # as strictly, as by the default account's synchronous gateway
+        default = self.gateway
+        config = self.registry.accounts[self.registry.default_account]
+        _, pool_maxsize, keepalive_timeout = get_pool_config(config)
+        self.gateway = AsyncGateway(
+            default.post_url,
+            default.username,
+            default.password,
+            default.currency,
+            limit=getattr(settings, 'PAYMENTEXPRESS_ASYNC_CONCURRENCY',
+                          DEFAULT_CONCURRENCY_LIMIT),
+            limit_per_host=pool_maxsize,
+            keepalive_timeout=keepalive_timeout,
+            policy=default.policy,
+            limiter=default.limiter,
+            preflight=default.preflight,
+            card_types=default.card_types
+        )
+
+    def _get_gateway(self, account=None, currency=None):
+        if account is not None or currency is not None:
+            raise NotImplementedError(
+                "AsyncFacade only uses the default account and currency")
+        return self.gateway
+
+    get_billing_id = _unavailable('get_billing_id')
+    save_billing_id = _unavailable('save_billing_id')
+    tokenise = _unavailable('tokenise')
+    complete_many = _unavailable('complete_many')
+    refund_many = _unavailable('refund_many')
+    reconcile = _unavailable('reconcile')
+
+    async def _coalesce(self, txn_type, order_number, amount, func, *args):
+        """
+        Coroutine counterpart of ``Facade._coalesce``, sharing the outcome
+        of an identical call in flight on this event loop, or the result or
+        pending TxnId of one just made in this process
+        """
+        if self.coalescer is None:
+            return await func(*args, txn_id=generate_txn_id())
+        key = (None, None, order_number, txn_type, u'%s' % amount)
+        result = self.coalescer.get_result(key)
+        if result is not None:
+            instrumentation.count('facade.coalesced', txn_type=txn_type)
+            return result
+        pending_txn_id = self.coalescer.get_pending(key)
+        if pending_txn_id is not None:
+            raise self._pending(pending_txn_id)
+        timeout = 2 * self.gateway.policy.max_duration
+        calls = _calls.setdefault(asyncio.get_event_loop(), {})
+        if key in calls:
+            instrumentation.count('facade.coalesced', txn_type=txn_type)
+            future, txn_id = calls[key]
+            try:
+                result = await asyncio.wait_for(asyncio.shield(future),
+                                                timeout)
+            except asyncio.TimeoutError:
+                raise self._pending(txn_id)
+            return dict(result)
+
+        txn_id = generate_txn_id()
+        future = asyncio.get_event_loop().create_future()
+        calls[key] = (future, txn_id)
+        try:
+            result = await func(*args, txn_id=txn_id)
+        except BaseException as e:
+            # A call cancelled part way may still have been sent
+            if not isinstance(e, Exception):
+                e = self._pending(txn_id)
+            if getattr(e, 'txn_id', None) is not None:
+                self.coalescer.set_pending(key, e.txn_id, timeout)
+            future.set_exception(e)
+            # Nobody need be waiting for it
+            future.exception()
+            raise
+        else:
+            self.coalescer.set_result(key, result)
+            future.set_result(result)
+            return dict(result)
+        finally:
+            del calls[key]
+
+    async def _send(self, gateway, gateway_method, txn_id=None, **kwargs):
+        """
+        Coroutine counterpart of ``Facade._send``
+        """
+        if txn_id is None:
+            txn_id = generate_txn_id()
+        try:
+            response = await gateway_method(txn_id=txn_id, **kwargs)
+        except InvalidCard as e:
+            # Rejected before anything was sent
+            raise UnableToTakePayment(str(e))
+        except (requests.RequestException,) + TRANSPORT_ERRORS as e:
+            response = e
+        return await self._settle(gateway, txn_id, response)
+
+    async def _settle(self, gateway, txn_id, response):
+        """
+        Coroutine counterpart of ``Facade._settle``
+        """
+        if isinstance(response, Exception):
+            # Nothing reached PX POST if the connection was never made
+            if isinstance(response, GatewayUnavailable) or \
+                    is_connect_failure(response):
+                raise response
+        elif not self._is_ambiguous(response):
+            return response
+        return await self._resolve(gateway, txn_id)
+
+    async def _resolve(self, gateway, txn_id):
+        try:
+            response = await gateway.status(txn_id=txn_id)
+        except (requests.RequestException,) + TRANSPORT_ERRORS:
+            response = None
+        if response is None or self._is_ambiguous(response):
+            raise self._pending(txn_id)
+        return response
+
+    async def authorise(self, order_number, amount, bankcard):
+        """
+        Authorizes a transaction.
+        Must be completed within 7 days using the "Complete" TxnType
+        """
+        self._check_amount(amount)
+        return await self._coalesce(AUTH, order_number, amount,
+                                    self._authorise, order_number, amount,
+                                    bankcard)
+
+    async def _authorise(self, order_number, amount, bankcard, txn_id=None):
+        merchant_ref = await run_sync(self._get_merchant_reference,
+                                      order_number, AUTH)
+        res = await self._send(self.gateway, self.gateway.authorise,
+                               txn_id=txn_id,
+                               **self._get_card_kwargs(
+                                   bankcard, amount=amount,
+                                   merchant_ref=merchant_ref))
+        return await run_sync(self._handle_response, AUTH, order_number,
+                              amount, res, txn_id=txn_id)
+
+    async def complete(self, order_number, amount, dps_txn_ref):
+        """
+        Completes (settles) a pre-approved Auth Transaction.
+        """
+        self._check_amount(amount)
+        merchant_ref = await run_sync(self._get_merchant_reference,
+                                      order_number, COMPLETE)
+        txn_id = generate_txn_id()
+        res = await self._send(self.gateway, self.gateway.complete,
+                               txn_id=txn_id,
+                               amount=amount,
+                               dps_txn_ref=dps_txn_ref,
+                               merchant_ref=merchant_ref)
+        return await run_sync(self._handle_response, COMPLETE, order_number,
+                              amount, res, txn_id=txn_id)
+
+    async def purchase(self, order_number, amount, billing_id=None,
+                       bankcard=None):
+        """
+        Purchase - Funds are transferred immediately.
+        """
+        self._check_amount(amount)
+        if not billing_id and not bankcard:
+            raise ValueError("You must specify either a billing id or " +
+                "a merchant reference")
+        return await self._coalesce(PURCHASE, order_number, amount,
+                                    self._purchase, order_number, amount,
+                                    billing_id, bankcard)
+
+    async def _purchase(self, order_number, amount, billing_id, bankcard,
+                        txn_id=None):
+        merchant_ref = await run_sync(self._get_merchant_reference,
+                                      order_number, PURCHASE)
+        if billing_id:
+            res = await self._send(self.gateway, self.gateway.purchase,
+                                   txn_id=txn_id,
+                                   amount=amount,
+                                   dps_billing_id=billing_id,
+                                   merchant_ref=merchant_ref)
+        else:
+            res = await self._send(self.gateway, self.gateway.purchase,
+                                   txn_id=txn_id,
+                                   **self._get_card_kwargs(
+                                       bankcard, amount=amount,
+                                       merchant_ref=merchant_ref,
+                                       enable_add_bill_card=1))
+        return await run_sync(self._handle_response, PURCHASE, order_number,
+                              amount, res, txn_id=txn_id)
+
+    async def refund(self, order_number, amount, dps_txn_ref):
+        """
+        Refund - Funds transferred immediately.
+        """
+        self._check_amount(amount)
+        merchant_ref = await run_sync(self._get_merchant_reference,
+                                      order_number, REFUND)
+        txn_id = generate_txn_id()
+        res = await self._send(self.gateway, self.gateway.refund,
+                               txn_id=txn_id,
+                               amount=amount,
+                               dps_txn_ref=dps_txn_ref,
+                               merchant_ref=merchant_ref)
+        return await run_sync(self._handle_response, REFUND, order_number,
+                              amount, res, txn_id=txn_id)
+
+    async def validate(self, bankcard):
+        """
+        Validation Transaction - effects a $1.00 Auth.
+        """
+        amount = 1.00
+        txn_id = generate_txn_id()
+        res = await self._send(self.gateway, self.gateway.validate,
+                               txn_id=txn_id,
+                               **self._get_card_kwargs(
+                                   bankcard, amount=amount,
+                                   enable_add_bill_card=1))
+        return await run_sync(self._handle_response, VALIDATE, None,
+                              amount, res, txn_id=txn_id)
+
+    async def status(self, txn_id):
+        """
+        Status - looks up the outcome of a transaction by its TxnId, as
+        carried by ``TransactionPending``.
+        """
+        return self._get_result(await self._resolve(self.gateway, txn_id))
@@ -0,0 +1,215 @@
+"""
+asyncio variant of the gateway, for use under ASGI workers.
+
+Requires Python 3.5+ and the optional ``aiohttp`` dependency.
+"""
+import asyncio
+import weakref
+
+from paymentexpress import instrumentation
+from paymentexpress.gateway import Gateway, Response
+from paymentexpress.masking import mask_xml
+from paymentexpress.policy import (CircuitOpenError, GatewayUnavailable,
+                                   ServerError)
+from paymentexpress.ratelimit import RateLimitExceeded
+from paymentexpress.transport import (DEFAULT_POOL_MAXSIZE,
+                                      DEFAULT_KEEPALIVE_TIMEOUT)
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+    TRANSPORT_ERRORS = (asyncio.TimeoutError, ServerError)
+else:
+    # What a send that may or may not have reached PX POST can raise
+    TRANSPORT_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError,
+                        ServerError)
+
+DEFAULT_CONCURRENCY_LIMIT = 100
+
+# Client sessions are bound to the event loop they were created on, so the
+# shared sessions are kept per loop and disappear along with it.
+_sessions = weakref.WeakKeyDictionary()
+
+
+def get_async_session(limit=DEFAULT_CONCURRENCY_LIMIT,
+                      limit_per_host=DEFAULT_POOL_MAXSIZE,
+                      keepalive_timeout=DEFAULT_KEEPALIVE_TIMEOUT):
+    """
+    Return the shared ``aiohttp`` session for the running event loop and
+    the given pool configuration, creating it on first use.
+    """
+    if aiohttp is None:
+        raise ImportError("aiohttp must be installed to use AsyncGateway")
+    loop = asyncio.get_event_loop()
+    loop_sessions = _sessions.setdefault(loop, {})
+    key = (limit, limit_per_host, keepalive_timeout)
+    session = loop_sessions.get(key)
+    if session is None or session.closed:
+        connector = aiohttp.TCPConnector(limit=limit,
+                                         limit_per_host=limit_per_host,
+                                         keepalive_timeout=keepalive_timeout)
+        session = aiohttp.ClientSession(connector=connector)
+        loop_sessions[key] = session
+    return session
+
+
+async def close_async_sessions():
+    """
+    Close every shared session belonging to the running event loop
+    """
+    loop_sessions = _sessions.pop(asyncio.get_event_loop(), {})
+    for session in loop_sessions.values():
+        await session.close()
+
+
+async def acquire(limiter, txn_type):
+    """
+    Coroutine counterpart of ``RateLimiter.acquire``, which waits for a token
+    without blocking the event loop
+    """
+    bucket = limiter.get_bucket(txn_type)
+    if bucket is None:
+        return 0
+    waited = 0
+    while True:
+        wait = bucket.try_acquire()
+        if not wait:
+            return waited
+        if waited + wait > limiter.max_wait:
+            raise RateLimitExceeded(
+                "Rate limit for %s requests exceeded" % txn_type)
+        await asyncio.sleep(wait)
+        waited += wait
+
+
+async def execute(policy, url, request, send):
+    """
+    Coroutine counterpart of ``RetryPolicy.execute``, for an async ``send``
+    """
+    breaker = policy.get_breaker(url)
+    attempt = 0
+    while True:
+        if not breaker.allow_request():
+            raise CircuitOpenError("PX POST at %s is unavailable" % url)
+        response = None
+        failed, sent = True, True
+        try:
+            response = await send(policy.timeout)
+            failed = response.is_empty()
+        except GatewayUnavailable:
+            # Turned away before sending, such as by the rate limiter
+            sent = False
+            raise
+        except TRANSPORT_ERRORS as e:
+            if not policy.should_retry(request, attempt, error=e):
+                raise
+        finally:
+            # Any other exception counts as a failure, so that a half-open
+            # trial always ends
+            if not sent:
+                breaker.record_unsent()
+            elif failed:
+                breaker.record_failure()
+            else:
+                breaker.record_success()
+        if response is not None and not policy.should_retry(
+                request, attempt, response=response):
+            return response
+        await asyncio.sleep(policy.get_delay(attempt))
+        attempt += 1
+
+
+class AsyncGateway(Gateway):
+    """
+    Non-blocking transport class used to send PaymentExpress requests.
+
+    Takes the same arguments as ``Gateway`` and exposes the same API, except
+    that every transaction method is a coroutine.
+    """
+
+    def __init__(self, post_url, username, password, currency, session=None,
+                 policy=None, limiter=None, preflight=True, card_types=None,
+                 limit=DEFAULT_CONCURRENCY_LIMIT,
+                 limit_per_host=DEFAULT_POOL_MAXSIZE,
+                 keepalive_timeout=DEFAULT_KEEPALIVE_TIMEOUT):
+        if aiohttp is None:
+            raise ImportError("aiohttp must be installed to use AsyncGateway")
+        super(AsyncGateway, self).__init__(
+            post_url, username, password, currency, session=session,
+            policy=policy, limiter=limiter, preflight=preflight,
+            card_types=card_types)
+        # An aiohttp session can only be created inside a running loop, so
+        # unless one is given the loop's shared session is looked up per call
+        self.session = session
+        self.pool_config = (limit, limit_per_host, keepalive_timeout)
+
+    async def _fetch_response(self, request):
+        """
+        Sends the request
+        """
+        if request.spec is None:
+            self._check_kwargs(request.data, request.required_keys)
+        session = self.session
+        if session is None:
+            session = get_async_session(*self.pool_config)
+        txn_type = request.data.get('txn_type')
+        with instrumentation.timed('gateway.build', txn_type=txn_type):
+            request_bytes = request.request_bytes
+            masked_xml = mask_xml(request.request_xml)
+
+        async def send(timeout):
+            # Every attempt, retries included, counts against the limit
+            if self.limiter is not None:
+                with instrumentation.timed('gateway.rate_limit',
+                                           txn_type=txn_type):
+                    await acquire(self.limiter, txn_type)
+            connect_timeout, read_timeout = timeout
+            with instrumentation.timed('gateway.network', txn_type=txn_type):
+                async with session.post(
+                        self.post_url, data=request_bytes,
+                        auth=aiohttp.BasicAuth(self.username, self.password),
+                        timeout=aiohttp.ClientTimeout(
+                            sock_connect=connect_timeout,
+                            sock_read=read_timeout)
+                ) as response:
+                    if response.status >= 500:
+                        raise ServerError("PX POST replied with HTTP %d"
+                                          % response.status)
+                    response_xml = await response.read()
+            return Response(masked_xml, response_xml)
+
+        try:
+            response = await execute(self.policy, self.post_url, request,
+                                     send)
+        except Exception:
+            instrumentation.record_error('gateway', txn_type)
+            raise
+        instrumentation.record_response(txn_type, response)
+        return response
+
+    async def authorise(self, **kwargs):
+        return await super(AsyncGateway, self).authorise(**kwargs)
+
+    async def complete(self, **kwargs):
+        return await super(AsyncGateway, self).complete(**kwargs)
+
+    async def purchase(self, **kwargs):
+        return await super(AsyncGateway, self).purchase(**kwargs)
+
+    async def validate(self, **kwargs):
+        return await super(AsyncGateway, self).validate(**kwargs)
+
+    async def refund(self, **kwargs):
+        return await super(AsyncGateway, self).refund(**kwargs)
+
+    async def status(self, **kwargs):
+        return await super(AsyncGateway, self).status(**kwargs)
+
+    def complete_batch(self, batch, max_workers=None):
+        raise NotImplementedError(
+            "Batches are not available on AsyncGateway; use asyncio.gather")
+
+    def status_batch(self, txn_ids, max_workers=None):
+        raise NotImplementedError(
+            "Batches are not available on AsyncGateway; use asyncio.gather")
@@ -0,0 +1,311 @@
+"""
+Write-behind recording of ``OrderTransaction`` rows.
+
+Rather than inserting each audit row inside the customer's request, the
+facade can hand it to an ``AuditWriter``, whose background thread inserts
+queued rows in batches.  Every row is first appended to a journal file, so
+rows still queued when a process dies are inserted by the next writer to
+start.  After each batch the journal is rewritten to hold only the rows still
+queued and those whose insert failed, which the writer retries.
+"""
+import atexit
+import glob
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from paymentexpress.models import OrderTransaction, RESPONSE_COLUMNS
+
+try:
+    from queue import Queue, Empty, Full
+except ImportError:
+    from Queue import Queue, Empty, Full
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger('paymentexpress')
+
+DEFAULT_QUEUE_SIZE = 1000
+DEFAULT_BATCH_SIZE = 100
+DEFAULT_FLUSH_INTERVAL = 1.0
+
+# Longest wait, in seconds, between attempts to insert rows that failed
+MAX_RETRY_INTERVAL = 60
+
+# Fields copied from each transaction into the journal
+RECORD_FIELDS = ('order_number', 'txn_type', 'txn_ref', 'txn_id', 'amount',
+                 'response_code', 'response_message', 'request_xml',
+                 'response_xml', 'columns_filled') + RESPONSE_COLUMNS
+
+# Fields kept in the journal as strings, which Django converts back on insert
+_STRING_FIELDS = ('amount', 'amount_settled')
+
+_STOP = object()
+
+
+def _to_record(txn):
+    record = {}
+    for field in RECORD_FIELDS:
+        value = getattr(txn, field)
+        if value is not None:
+            if field in _STRING_FIELDS:
+                value = str(value)
+            elif field == 'rx_date':
+                value = value.isoformat()
+        record[field] = value
+    return record
+
+
+class AuditWriter(object):
+    """
+    Queues transactions and inserts them in batches from a background thread.
+
+    ``journal_dir``, when given, is where each writer keeps its journal of
+    rows that have been queued but not yet inserted.  Journals left behind
+    by writers that are no longer running are replayed on ``start``.
+    Replaying a journal may re-insert rows whose batch was committed just
+    before the crash, so records are never lost but can be duplicated.
+    Without a ``journal_dir`` there is no journal, and rows still queued
+    when the process dies are lost.
+
+    Batches which cannot be inserted are retried from the background thread,
+    backing off up to ``MAX_RETRY_INTERVAL`` seconds.  After each batch the
+    journal is rewritten to hold only the rows still in flight and those
+    which failed, so it does not grow under steady load and is not replayed
+    for rows already inserted.
+    """
+
+    def __init__(self, queue_size=DEFAULT_QUEUE_SIZE,
+                 batch_size=DEFAULT_BATCH_SIZE,
+                 flush_interval=DEFAULT_FLUSH_INTERVAL,
+                 journal_dir=None, fsync=False):
+        self.queue = Queue(queue_size)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.journal_dir = journal_dir
+        self.fsync = fsync
+        self.journal_path = None
+        self._journal = None
+        self._journal_lock = threading.Lock()
+        # Rows journalled and not yet inserted or failed
+        self._in_flight = []
+        # Rows whose insert failed, to be retried, and when to retry them
+        self._failed = []
+        self._retry_interval = flush_interval
+        self._retry_at = None
+        self._thread = None
+
+    def start(self):
+        if self.journal_dir:
+            self.replay_journals()
+            self._open_journal()
+        self._thread = threading.Thread(target=self._run,
+                                        name='paymentexpress-audit')
+        self._thread.daemon = True
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        """
+        Insert everything still queued and stop the background thread
+        """
+        if self._thread is None:
+            return
+        self.queue.put(_STOP)
+        self._thread.join()
+        self._thread = None
+        self._retry_failed()
+        if self._journal is not None:
+            self._journal.close()
+            # A journal holding failed rows is left for the next writer
+            if not self._in_flight and not self._failed:
+                os.remove(self.journal_path)
+            self._journal = None
+
+    def flush(self):
+        """
+        Block until every queued transaction has been inserted
+        """
+        self.queue.join()
+
+    def submit(self, txn):
+        """
+        Queue an unsaved ``OrderTransaction`` for insertion.  If the queue
+        is full the transaction is inserted straight away instead.
+        """
+        txn.mask_request_xml()
+        record = _to_record(txn)
+        self._append_to_journal(record)
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            self._write([record])
+
+    # Journal
+
+    def _open_journal(self):
+        if not os.path.isdir(self.journal_dir):
+            os.makedirs(self.journal_dir)
+        self.journal_path = os.path.join(
+            self.journal_dir, 'audit-%d-%s.journal' % (os.getpid(),
+                                                       uuid.uuid4().hex))
+        self._journal = open(self.journal_path, 'a')
+        if fcntl is not None:
+            # Held for the life of the writer, so that other processes can
+            # tell this journal apart from one left by a crashed writer
+            fcntl.flock(self._journal, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+    def _append_to_journal(self, record):
+        with self._journal_lock:
+            self._in_flight.append(record)
+            if self._journal is None:
+                return
+            self._journal.write(json.dumps(record) + '\n')
+            self._journal.flush()
+            if self.fsync:
+                os.fsync(self._journal.fileno())
+
+    def _settled(self, records, failed=()):
+        """
+        Note that ``records`` are no longer in flight, of which ``failed``
+        could not be inserted, and rewrite the journal to match
+        """
+        with self._journal_lock:
+            settled = set(id(record) for record in records)
+            self._in_flight = [record for record in self._in_flight
+                               if id(record) not in settled]
+            self._failed.extend(failed)
+            if self._journal is not None:
+                self._journal.seek(0)
+                self._journal.truncate(0)
+                for record in self._in_flight + self._failed:
+                    self._journal.write(json.dumps(record) + '\n')
+                self._journal.flush()
+                if self.fsync:
+                    os.fsync(self._journal.fileno())
+
+    def replay_journals(self):
+        """
+        Insert the rows of any journals left by writers that are no longer
+        running
+        """
+        pattern = os.path.join(self.journal_dir, 'audit-*.journal')
+        for path in glob.glob(pattern):
+            if path == self.journal_path:
+                continue
+            with open(path, 'r+') as journal:
+                if fcntl is not None:
+                    try:
+                        fcntl.flock(journal, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except IOError:
+                        # Still in use by a running writer
+                        continue
+                records = [json.loads(line) for line in journal
+                           if line.strip()]
+                if records:
+                    self._insert(records)
+                    logger.info("Replayed %d audit records from %s",
+                                len(records), path)
+            os.remove(path)
+
+    # Background thread
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            if self._retry_at is not None and time.time() >= self._retry_at:
+                self._retry_failed()
+            try:
+                first = self.queue.get(timeout=self.flush_interval)
+            except Empty:
+                continue
+            batch = [first]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Empty:
+                    break
+            records = [r for r in batch if r is not _STOP]
+            stopping = len(records) != len(batch)
+            if records:
+                self._write(records)
+            for _ in batch:
+                self.queue.task_done()
+
+    def _insert(self, records):
+        OrderTransaction.objects.record_many(
+            [OrderTransaction(**record) for record in records])
+
+    def _write(self, records):
+        try:
+            self._insert(records)
+        except Exception:
+            logger.exception("Unable to insert %d audit records",
+                             len(records))
+            if self._retry_at is None:
+                self._retry_at = time.time() + self._retry_interval
+            self._settled(records, records)
+        else:
+            self._settled(records)
+
+    def _retry_failed(self):
+        """
+        Try again to insert the rows which failed, backing off further if
+        they fail again
+        """
+        with self._journal_lock:
+            records, self._failed = self._failed, []
+            # In flight again until settled
+            self._in_flight.extend(records)
+        if not records:
+            return
+        self._retry_at = None
+        self._write(records)
+        if self._retry_at is not None:
+            self._retry_interval = min(MAX_RETRY_INTERVAL,
+                                       self._retry_interval * 2)
+            self._retry_at = time.time() + self._retry_interval
+        else:
+            self._retry_interval = self.flush_interval
+            logger.info("Inserted %d audit records on retry", len(records))
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_audit_writer():
+    """
+    Return the process-wide writer, configured from settings and started on
+    first use.  Unless ``PAYMENTEXPRESS_AUDIT_JOURNAL_DIR`` is set it keeps
+    no journal.
+    """
+    global _writer
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                writer = AuditWriter(
+                    queue_size=getattr(settings,
+                                       'PAYMENTEXPRESS_AUDIT_QUEUE_SIZE',
+                                       DEFAULT_QUEUE_SIZE),
+                    batch_size=getattr(settings,
+                                       'PAYMENTEXPRESS_AUDIT_BATCH_SIZE',
+                                       DEFAULT_BATCH_SIZE),
+                    flush_interval=getattr(
+                        settings, 'PAYMENTEXPRESS_AUDIT_FLUSH_INTERVAL',
+                        DEFAULT_FLUSH_INTERVAL),
+                    journal_dir=getattr(settings,
+                                        'PAYMENTEXPRESS_AUDIT_JOURNAL_DIR',
+                                        None),
+                    fsync=getattr(settings, 'PAYMENTEXPRESS_AUDIT_FSYNC',
+                                  False))
+                writer.start()
+                _writer = writer
+    return _writer
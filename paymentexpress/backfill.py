@@ -0,0 +1,107 @@
+"""
+Backfill of the parsed response columns of ``OrderTransaction`` rows
+recorded before those columns existed.
+
+The table is walked in ranges of primary keys.  Each range's stored reply
+XML is read, parsed and written back on its own, so memory use is bounded by
+the chunk size rather than the size of the table.  Ranges can be shared out
+between worker processes, each with its own database connection.
+"""
+import functools
+import multiprocessing
+from xml.parsers.expat import ExpatError
+
+from django.db import connection, transaction
+from django.db.models import Max, Min
+
+from paymentexpress.gateway import Response
+from paymentexpress.models import OrderTransaction
+
+DEFAULT_CHUNK_SIZE = 500
+
+try:
+    atomic = transaction.atomic
+except AttributeError:
+    atomic = transaction.commit_on_success
+
+
+def pending_transactions(refill=False):
+    """
+    Transactions whose reply XML is stored but has not been parsed into
+    columns, or every one with XML if ``refill`` is set
+    """
+    txns = OrderTransaction.objects.filter(xml__isnull=False)
+    if not refill:
+        txns = txns.filter(columns_filled=False)
+    return txns
+
+
+def pk_ranges(txns, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Return the half-open ``(start, end)`` primary key ranges covering
+    ``txns``, of ``chunk_size`` keys each
+    """
+    bounds = txns.aggregate(low=Min('pk'), high=Max('pk'))
+    if bounds['low'] is None:
+        return []
+    end = bounds['high'] + 1
+    return [(start, min(start + chunk_size, end))
+            for start in range(bounds['low'], end, chunk_size)]
+
+
+def backfill_range(pk_range, refill=False):
+    """
+    Fill in the columns of the pending transactions in ``pk_range``,
+    returning the number of rows read and updated.  Rows whose reply holds
+    none of the columns are only marked as filled in, and rows whose reply
+    can't be parsed are left pending.
+    """
+    start, end = pk_range
+    rows = pending_transactions(refill).filter(
+        pk__gte=start, pk__lt=end).values_list('pk', 'xml__response_xml')
+    read = 0
+    updates, empty = [], []
+    for pk, response_xml in rows:
+        read += 1
+        try:
+            columns = OrderTransaction.response_columns(
+                Response('', response_xml))
+        except (ExpatError, UnicodeError, LookupError):
+            continue
+        if columns:
+            updates.append((pk, columns))
+        else:
+            empty.append(pk)
+    # Parsed before writing, so the transaction is held only while updating
+    with atomic():
+        for pk, columns in updates:
+            OrderTransaction.objects.filter(pk=pk).update(
+                columns_filled=True, **columns)
+        if empty:
+            OrderTransaction.objects.filter(pk__in=empty).update(
+                columns_filled=True)
+    return read, len(updates)
+
+
+def backfill(chunk_size=DEFAULT_CHUNK_SIZE, processes=1, refill=False):
+    """
+    Backfill every pending transaction, yielding the number of rows read
+    and updated for each chunk as it completes.  Chunks are processed in
+    this process, or by a pool of ``processes`` worker processes.
+    """
+    ranges = pk_ranges(pending_transactions(refill), chunk_size)
+    func = functools.partial(backfill_range, refill=refill)
+    if processes <= 1:
+        for pk_range in ranges:
+            yield func(pk_range)
+        return
+    # Forked workers must open database connections of their own
+    connection.close()
+    pool = multiprocessing.Pool(processes)
+    try:
+        for counts in pool.imap_unordered(func, ranges):
+            yield counts
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
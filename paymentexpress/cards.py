@@ -0,0 +1,165 @@
+"""
+Card scheme detection, local card checks, and the fingerprints stored cards
+are looked up by.
+
+``check_card`` rejects card details PX POST would certainly decline (a
+mistyped number, an expired card, a scheme the merchant doesn't take or a
+security code of the wrong length) without a round-trip.  Cards of schemes
+not listed here, such as UnionPay or Maestro, are only checked for their
+Luhn checksum, a plausible length and their expiry.
+
+A fingerprint is made of the card type, last four digits and expiry only,
+so the full card number is never kept or used as a key.
+"""
+import bisect
+import re
+import time
+
+# Card types, named as in PX POST's CardName
+VISA = 'Visa'
+MASTERCARD = 'MasterCard'
+AMEX = 'Amex'
+DINERS = 'Diners'
+DISCOVER = 'Discover'
+JCB = 'JCB'
+UNKNOWN = 'Unknown'
+
+# Ranges of the first six digits (BIN) issued to each scheme, in order
+BIN_RANGES = (
+    (222100, 272099, MASTERCARD),
+    (300000, 305999, DINERS),
+    (309500, 309599, DINERS),
+    (340000, 349999, AMEX),
+    (352800, 358999, JCB),
+    (360000, 369999, DINERS),
+    (370000, 379999, AMEX),
+    (380000, 399999, DINERS),
+    (400000, 499999, VISA),
+    (510000, 559999, MASTERCARD),
+    (601100, 601199, DISCOVER),
+    (644000, 659999, DISCOVER),
+)
+
+_BIN_STARTS = tuple(low for low, _, _ in BIN_RANGES)
+
+# Card number lengths and security code length of each scheme
+CARD_RULES = {
+    VISA: (frozenset([13, 16, 19]), 3),
+    MASTERCARD: (frozenset([16]), 3),
+    AMEX: (frozenset([15]), 4),
+    DINERS: (frozenset(range(14, 20)), 3),
+    DISCOVER: (frozenset(range(16, 20)), 3),
+    JCB: (frozenset(range(16, 20)), 3),
+    # Any length cards are issued in, and a security code of either length
+    UNKNOWN: (frozenset(range(12, 20)), None),
+}
+
+# Doubled digits with their own digits summed, for the Luhn check
+_DOUBLED = (0, 2, 4, 6, 8, 1, 3, 5, 7, 9)
+
+_NON_DIGITS = re.compile(r'[^0-9]')
+
+# Only ASCII digits, as ``str.isdigit`` also accepts other scripts' digits
+_DIGITS = re.compile(r'[0-9]+\Z')
+
+
+class InvalidCard(ValueError):
+    """
+    Raised, without contacting PX POST, for card details which cannot be
+    approved
+    """
+
+
+def normalise(card_number):
+    """
+    Return a card number without the spaces and dashes it may be typed with
+    """
+    return _NON_DIGITS.sub('', card_number or '')
+
+
+def _get_bin_type(number):
+    prefix = int(number[:6].ljust(6, '0'))
+    index = bisect.bisect_right(_BIN_STARTS, prefix) - 1
+    if index >= 0 and prefix <= BIN_RANGES[index][1]:
+        return BIN_RANGES[index][2]
+    return UNKNOWN
+
+
+def get_card_type(card_number):
+    number = normalise(card_number)
+    if not number:
+        return UNKNOWN
+    return _get_bin_type(number)
+
+
+def is_luhn_valid(number):
+    """
+    Whether a string of digits passes the Luhn checksum
+    """
+    total = 0
+    double = False
+    for c in reversed(number):
+        digit = ord(c) - 48
+        if not 0 <= digit <= 9:
+            return False
+        total += _DOUBLED[digit] if double else digit
+        double = not double
+    return total % 10 == 0
+
+
+def is_expired(expiry, today=None):
+    """
+    Whether a card with an mmyy expiry has expired.  Cards are valid until
+    the end of their expiry month.
+    """
+    if today is None:
+        # Cheaper than building a date on every call
+        now = time.localtime()
+        current = (now.tm_year, now.tm_mon)
+    else:
+        current = (today.year, today.month)
+    return (2000 + int(expiry[2:]), int(expiry[:2])) < current
+
+
+def check_card(card_number, expiry=None, cvc=None, card_types=None,
+               today=None):
+    """
+    Raise ``InvalidCard`` unless a card number passes the Luhn check and
+    has a length its scheme issues, the card has not expired and its
+    security code has its scheme's length.  Only the schemes in
+    ``card_types`` are accepted, if given; otherwise cards of unknown
+    schemes are too.  Returns the card type.
+    """
+    number = card_number or ''
+    if not _DIGITS.match(number):
+        number = normalise(number)
+        if not number:
+            raise InvalidCard("Card number is not valid")
+    card_type = _get_bin_type(number)
+    if card_types is not None and card_type not in card_types:
+        raise InvalidCard("This type of card is not accepted")
+    lengths, cvc_length = CARD_RULES[card_type]
+    if len(number) not in lengths or not is_luhn_valid(number):
+        raise InvalidCard("Card number is not valid")
+    if expiry and is_expired(
+            expiry if _DIGITS.match(expiry) else normalise(expiry), today):
+        raise InvalidCard("Card has expired")
+    if cvc:
+        cvc = u'%s' % cvc
+        if cvc_length is None:
+            if len(cvc) not in (3, 4) or not _DIGITS.match(cvc):
+                raise InvalidCard("Card security code must be 3 or 4 "
+                                  "digits")
+        elif len(cvc) != cvc_length or not _DIGITS.match(cvc):
+            raise InvalidCard("Card security code must be %d digits"
+                              % cvc_length)
+    return card_type
+
+
+def get_fingerprint(card_number, expiry):
+    """
+    Return the fingerprint of a card number and its mmyy (or mm/yy) expiry
+    """
+    number = normalise(card_number)
+    return '%s:%s:%s' % (get_card_type(number), number[-4:],
+                         normalise(expiry))
@@ -0,0 +1,273 @@
+"""
+Guards against the same payment being submitted twice, for example by a
+double-clicked "Place order" button.
+
+Calls are keyed by account, currency, order number, transaction type and
+amount.  While one call is in flight, identical calls wait for it and share
+its outcome instead of contacting PX POST themselves.  Successful results
+are then kept for ``PAYMENTEXPRESS_RESUBMIT_TTL`` seconds and handed to any
+immediate resubmit.  Declines and errors are only shared with the calls
+which were waiting, so a corrected resubmit is still sent, except that a
+call whose outcome is not yet known leaves identical calls pending on its
+TxnId until it could have finished.
+
+Set ``PAYMENTEXPRESS_COALESCE_CACHE`` to the alias of a Django cache shared
+by every process to guard across processes as well.
+"""
+import threading
+import time
+
+from django.conf import settings
+
+try:
+    from django.core.signals import setting_changed
+except ImportError:
+    # Django < 1.8 only sends it from the test utilities
+    from django.test.signals import setting_changed
+
+try:
+    from django.core.cache import caches
+except ImportError:
+    from django.core.cache import get_cache
+else:
+    def get_cache(alias):
+        return caches[alias]
+
+from paymentexpress import instrumentation
+
+from oscar.apps.payment.exceptions import PaymentError
+
+DEFAULT_RESUBMIT_TTL = 30
+DEFAULT_WAIT_TIMEOUT = 120
+DEFAULT_POLL_INTERVAL = 0.05
+
+CACHE_KEY_PREFIX = 'paymentexpress:coalesce'
+
+
+class DuplicateTransaction(PaymentError):
+    """
+    Raised when an identical transaction is still being processed
+    """
+
+
+class CallPending(DuplicateTransaction):
+    """
+    Raised when an identical call does not finish in time, or finished
+    without its outcome being known.  ``txn_id`` is the one it was given, if
+    any.
+    """
+
+    def __init__(self, message, txn_id=None):
+        super(CallPending, self).__init__(message)
+        self.txn_id = txn_id
+
+
+class _Call(object):
+    __slots__ = ('event', 'result', 'error', 'txn_id')
+
+    def __init__(self, txn_id=None):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+        self.txn_id = txn_id
+
+
+class Coalescer(object):
+    """
+    Runs at most one call per key at a time, sharing its outcome with
+    identical calls made meanwhile and its result with those made within
+    ``ttl`` seconds of it.  ``cache``, a Django cache, extends both across
+    processes.  Calls waiting on another call give up after ``wait_timeout``
+    seconds, unless ``run`` is given a timeout of its own.
+    """
+
+    def __init__(self, ttl=DEFAULT_RESUBMIT_TTL, cache=None,
+                 wait_timeout=DEFAULT_WAIT_TIMEOUT,
+                 poll_interval=DEFAULT_POLL_INTERVAL):
+        self.ttl = ttl
+        self.cache = cache
+        self.wait_timeout = wait_timeout
+        self.poll_interval = poll_interval
+        self._calls = {}
+        self._results = {}
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def run(self, key, func, txn_id=None, timeout=None):
+        """
+        Return ``func()``, or the result of an identical call in flight or
+        just made.  Waiting on a call in this process for longer than
+        ``timeout`` raises ``CallPending`` with the ``txn_id`` that call was
+        run under.  So does any identical call made within ``timeout``
+        seconds of one which raised an error carrying a ``txn_id``, such as
+        ``TransactionPending``, as it may yet have been processed.
+        """
+        if timeout is None:
+            timeout = self.wait_timeout
+        with self._lock:
+            result = self._get_result(key)
+            if result is not None:
+                instrumentation.count('facade.coalesced', txn_type=key[3])
+                return dict(result)
+            pending_txn_id = self._get_entry(self._pending, key)
+            if pending_txn_id is not None:
+                raise CallPending(
+                    "An identical transaction's outcome is not yet known",
+                    pending_txn_id)
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call(txn_id)
+        if not leader:
+            instrumentation.count('facade.coalesced', txn_type=key[3])
+            if not call.event.wait(timeout):
+                raise CallPending(
+                    "An identical transaction is still being processed",
+                    call.txn_id)
+            if call.error is not None:
+                raise call.error
+            return dict(call.result)
+
+        try:
+            if self.cache is None:
+                call.result = func()
+            else:
+                call.result = self._run_shared(key, func, txn_id, timeout)
+        except Exception as e:
+            call.error = e
+            if getattr(e, 'txn_id', None) is not None:
+                self.set_pending(key, e.txn_id, timeout)
+            raise
+        else:
+            self.set_result(key, call.result)
+            return dict(call.result)
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+
+    def get_result(self, key):
+        """
+        Return a copy of the result of an identical call just made, or None
+        """
+        with self._lock:
+            result = self._get_result(key)
+        return None if result is None else dict(result)
+
+    def _get_result(self, key):
+        return self._get_entry(self._results, key)
+
+    def set_result(self, key, result):
+        if self.ttl > 0:
+            self._set_entry(self._results, key, result, self.ttl)
+
+    def get_pending(self, key):
+        """
+        Return the TxnId of an identical call whose outcome is not yet
+        known, or None
+        """
+        with self._lock:
+            return self._get_entry(self._pending, key)
+
+    def set_pending(self, key, txn_id, timeout):
+        self._set_entry(self._pending, key, txn_id, timeout)
+
+    def _get_entry(self, entries, key):
+        entry = entries.get(key)
+        if entry is None:
+            return None
+        expires, value = entry
+        if expires <= time.time():
+            del entries[key]
+            return None
+        return value
+
+    def _set_entry(self, entries, key, value, ttl):
+        now = time.time()
+        with self._lock:
+            # Expired entries are dropped as new ones are added, so the dict
+            # only ever holds the last ``ttl`` seconds of entries
+            for stale in [k for k, (expires, _) in entries.items()
+                          if expires <= now]:
+                del entries[stale]
+            entries[key] = (now + ttl, value)
+
+    def _get_cache_keys(self, key):
+        name = ':'.join(u'%s' % part for part in key)
+        return ('%s:result:%s' % (CACHE_KEY_PREFIX, name),
+                '%s:lock:%s' % (CACHE_KEY_PREFIX, name))
+
+    def _run_shared(self, key, func, txn_id, timeout):
+        # The lock holds the leader's ``(txn_id, pending)``, so that calls
+        # waiting in other processes can be told which TxnId to look up
+        result_key, lock_key = self._get_cache_keys(key)
+        deadline = time.time() + timeout
+        while True:
+            result = self.cache.get(result_key)
+            if result is not None:
+                instrumentation.count('facade.coalesced', txn_type=key[3])
+                return result
+            if self.cache.add(lock_key, (txn_id, False), timeout):
+                break
+            holder = self.cache.get(lock_key)
+            if holder is not None and holder[1]:
+                raise CallPending(
+                    "An identical transaction's outcome is not yet known",
+                    holder[0])
+            if time.time() >= deadline:
+                raise CallPending(
+                    "An identical transaction is still being processed",
+                    holder[0] if holder is not None else None)
+            time.sleep(self.poll_interval)
+        try:
+            result = func()
+        except Exception as e:
+            if getattr(e, 'txn_id', None) is None:
+                self.cache.delete(lock_key)
+            else:
+                # It may yet have been processed, so no other process may
+                # send it again until it could have finished
+                self.cache.set(lock_key, (e.txn_id, True), timeout)
+            raise
+        if self.ttl > 0:
+            self.cache.set(result_key, result, self.ttl)
+        self.cache.delete(lock_key)
+        return result
+
+    def clear(self):
+        with self._lock:
+            self._results.clear()
+            self._pending.clear()
+
+
+_coalescer = None
+_coalescer_lock = threading.Lock()
+
+
+def get_coalescer():
+    """
+    Return the process-wide coalescer configured from settings, or None
+    when ``PAYMENTEXPRESS_COALESCE`` is off
+    """
+    global _coalescer
+    if not getattr(settings, 'PAYMENTEXPRESS_COALESCE', True):
+        return None
+    if _coalescer is None:
+        with _coalescer_lock:
+            if _coalescer is None:
+                alias = getattr(settings, 'PAYMENTEXPRESS_COALESCE_CACHE',
+                                None)
+                _coalescer = Coalescer(
+                    ttl=getattr(settings, 'PAYMENTEXPRESS_RESUBMIT_TTL',
+                                DEFAULT_RESUBMIT_TTL),
+                    cache=get_cache(alias) if alias else None)
+    return _coalescer
+
+
+def _reset_coalescer(sender, setting, **kwargs):
+    global _coalescer
+    if setting.startswith('PAYMENTEXPRESS_'):
+        _coalescer = None
+
+
+setting_changed.connect(_reset_coalescer)
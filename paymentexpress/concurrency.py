@@ -0,0 +1,30 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_MAX_WORKERS = 10
+
+
+def _collect(item, future):
+    try:
+        return item, future.result(), None
+    except Exception as e:
+        return item, None, e
+
+
+def bounded_map(func, iterable, max_workers=DEFAULT_MAX_WORKERS):
+    """
+    Call ``func`` on each item of ``iterable`` using a pool of worker threads,
+    yielding ``(item, result, error)`` tuples in input order.
+
+    Exceptions raised by ``func`` are returned as ``error`` rather than
+    raised.  The iterable is consumed lazily, with at most twice
+    ``max_workers`` items in flight at once.
+    """
+    with ThreadPoolExecutor(max_workers) as executor:
+        pending = deque()
+        for item in iterable:
+            pending.append((item, executor.submit(func, item)))
+            if len(pending) >= max_workers * 2:
+                yield _collect(*pending.popleft())
+        while pending:
+            yield _collect(*pending.popleft())
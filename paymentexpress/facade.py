@@ -1,12 +1,83 @@
 from django.conf import settings
+from django.db.models import Count
+from paymentexpress import instrumentation
+from paymentexpress.audit import get_audit_writer
+from paymentexpress.cards import InvalidCard
+from paymentexpress.coalescing import CallPending, get_coalescer
+from paymentexpress.concurrency import DEFAULT_MAX_WORKERS
 from paymentexpress.gateway import (
-    AUTH, COMPLETE, PURCHASE, REFUND, VALIDATE, Gateway
+    AUTH, COMPLETE, PURCHASE, REFUND, VALIDATE
 )
 from paymentexpress.models import OrderTransaction
+from paymentexpress.policy import GatewayUnavailable, is_connect_failure
+from paymentexpress.reference import (generate_merchant_reference,
+                                      generate_txn_id)
+from paymentexpress.refunds import BulkRefund, DEFAULT_CHUNK_SIZE
+from paymentexpress.registry import get_registry
+from paymentexpress.tokens import get_token_store
 
-from oscar.apps.payment.exceptions import (UnableToTakePayment,
+from oscar.apps.payment.exceptions import (PaymentError,
+                                           UnableToTakePayment,
                                            InvalidGatewayRequestError)
+from collections import namedtuple
+import functools
 import random
+import requests
+
+
+class BatchResult(namedtuple('BatchResult', ['order_number', 'amount',
+                                             'dps_txn_ref', 'result',
+                                             'error'])):
+    """
+    The outcome of one item of a batch call.  ``result`` holds the dict the
+    equivalent single call would have returned, or ``error`` the exception
+    it would have raised.
+    """
+
+    def is_successful(self):
+        return self.error is None
+
+
+class ReconcileResult(namedtuple('ReconcileResult', ['order_number',
+                                                     'txn_type', 'amount',
+                                                     'txn_id', 'result',
+                                                     'error'])):
+    """
+    The outcome of looking up one pending transaction
+    """
+
+    def is_successful(self):
+        return self.error is None
+
+
+class TransactionPending(PaymentError):
+    """
+    Raised when a transaction may or may not have been processed, because
+    its reply was lost and a status lookup could not settle it either.  Pass
+    ``txn_id`` to ``Facade.reconcile`` later to find out.
+    """
+
+    def __init__(self, message, txn_id):
+        super(TransactionPending, self).__init__(message)
+        self.txn_id = txn_id
+
+
+def _instrumented(txn_type):
+    """
+    Time a facade method as ``facade.call``, counting calls which fail
+    before a response is handled as errors
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with instrumentation.timed('facade.call', txn_type=txn_type):
+                try:
+                    return method(self, *args, **kwargs)
+                except (requests.RequestException, TransactionPending):
+                    instrumentation.record_error('facade', txn_type)
+                    raise
+        return wrapper
+    return decorator
 
 
 class Facade(object):
@@ -15,22 +86,60 @@ class Facade(object):
     """
 
     def __init__(self):
-        self.gateway = Gateway(
-            settings.PAYMENTEXPRESS_POST_URL,
-            settings.PAYMENTEXPRESS_USERNAME,
-            settings.PAYMENTEXPRESS_PASSWORD,
-            getattr(settings, 'PAYMENTEXPRESS_CURRENCY', 'AUD')
-        )
+        self.registry = get_registry()
+        self.gateway = self.registry.get_gateway()
+        self.coalescer = get_coalescer()
+        self.tokens = get_token_store()
+
+    def _get_gateway(self, account=None, currency=None):
+        """
+        Return the gateway for an account and currency, as configured in
+        ``PAYMENTEXPRESS_ACCOUNTS``
+        """
+        if account is None and currency is None:
+            return self.gateway
+        return self.registry.get_gateway(account, currency)
+
+    def _coalesce(self, txn_type, order_number, amount, account, currency,
+                  func, *args):
+        """
+        Return ``func(*args, txn_id=...)``, or the result of an identical
+        call already in flight or just made (see
+        ``paymentexpress.coalescing``).  An identical call that outlasts its
+        own transaction and status lookup leaves this one pending too.
+        """
+        if self.coalescer is None:
+            return func(*args, txn_id=generate_txn_id())
+        key = (account, currency, order_number, txn_type, u'%s' % amount)
+        txn_id = generate_txn_id()
+        policy = self._get_gateway(account, currency).policy
+        try:
+            return self.coalescer.run(
+                key, lambda: func(*args, txn_id=txn_id), txn_id=txn_id,
+                timeout=2 * policy.max_duration)
+        except CallPending as e:
+            raise self._pending(e.txn_id)
 
     def _check_amount(self, amount):
         if amount == 0 or amount is None:
             raise UnableToTakePayment("Order amount must be non-zero")
 
+    def _use_legacy_merchant_reference(self):
+        return getattr(settings, 'PAYMENTEXPRESS_LEGACY_MERCHANT_REFERENCE',
+                       False)
+
     def _get_merchant_reference(self, order_number, txn_type):
+        if not self._use_legacy_merchant_reference():
+            return generate_merchant_reference(order_number, txn_type)
+
         num_previous = OrderTransaction.objects.filter(
             order_number=order_number,
             txn_type=txn_type).count()
+        return self._format_merchant_reference(order_number, txn_type,
+                                               num_previous)
 
+    def _format_merchant_reference(self, order_number, txn_type,
+                                   num_previous):
         # Get a random number to append to the end.  This solves the problem
         # where a previous request crashed out and didn't save a model instance
         # Hence we can get a clash of merchant references.
@@ -43,9 +152,12 @@ class Facade(object):
         return ('The transaction was declined by your bank - ' +
             'please check your bankcard details and try again')
 
-    def _handle_response(self, txn_type, order_number, amount, response):
-
-        OrderTransaction.objects.create(
+    def _build_transaction(self, txn_type, order_number, amount, response,
+                           **columns):
+        fields = OrderTransaction.response_columns(response)
+        fields['columns_filled'] = True
+        fields.update(columns)
+        return OrderTransaction(
             order_number=order_number,
             txn_type=txn_type,
             txn_ref=response['dps_txn_ref'],
@@ -53,9 +165,11 @@ class Facade(object):
             response_code=response['response_code'],
             response_message=response.get_message(),
             request_xml=response.request_xml,
-            response_xml=response.response_xml
+            response_xml=response.response_xml,
+            **fields
             )
 
+    def _get_result(self, response):
         if response.is_successful():
             return {
                 'txn_reference': response['dps_txn_ref'],
@@ -68,88 +182,298 @@ class Facade(object):
         else:
             raise InvalidGatewayRequestError(response.get_message())
 
+    def _record_transaction(self, txn):
+        if getattr(settings, 'PAYMENTEXPRESS_DEFERRED_AUDIT', False):
+            get_audit_writer().submit(txn)
+        else:
+            txn.save()
+
+    def _is_ambiguous(self, response):
+        return response.is_empty() or response['status_required'] == 1
+
+    def _send(self, gateway, gateway_method, txn_id=None, **kwargs):
+        """
+        Call a gateway method under ``txn_id``, or a new TxnId, and return
+        its settled response
+        """
+        if txn_id is None:
+            txn_id = generate_txn_id()
+        try:
+            response = gateway_method(txn_id=txn_id, **kwargs)
+        except InvalidCard as e:
+            # Rejected before anything was sent
+            raise UnableToTakePayment(str(e))
+        except requests.RequestException as e:
+            response = e
+        return self._settle(gateway, txn_id, response)
+
+    def _settle(self, gateway, txn_id, response):
+        """
+        Return the response to a transaction sent under ``txn_id``, given the
+        gateway's reply or the error it raised.  If the outcome is unknown
+        (the reply was lost, or PX POST asks for a status check) it is looked
+        up by TxnId rather than the transaction being sent again.
+        """
+        if isinstance(response, Exception):
+            # Nothing reached PX POST if the connection was never made
+            if not isinstance(response, requests.RequestException) \
+                    or isinstance(response, GatewayUnavailable) \
+                    or is_connect_failure(response):
+                raise response
+        elif not self._is_ambiguous(response):
+            return response
+        return self._resolve(gateway, txn_id)
+
+    def _resolve(self, gateway, txn_id):
+        try:
+            response = gateway.status(txn_id=txn_id)
+        except requests.RequestException:
+            response = None
+        if response is None or self._is_ambiguous(response):
+            raise self._pending(txn_id)
+        return response
+
+    def _pending(self, txn_id):
+        return TransactionPending(
+            "The outcome of transaction %s is not yet known" % txn_id, txn_id)
+
+    def _handle_response(self, txn_type, order_number, amount, response,
+                         **columns):
+        with instrumentation.timed('facade.persist', txn_type=txn_type):
+            self._record_transaction(self._build_transaction(
+                txn_type, order_number, amount, response, **columns))
+        instrumentation.count_outcome('facade', txn_type, response)
+        return self._get_result(response)
+
     def _format_card_date(self, str_date):
         # Dirty hack so that Oscar's BankcardForm doesn't need to be overridden
         if str_date is None:
             return None
         return str_date.replace('/', '')
 
-    def authorise(self, order_number, amount, bankcard):
+    def _get_card_kwargs(self, bankcard, **kwargs):
+        """
+        Return the gateway arguments describing a bankcard, merged with any
+        extra arguments given
+        """
+        kwargs.update({
+            'card_holder': bankcard.card_holder_name,
+            'card_number': bankcard.card_number,
+            'card_issue_date': self._format_card_date(bankcard.start_date),
+            'card_expiry': self._format_card_date(bankcard.expiry_date),
+            'cvc2': bankcard.cvv,
+        })
+        return kwargs
+
+    @_instrumented(AUTH)
+    def authorise(self, order_number, amount, bankcard, account=None,
+                  currency=None):
         """
         Authorizes a transaction.
         Must be completed within 7 days using the "Complete" TxnType
         """
         self._check_amount(amount)
+        return self._coalesce(AUTH, order_number, amount, account, currency,
+                              self._authorise, order_number, amount,
+                              bankcard, account, currency)
 
-        card_issue_date = self._format_card_date(bankcard.start_date)
-        card_expiry_date = self._format_card_date(bankcard.expiry_date)
-
+    def _authorise(self, order_number, amount, bankcard, account, currency,
+                   txn_id=None):
+        gateway = self._get_gateway(account, currency)
         merchant_ref = self._get_merchant_reference(order_number, AUTH)
-        res = self.gateway.authorise(card_holder=bankcard.card_holder_name,
-                                     card_number=bankcard.card_number,
-                                     card_issue_date=card_issue_date,
-                                     card_expiry=card_expiry_date,
-                                     cvc2=bankcard.cvv,
-                                     amount=amount,
-                                     merchant_ref=merchant_ref)
-        return self._handle_response(AUTH, order_number, amount, res)
+        res = self._send(gateway, gateway.authorise, txn_id=txn_id,
+                         **self._get_card_kwargs(bankcard, amount=amount,
+                                                 merchant_ref=merchant_ref))
+        return self._handle_response(AUTH, order_number, amount, res,
+                                     txn_id=txn_id)
 
-    def complete(self, order_number, amount, dps_txn_ref):
+    @_instrumented(COMPLETE)
+    def complete(self, order_number, amount, dps_txn_ref, account=None,
+                 currency=None):
         """
         Completes (settles) a pre-approved Auth Transaction.
         The DpsTxnRef value returned by the original approved Auth transaction
         must be supplied.
         """
         self._check_amount(amount)
+        gateway = self._get_gateway(account, currency)
         merchant_ref = self._get_merchant_reference(order_number, COMPLETE)
-        res = self.gateway.complete(amount=amount,
-                                    dps_txn_ref=dps_txn_ref,
-                                    merchant_ref=merchant_ref)
-        return self._handle_response(COMPLETE, order_number, amount, res)
+        txn_id = generate_txn_id()
+        res = self._send(gateway, gateway.complete,
+                         txn_id=txn_id,
+                         amount=amount,
+                         dps_txn_ref=dps_txn_ref,
+                         merchant_ref=merchant_ref)
+        return self._handle_response(COMPLETE, order_number, amount, res,
+                                     txn_id=txn_id)
 
-    def purchase(self, order_number, amount, billing_id=None, bankcard=None):
+    def complete_many(self, batch, max_workers=None, account=None,
+                      currency=None):
+        """
+        Completes (settles) many pre-approved Auth Transactions.
+        Takes an iterable of (order_number, amount, dps_txn_ref) tuples and
+        sends them through a bounded pool of concurrent gateway calls.  All
+        transactions are recorded with a single bulk insert, and a list of
+        ``BatchResult`` instances is returned in place of raising on the
+        first failure.
+        """
+        if max_workers is None:
+            max_workers = getattr(settings,
+                                  'PAYMENTEXPRESS_BATCH_CONCURRENCY',
+                                  DEFAULT_MAX_WORKERS)
+        gateway = self._get_gateway(account, currency)
+        batch = list(batch)
+        legacy_reference = self._use_legacy_merchant_reference()
+        if legacy_reference:
+            num_previous = dict(
+                OrderTransaction.objects.filter(
+                    order_number__in=set(item[0] for item in batch),
+                    txn_type=COMPLETE)
+                .values_list('order_number')
+                .annotate(Count('id'))
+                .order_by())
+
+        outcomes = [None] * len(batch)
+        calls, call_indexes = [], []
+        for index, (order_number, amount, dps_txn_ref) in enumerate(batch):
+            try:
+                self._check_amount(amount)
+            except UnableToTakePayment as e:
+                outcomes[index] = BatchResult(order_number, amount,
+                                              dps_txn_ref, None, e)
+                continue
+            if legacy_reference:
+                # Orders repeated within the batch still need distinct
+                # references, so count them off as they are used
+                previous = num_previous.get(order_number, 0)
+                num_previous[order_number] = previous + 1
+                merchant_ref = self._format_merchant_reference(
+                    order_number, COMPLETE, previous)
+            else:
+                merchant_ref = generate_merchant_reference(order_number,
+                                                           COMPLETE)
+            calls.append({
+                'amount': amount,
+                'dps_txn_ref': dps_txn_ref,
+                'merchant_ref': merchant_ref,
+                'txn_id': generate_txn_id(),
+            })
+            call_indexes.append(index)
+
+        txns = []
+        responses = gateway.complete_batch(calls, max_workers)
+        for index, call, response in zip(call_indexes, calls, responses):
+            order_number, amount, dps_txn_ref = batch[index]
+            result, error = None, None
+            try:
+                response = self._settle(gateway, call['txn_id'], response)
+            except Exception as e:
+                error = e
+            else:
+                txn = self._build_transaction(COMPLETE, order_number,
+                                              amount, response,
+                                              txn_id=call['txn_id'])
+                txns.append(txn)
+                try:
+                    result = self._get_result(response)
+                except (UnableToTakePayment,
+                        InvalidGatewayRequestError) as e:
+                    error = e
+            outcomes[index] = BatchResult(order_number, amount, dps_txn_ref,
+                                          result, error)
+
+        with instrumentation.timed('facade.persist', txn_type=COMPLETE):
+            OrderTransaction.objects.record_many(txns)
+        return outcomes
+
+    @_instrumented(PURCHASE)
+    def purchase(self, order_number, amount, billing_id=None, bankcard=None,
+                 account=None, currency=None, user=None):
         """
         Purchase - Funds are transferred immediately.
+        If a ``user`` is given with a bankcard, a card they have stored
+        before is charged by its billing id, and a new card is stored.
         """
         self._check_amount(amount)
+        if not (billing_id or bankcard):
+            raise ValueError("You must specify either a billing id or " +
+                "a merchant reference")
+        store_card = False
+        if user is not None and bankcard is not None and not billing_id:
+            billing_id = self.get_billing_id(user, bankcard, account)
+            store_card = billing_id is None
+        result = self._coalesce(PURCHASE, order_number, amount, account,
+                                currency, self._purchase, order_number,
+                                amount, billing_id, bankcard, account,
+                                currency)
+        if store_card and result['partner_reference']:
+            self.save_billing_id(user, bankcard, result['partner_reference'],
+                                 account)
+        return result
 
-        res = None
+    def _purchase(self, order_number, amount, billing_id, bankcard, account,
+                  currency, txn_id=None):
+        gateway = self._get_gateway(account, currency)
         merchant_ref = self._get_merchant_reference(order_number, PURCHASE)
 
         if billing_id:
-            res = self.gateway.purchase(amount=amount,
-                                        dps_billing_id=billing_id,
-                                        merchant_ref=merchant_ref)
-        elif bankcard:
-            card_issue_date = self._format_card_date(bankcard.start_date)
-            card_expiry_date = self._format_card_date(bankcard.expiry_date)
-            res = self.gateway.purchase(amount=amount,
-                                        card_holder=bankcard.card_holder_name,
-                                        card_number=bankcard.card_number,
-                                        card_issue_date=card_issue_date,
-                                        card_expiry=card_expiry_date,
-                                        cvc2=bankcard.cvv,
-                                        merchant_ref=merchant_ref,
-                                        enable_add_bill_card=1)
+            res = self._send(gateway, gateway.purchase,
+                             txn_id=txn_id,
+                             amount=amount,
+                             dps_billing_id=billing_id,
+                             merchant_ref=merchant_ref)
         else:
-            raise ValueError("You must specify either a billing id or " +
-                "a merchant reference")
+            res = self._send(gateway, gateway.purchase,
+                             txn_id=txn_id,
+                             **self._get_card_kwargs(
+                                 bankcard, amount=amount,
+                                 merchant_ref=merchant_ref,
+                                 enable_add_bill_card=1))
 
-        return self._handle_response(PURCHASE, order_number, amount, res)
+        return self._handle_response(PURCHASE, order_number, amount, res,
+                                     txn_id=txn_id)
 
-    def refund(self, order_number, amount, dps_txn_ref):
+    @_instrumented(REFUND)
+    def refund(self, order_number, amount, dps_txn_ref, account=None,
+               currency=None):
         """
         Refund - Funds transferred immediately.
         Must be enabled as a special option.
         """
         self._check_amount(amount)
+        gateway = self._get_gateway(account, currency)
         merchant_ref = self._get_merchant_reference(order_number, REFUND)
-        res = self.gateway.refund(amount=amount,
-                                  dps_txn_ref=dps_txn_ref,
-                                  merchant_ref=merchant_ref)
-        return self._handle_response(REFUND, order_number, amount, res)
+        txn_id = generate_txn_id()
+        res = self._send(gateway, gateway.refund,
+                         txn_id=txn_id,
+                         amount=amount,
+                         dps_txn_ref=dps_txn_ref,
+                         merchant_ref=merchant_ref)
+        return self._handle_response(REFUND, order_number, amount, res,
+                                     txn_id=txn_id)
+
+    def refund_many(self, rows, max_workers=None, rate=None, resume=True,
+                    account=None, currency=None,
+                    chunk_size=DEFAULT_CHUNK_SIZE, batch=u''):
+        """
+        Refunds a stream of ``(line, [order_number, amount, dps_txn_ref])``
+        rows, as read by ``paymentexpress.refunds.read_rows``, yielding a
+        ``RefundResult`` for each as it completes.  At most ``rate`` refunds
+        are sent per second.  Rows of ``batch`` already refunded are skipped,
+        and those left pending are looked up, checking ``chunk_size`` rows at
+        a time, unless ``resume`` is False.
+        """
+        if max_workers is None:
+            max_workers = getattr(settings,
+                                  'PAYMENTEXPRESS_BATCH_CONCURRENCY',
+                                  DEFAULT_MAX_WORKERS)
+        return BulkRefund(self, max_workers=max_workers, rate=rate,
+                          chunk_size=chunk_size, resume=resume,
+                          account=account, currency=currency,
+                          batch=batch).run(rows)
 
-    def validate(self, bankcard):
+    @_instrumented(VALIDATE)
+    def validate(self, bankcard, account=None, currency=None):
         """
         Validation Transaction.
         Effects a $1.00 Auth to validate card details including expiry date.
@@ -157,14 +481,99 @@ class Facade(object):
         automatically add to Billing Database if the transaction is approved.
         """
         amount = 1.00
-        card_issue_date = self._format_card_date(bankcard.start_date)
-        card_expiry_date = self._format_card_date(bankcard.expiry_date)
-
-        res = self.gateway.validate(amount=amount,
-                                    card_holder=bankcard.card_holder_name,
-                                    card_number=bankcard.card_number,
-                                    card_issue_date=card_issue_date,
-                                    card_expiry=card_expiry_date,
-                                    cvc2=bankcard.cvv,
-                                    enable_add_bill_card=1)
-        return self._handle_response(VALIDATE, None, amount, res)
+        gateway = self._get_gateway(account, currency)
+        txn_id = generate_txn_id()
+        res = self._send(gateway, gateway.validate, txn_id=txn_id,
+                         **self._get_card_kwargs(bankcard, amount=amount,
+                                                 enable_add_bill_card=1))
+        return self._handle_response(VALIDATE, None, amount, res,
+                                     txn_id=txn_id)
+
+    def _get_account_name(self, account):
+        if account is None:
+            return self.registry.default_account
+        return account
+
+    def get_billing_id(self, user, bankcard, account=None):
+        """
+        Returns the billing id of a card the user has stored with the
+        account, or None.  Looked up by the card's fingerprint, usually
+        without a database query.
+        """
+        return self.tokens.get_billing_id(
+            user, self._get_account_name(account), bankcard.card_number,
+            self._format_card_date(bankcard.expiry_date))
+
+    def save_billing_id(self, user, bankcard, billing_id, account=None):
+        """
+        Stores the billing id of one of the user's cards
+        """
+        self.tokens.save(user, self._get_account_name(account),
+                         bankcard.card_number,
+                         self._format_card_date(bankcard.expiry_date),
+                         billing_id)
+
+    def tokenise(self, user, bankcard, account=None, currency=None):
+        """
+        Returns the billing id of the user's card.  A card which has not
+        been stored before is added to the billing database by a $1.00
+        validation, and stored.  Returns None if PX POST gave no billing id
+        for it.
+        """
+        billing_id = self.get_billing_id(user, bankcard, account)
+        if billing_id is None:
+            billing_id = self.validate(bankcard, account,
+                                       currency)['partner_reference']
+            if not billing_id:
+                return None
+            self.save_billing_id(user, bankcard, billing_id, account)
+        return billing_id
+
+    def status(self, txn_id, account=None, currency=None):
+        """
+        Status - looks up the outcome of a transaction by its TxnId, as
+        carried by ``TransactionPending``.  Returns or raises as the
+        original call would have.
+        """
+        response = self._resolve(self._get_gateway(account, currency),
+                                 txn_id)
+        return self._get_result(response)
+
+    def reconcile(self, pending, max_workers=None, account=None,
+                  currency=None):
+        """
+        Looks up many pending transactions concurrently.
+        Takes an iterable of (order_number, txn_type, amount, txn_id) tuples.
+        Each transaction whose outcome is now known is recorded, and a list
+        of ``ReconcileResult`` instances is returned in the same order; those
+        still unknown carry a ``TransactionPending`` error.
+        """
+        if max_workers is None:
+            max_workers = getattr(settings,
+                                  'PAYMENTEXPRESS_BATCH_CONCURRENCY',
+                                  DEFAULT_MAX_WORKERS)
+        pending = list(pending)
+        responses = self._get_gateway(account, currency).status_batch(
+            [item[3] for item in pending], max_workers)
+
+        txns, outcomes = [], []
+        for item, response in zip(pending, responses):
+            order_number, txn_type, amount, txn_id = item
+            result, error = None, None
+            if isinstance(response, Exception) or \
+                    self._is_ambiguous(response):
+                error = self._pending(txn_id)
+            else:
+                txns.append(self._build_transaction(txn_type, order_number,
+                                                    amount, response,
+                                                    txn_id=txn_id))
+                try:
+                    result = self._get_result(response)
+                except (UnableToTakePayment,
+                        InvalidGatewayRequestError) as e:
+                    error = e
+            outcomes.append(ReconcileResult(order_number, txn_type, amount,
+                                            txn_id, result, error))
+
+        OrderTransaction.objects.record_many(txns)
+        return outcomes
@@ -1,5 +1,11 @@
-from xml.dom.minidom import parseString, Document
-import requests
+from xml.parsers import expat
+from xml.sax.saxutils import escape
+from paymentexpress import instrumentation
+from paymentexpress.cards import check_card
+from paymentexpress.concurrency import bounded_map, DEFAULT_MAX_WORKERS
+from paymentexpress.masking import mask_xml
+from paymentexpress.policy import ServerError, get_policy
+from paymentexpress.transport import get_session
 import re
 
 # Methods
@@ -9,76 +15,173 @@ COMPLETE = 'Complete'
 PURCHASE = 'Purchase'
 REFUND = 'Refund'
 VALIDATE = 'Validate'
+STATUS = 'Status'
 
 UNABLE_TO_FULFILL_TRANSACTION = 'Unable to fulfill transaction'
 
 
+# PX POST request fields, in the order they are written to the Txn envelope
+FIELDS = (
+    # Required
+    ('username', 'PostUsername'),
+    ('password', 'PostPassword'),
+    ('amount', 'Amount'),
+    ('currency', 'InputCurrency'),
+    ('txn_type', 'TxnType'),
+
+    # Card details
+    ('card_holder', 'CardHolderName'),
+    ('card_number', 'CardNumber'),
+    ('cvc2', 'Cvc2'),
+    ('card_issue_date', 'DateStart'),
+    ('card_expiry', 'DateExpiry'),
+
+    ('billing_id', 'BillingId'),
+    ('dps_billing_id', 'DpsBillingId'),
+    ('dps_txn_ref', 'DpsTxnRef'),
+    ('enable_add_bill_card', 'EnableAddBillCard'),
+    ('merchant_ref', 'MerchantReference'),
+    ('txn_id', 'TxnId'),
+    ('txn_data1', 'TxnData1'),
+    ('txn_data2', 'TxnData2'),
+    ('txn_data3', 'TxnData3'),
+    ('enable_avs', 'EnableAvsData'),
+    ('avs_action', 'AvsAction'),
+    ('avs_postcode', 'AvsPostCode'),
+    ('avs_street_address', 'AvsStreetAddress'),
+    ('issue_number', 'IssueNumber'),
+    ('track2', 'Track2'),
+)
+
+XML_DECLARATION = u'<?xml version="1.0" ?>'
+
+# Pre-rendered (key, open tag, close tag, empty element) for each field
+_FIELD_TEMPLATES = tuple(
+    (key, u'<%s>' % tag, u'</%s>' % tag, u'<%s/>' % tag)
+    for key, tag in FIELDS
+)
+
+_XML_ENTITIES = {'"': '&quot;'}
+
+_FIELD_MAP = dict(FIELDS)
+
+# Keys every request carries
+BASE_REQUIRED_KEYS = frozenset([
+    'username', 'password', 'amount', 'currency', 'txn_type',
+])
+
+CURRENCY_PATTERN = re.compile(r'^[A-Z]{3}$')
+MMYY_PATTERN = re.compile(r'^(0[1-9]|1[012])([0-9]{2})$')
+
+
+def _check_currency(key, value):
+    if not CURRENCY_PATTERN.match(value):
+        raise ValueError('Currency code must be a 3 character code')
+
+
+def _check_amount(key, value):
+    if value == 0:
+        raise ValueError('Amount must be non-zero')
+
+
+def _check_mmyy(key, value):
+    if value is not None and not MMYY_PATTERN.match(value):
+        raise ValueError('%s must be in format mmyy' % key)
+
+
+# Validators for the keys which have them.  Other keys are passed through.
+_VALIDATORS = (
+    ('currency', _check_currency),
+    ('amount', _check_amount),
+    ('card_issue_date', _check_mmyy),
+    ('card_expiry', _check_mmyy),
+)
+
+
+def check_fields(kwargs, required_keys):
+    """
+    Raise ``ValueError`` if any of ``required_keys`` is missing from
+    ``kwargs`` or a value is malformed
+    """
+    for key in required_keys:
+        if key not in kwargs:
+            raise ValueError('You must provide a "%s" argument' % key)
+    for key, validate in _VALIDATORS:
+        if key in kwargs:
+            validate(key, kwargs[key])
+
+
 class Request(object):
     """
     Represents a PaymentExpress request
     """
+    __slots__ = ('data', 'required_keys', 'spec', '_xml', '_bytes')
+
+    field_map = _FIELD_MAP
+
     def __init__(self, username, password, currency, txn_type, amount):
-        self.data = {}
-        self.required_keys = [
-            'username',
-            'password',
-            'amount',
-            'currency',
-            'txn_type',
-            'amount',
-        ]
-
-        self.field_map = {
-
-            # Required
-            'username': 'PostUsername',
-            'password': 'PostPassword',
-            'amount': 'Amount',
-            'currency': 'InputCurrency',
-            'txn_type': 'TxnType',
-
-            # Card details
-            'card_holder': 'CardHolderName',
-            'card_number': 'CardNumber',
-            'cvc2': 'Cvc2',
-            'card_issue_date': 'DateStart',
-            'card_expiry': 'DateExpiry',
-
-            'billing_id': 'BillingId',
-            'dps_billing_id': 'DpsBillingId',
-            'dps_txn_ref': 'DpsTxnRef',
-            'enable_add_bill_card': 'EnableAddBillCard',
-            'merchant_ref': 'MerchantReference',
-            'txn_data1': 'TxnData1',
-            'txn_data2': 'TxnData2',
-            'txn_data3': 'TxnData3',
-            'enable_avs': 'EnableAvsData',
-            'avs_action': 'AvsAction',
-            'avs_postcode': 'AvsPostCode',
-            'avs_street_address': 'AvsStreetAddress',
-            'issue_number': 'IssueNumber',
-            'track2': 'Track2',
+        self.data = {
+            'username': username,
+            'password': password,
+            'currency': currency,
+            'txn_type': txn_type,
+            'amount': amount,
         }
+        self.required_keys = BASE_REQUIRED_KEYS
+        self.spec = None
+        self._xml = None
+        self._bytes = None
 
-        self.set_auth(username, password)
-        self.set_element('currency', currency)
-        self.set_element('txn_type', txn_type)
-        self.set_element('amount', amount)
+    @classmethod
+    def from_spec(cls, spec, data):
+        """
+        Wrap ``data`` already built and checked by ``spec``
+        """
+        request = cls.__new__(cls)
+        request.data = data
+        request.required_keys = spec.request_keys
+        request.spec = spec
+        request._xml = None
+        request._bytes = None
+        return request
 
     @property
     def request_xml(self):
         """
-        Return the string value of the request object
+        Return the string value of the request object.  The XML is written
+        once and reused until an element is changed with ``set_element``.
         """
-        doc = Document()
-        root = doc.createElement('Txn')
-        doc.appendChild(root)
+        if self._xml is None:
+            self._xml = self._serialize()
+        return self._xml
 
-        for key, value in self.data.items():
-            field = self.field_map.get(key)
-            self._create_element(doc, root, field, value)
+    @property
+    def request_bytes(self):
+        """
+        The request XML encoded as UTF-8, as it is sent
+        """
+        if self._bytes is None:
+            self._bytes = self.request_xml.encode('utf-8')
+        return self._bytes
 
-        return doc.toxml()
+    def _serialize(self):
+        """
+        Write the Txn envelope straight from the data dict, in field order
+        """
+        data = self.data
+        parts = [XML_DECLARATION, u'<Txn>']
+        for key, open_tag, close_tag, empty_tag in _FIELD_TEMPLATES:
+            if key not in data:
+                continue
+            value = data[key]
+            if value:
+                parts.append(open_tag)
+                parts.append(escape(u'%s' % (value,), _XML_ENTITIES))
+                parts.append(close_tag)
+            else:
+                parts.append(empty_tag)
+        parts.append(u'</Txn>')
+        return u''.join(parts)
 
     def set_auth(self, username, password):
         self.set_element('username', username)
@@ -86,19 +189,13 @@ class Request(object):
 
     def set_element(self, name, value):
         self.data[name] = value
+        self._xml = self._bytes = None
 
-    def _create_element(self, doc, parent, tag, value=None, attributes=None):
-        """
-        Creates an XML element
-        """
-        ele = doc.createElement(tag)
-        parent.appendChild(ele)
-        if value:
-            text = doc.createTextNode(str(value))
-            ele.appendChild(text)
-        if attributes:
-            [ele.setAttribute(k, v) for k, v in attributes.items()]
-        return ele
+    def remove_element(self, name):
+        self.data.pop(name, None)
+        if name in self.required_keys:
+            self.required_keys = self.required_keys - frozenset([name])
+        self._xml = self._bytes = None
 
     def __unicode__(self):
         return self.request_xml
@@ -107,62 +204,274 @@ class Request(object):
         return self.__unicode__()
 
 
+class RequestSpec(object):
+    """
+    The fields of one kind of PX POST request, worked out once and shared
+    by every request of that kind.  Building a request then only checks the
+    arguments and copies their values.
+    """
+    __slots__ = ('txn_type', 'required_keys', 'request_keys', 'keys',
+                 'has_currency')
+
+    def __init__(self, txn_type, required_keys, has_amount=True,
+                 has_currency=True):
+        required_keys = set(required_keys)
+        if has_amount:
+            required_keys.add('amount')
+        self.txn_type = txn_type
+        # Arguments which must be passed in
+        self.required_keys = frozenset(required_keys)
+        # Elements the request must carry
+        self.request_keys = self.required_keys | frozenset(
+            key for key in BASE_REQUIRED_KEYS
+            if key != 'amount' and (has_currency or key != 'currency'))
+        # Arguments copied into the request, in field order
+        self.keys = tuple(key for key, _ in FIELDS
+                          if key in self.required_keys)
+        self.has_currency = has_currency
+
+    def build(self, username, password, currency, kwargs):
+        check_fields(kwargs, self.required_keys)
+        data = {
+            'username': username,
+            'password': password,
+            'txn_type': self.txn_type,
+        }
+        if self.has_currency:
+            _check_currency('currency', currency)
+            data['currency'] = currency
+        for key in self.keys:
+            data[key] = kwargs[key]
+        # A TxnId lets PX POST recognise a repeated request, so it is sent
+        # with any transaction type
+        if kwargs.get('txn_id'):
+            data['txn_id'] = kwargs['txn_id']
+        return Request.from_spec(self, data)
+
+
+# Response data keys read from the child elements of a PX POST reply
+RESPONSE_ELEMENTS = (
+    ('authorised', 'Authorized'),
+    ('auth_code', 'AuthCode'),
+    ('txn_ref', 'TxnRef'),
+    ('dps_txn_ref', 'DpsTxnRef'),
+    ('card_holder_help_text', 'CardHolderHelpText'),
+    ('card_holder_response_text', 'CardHolderResponseText'),
+    ('help_text', 'HelpText'),
+    ('dps_billing_id', 'DpsBillingId'),
+    ('card_name', 'CardName'),
+    ('card_number', 'CardNumber'),
+    ('merchant_reference', 'MerchantReference'),
+    ('rx_date', 'RxDate'),
+    ('amount_settled', 'Amount'),
+    ('retry', 'Retry'),
+    ('allow_retry', 'AllowRetry'),
+    ('status_required', 'StatusRequired'),
+)
+
+# Data keys read from 0/1 flag elements, with their value when absent
+_FLAG_DEFAULTS = {
+    'authorised': 0,
+    'retry': 0,
+    'allow_retry': None,
+    'status_required': 0,
+}
+
+_RESPONSE_ELEMENT_TAGS = frozenset(tag for _, tag in RESPONSE_ELEMENTS)
+
+_RESPONSE_DATA_KEYS = frozenset(
+    ['success', 'response_code', 'response_text'] +
+    [key for key, _ in RESPONSE_ELEMENTS])
+
+
+class _StopParsing(Exception):
+    pass
+
+
+def parse_response(response_xml, tags=None, encoding=None):
+    """
+    Parse a PX POST reply in a single pass, returning the attributes of the
+    ``Transaction`` element and a dict holding the text of the first
+    element found with each of the given tags ('' when absent or empty).
+
+    Parsing stops as soon as everything asked for has been seen.  When no
+    tags are given the text of every element in the reply is returned.
+    ``encoding`` overrides the encoding declared by a reply given as bytes.
+    """
+    if not isinstance(response_xml, bytes):
+        # Python 2's expat cannot take non-ASCII text, so it is always given
+        # UTF-8 bytes
+        response_xml = response_xml.encode('utf-8')
+        encoding = 'utf-8'
+    parser = expat.ParserCreate(encoding)
+    parser.buffer_text = True
+    attributes = {}
+    if tags is None:
+        texts = {}
+        wanted = None
+    else:
+        texts = dict.fromkeys(tags, u'')
+        wanted = set(tags)
+    # Tag currently collecting text and its text so far.  As with minidom's
+    # firstChild, only the text before any nested element is kept.
+    state = {'tag': None, 'text': []}
+    seen_transaction = []
+
+    def finish_text():
+        texts[state['tag']] = u''.join(state['text'])
+        state['tag'] = None
+        state['text'] = []
+
+    def start_element(name, attrs):
+        if state['tag'] is not None:
+            finish_text()
+        if name == 'Transaction' and not seen_transaction:
+            attributes.update(attrs)
+            seen_transaction.append(True)
+        if wanted is None:
+            if name not in texts:
+                texts[name] = u''
+                state['tag'] = name
+        elif name in wanted:
+            wanted.discard(name)
+            state['tag'] = name
+
+    def end_element(name):
+        if state['tag'] is not None:
+            finish_text()
+        if not wanted and wanted is not None and seen_transaction:
+            raise _StopParsing()
+
+    def character_data(data):
+        if state['tag'] is not None:
+            state['text'].append(data)
+
+    parser.StartElementHandler = start_element
+    parser.EndElementHandler = end_element
+    parser.CharacterDataHandler = character_data
+    try:
+        parser.Parse(response_xml, True)
+    except _StopParsing:
+        pass
+    return attributes, texts
+
+
+_DECLARED_ENCODING = re.compile(
+    br'^\s*<\?xml[^>]*encoding=["\']([A-Za-z0-9._-]+)["\']')
+
+_EMPTY_REPLIES = frozenset([
+    u'', u'<?xml version="1.0" ?>', b'', b'<?xml version="1.0" ?>',
+])
+
+
+def decode_xml(content):
+    """
+    Return a reply's raw bytes as text, decoded with the encoding its XML
+    declaration names (UTF-8 if none).  Bytes which are not valid in that
+    encoding are taken to be Latin-1.
+    """
+    if not isinstance(content, bytes):
+        return content
+    match = _DECLARED_ENCODING.match(content)
+    encoding = match.group(1).decode('ascii') if match else 'utf-8'
+    try:
+        return content.decode(encoding)
+    except (UnicodeDecodeError, LookupError):
+        return content.decode('latin-1')
+
+
+# Placeholder for fields which have not been parsed yet
+_UNPARSED = object()
+
+
 class Response(object):
     """
-    Encapsulate a PaymentExpress response
+    Encapsulate a PaymentExpress response.
+
+    Nothing is parsed until a field is first asked for.  The mapped fields
+    in ``data`` are then read in a single early-stopping pass, while any
+    other element of the reply (``response['RxDate']``,
+    ``response['CardName']``...) triggers one full pass on first use.
+
+    The reply may be given as the raw bytes received, which are parsed as
+    they are and only decoded to text if ``response_xml`` is asked for.
     """
+    __slots__ = ('request_xml', 'response_content', '_response_xml', '_data',
+                 '_elements')
 
     def __init__(self, request_xml, response_xml):
         self.request_xml = request_xml
-        self.response_xml = response_xml
-        self.data = self._extract_data(response_xml)
+        self.response_content = response_xml
+        self._response_xml = None
+        self._data = _UNPARSED
+        self._elements = _UNPARSED
+
+    @property
+    def response_xml(self):
+        """
+        The reply as text
+        """
+        if self._response_xml is None:
+            self._response_xml = decode_xml(self.response_content)
+        return self._response_xml
+
+    @property
+    def data(self):
+        if self._data is _UNPARSED:
+            self._data = self._extract_data(self.response_content)
+        return self._data
+
+    @property
+    def elements(self):
+        """
+        Dict of the text of every element in the reply, keyed by tag
+        """
+        if self._elements is _UNPARSED:
+            if self.is_empty():
+                self._elements = {}
+            else:
+                _, self._elements = self._parse(self.response_content)
+        return self._elements
+
+    def is_empty(self):
+        """
+        Whether PX POST sent back nothing that could be parsed
+        """
+        return self._is_empty(self.response_content)
+
+    def _is_empty(self, response_xml):
+        return response_xml is None or response_xml in _EMPTY_REPLIES
+
+    def _parse(self, response_xml, tags=None):
+        try:
+            return parse_response(response_xml, tags)
+        except (expat.ExpatError, LookupError):
+            # Undeclared bytes in an encoding other than UTF-8, or an
+            # encoding expat does not know.  The reply is parsed again as
+            # decoded by ``response_xml``, re-encoded as UTF-8.
+            if not isinstance(response_xml, bytes):
+                raise
+            return parse_response(self.response_xml.encode('utf-8'), tags,
+                                  'utf-8')
 
     def _extract_data(self, response_xml):
-        if response_xml == '' \
-            or response_xml == '<?xml version="1.0" ?>' \
-            or response_xml is None:
+        if self._is_empty(response_xml):
             return None
 
-        doc = parseString(response_xml)
-        success = self._get_transaction_attribute(doc, 'success')
-        authorised = self._get_element_text(doc, 'Authorized')
+        attributes, texts = self._parse(response_xml, _RESPONSE_ELEMENT_TAGS)
+        success = attributes.get('success')
         data = {
             'success': int(success) if success else 0,
-            'response_code': self._get_transaction_attribute(doc, 'reco'),
-            'response_text': self._get_transaction_attribute(doc,
-                'responseText'),
-            'authorised': int(authorised) if authorised else 0,
-            'auth_code': self._get_element_text(doc, 'AuthCode'),
-            'txn_ref': self._get_element_text(doc, 'TxnRef'),
-            'dps_txn_ref': self._get_element_text(doc, 'DpsTxnRef'),
-            'card_holder_help_text': self._get_element_text(doc,
-                'CardHolderHelpText'),
-            'card_holder_response_text': self._get_element_text(doc,
-                'CardHolderResponseText'),
-            'help_text': self._get_element_text(doc, 'HelpText'),
-            'dps_billing_id': self._get_element_text(doc, 'DpsBillingId'),
+            'response_code': attributes.get('reco', ''),
+            'response_text': attributes.get('responseText', ''),
         }
+        for key, tag in RESPONSE_ELEMENTS:
+            text = texts[tag]
+            if key in _FLAG_DEFAULTS:
+                text = int(text) if text else _FLAG_DEFAULTS[key]
+            data[key] = text
         return data
 
-    def _try_get_element(self, doc, tag):
-        try:
-            ele = doc.getElementsByTagName(tag)[0]
-        except IndexError:
-            return None
-        return ele
-
-    def _get_transaction_attribute(self, doc, attr):
-        ele = self._try_get_element(doc, 'Transaction')
-        if ele is None or ele.attributes is None:
-            return ''
-        return ele.attributes.get(attr).value
-
-    def _get_element_text(self, doc, tag):
-        ele = self._try_get_element(doc, tag)
-        if ele is None or ele.firstChild is None:
-            return ''
-        return ele.firstChild.data
-
     def get_message(self):
         if self.data is None:
             return UNABLE_TO_FULFILL_TRANSACTION
@@ -172,7 +481,15 @@ class Response(object):
         return message
 
     def __getitem__(self, key):
-        return self.data[key]
+        if key in _RESPONSE_DATA_KEYS:
+            return self.data[key]
+        return self.elements[key]
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except (KeyError, TypeError):
+            return default
 
     def is_successful(self):
         if self.data is None:
@@ -191,63 +508,109 @@ class Gateway(object):
     """
     Transport class used to send PaymentExpress requests
     """
-
-    def __init__(self, post_url, username, password, currency):
+    authorise_spec = RequestSpec(AUTH, [
+        'card_holder', 'card_number', 'cvc2',
+    ])
+    complete_spec = RequestSpec(COMPLETE, ['dps_txn_ref'])
+    purchase_spec = RequestSpec(PURCHASE, [
+        'card_holder', 'card_number', 'card_expiry', 'cvc2',
+        'merchant_ref', 'enable_add_bill_card',
+    ])
+    billing_purchase_spec = RequestSpec(PURCHASE, ['dps_billing_id'])
+    validate_spec = RequestSpec(AUTH, [
+        'card_holder', 'card_number', 'cvc2', 'card_expiry',
+        'enable_add_bill_card',
+    ])
+    refund_spec = RequestSpec(REFUND, ['dps_txn_ref', 'merchant_ref'])
+    status_spec = RequestSpec(STATUS, ['txn_id'], has_amount=False,
+                              has_currency=False)
+
+    # Whether card details are checked locally before they are sent, and
+    # the card types accepted (all known types when None)
+    preflight = True
+    card_types = None
+
+    def __init__(self, post_url, username, password, currency, session=None,
+                 policy=None, limiter=None, preflight=True, card_types=None):
         self.post_url = post_url
         self.username = username
         self.password = password
         self.currency = currency
+        # Gateways share a pooled keep-alive session and a retry policy (and
+        # so its circuit breakers) unless given their own
+        self.session = session or get_session()
+        self.policy = policy or get_policy()
+        # An optional ``paymentexpress.ratelimit.RateLimiter``
+        self.limiter = limiter
+        self.preflight = preflight
+        self.card_types = card_types
 
     def _fetch_response(self, request):
         """
         Sends the request
         """
-        self._check_kwargs(request.data, request.required_keys)
-        response = requests.post(
-            self.post_url,
-            request.request_xml,
-            auth=(self.username, self.password)
-        )
-        return Response(request.request_xml, response.text)
+        # Requests built from a spec were checked as they were built
+        if request.spec is None:
+            self._check_kwargs(request.data, request.required_keys)
+        txn_type = request.data.get('txn_type')
+        with instrumentation.timed('gateway.build', txn_type=txn_type):
+            request_bytes = request.request_bytes
+            # Only the masked request is kept once it has been sent
+            masked_xml = mask_xml(request.request_xml)
+
+        def send(timeout):
+            # Every attempt, retries included, counts against the limit
+            if self.limiter is not None:
+                with instrumentation.timed('gateway.rate_limit',
+                                           txn_type=txn_type):
+                    self.limiter.acquire(txn_type)
+            with instrumentation.timed('gateway.network', txn_type=txn_type):
+                response = self.session.post(
+                    self.post_url,
+                    request_bytes,
+                    auth=(self.username, self.password),
+                    timeout=timeout
+                )
+            if response.status_code >= 500:
+                raise ServerError("PX POST replied with HTTP %d"
+                                  % response.status_code)
+            # The raw bytes are parsed directly, which skips the charset
+            # detection requests runs for ``text`` without a charset header
+            return Response(masked_xml, response.content)
+
+        try:
+            response = self.policy.execute(self.post_url, request, send)
+        except Exception:
+            instrumentation.record_error('gateway', txn_type)
+            raise
+        instrumentation.record_response(txn_type, response)
+        return response
 
     def _check_kwargs(self, kwargs, required_keys):
-        for key in required_keys:
-            if key not in kwargs:
-                raise ValueError('You must provide a "%s" argument' % key)
-
-        for key in kwargs:
-            value = kwargs[key]
-            if key == 'currency' and not re.match(r'^[A-Z]{3}$', value):
-                raise ValueError('Currency code must be a 3 character code')
-            if key == 'amount' and value == 0:
-                raise ValueError('Amount must be non-zero')
-            if key in ('card_issue_date', 'card_expiry') \
-                and value is not None \
-                and not re.match(r'^(0[1-9]|1[012])([0-9]{2})$', value):
-                raise ValueError('%s must be in format mmyy' % key)
+        check_fields(kwargs, required_keys)
+
+    def _build_request(self, spec, kwargs):
+        request = spec.build(self.username, self.password, self.currency,
+                             kwargs)
+        if self.preflight and 'card_number' in spec.required_keys:
+            check_card(kwargs['card_number'], kwargs.get('card_expiry'),
+                       kwargs.get('cvc2'), self.card_types)
+        return request
 
     def _get_request(self, txn_type, kwargs, required_keys):
-        if 'amount' not in required_keys:
-            required_keys.append('amount')
-
-        self._check_kwargs(kwargs, required_keys)
-        request = Request(self.username,
-                       self.password,
-                       self.currency,
-                       txn_type,
-                       kwargs.get('amount'))
-        for key in required_keys:
-            request.set_element(key, kwargs.get(key))
-        return request
+        """
+        Build a request needing ``required_keys`` (and always ``amount``)
+        from ``kwargs``.  The transaction methods use the prebuilt specs.
+        """
+        return self._build_request(RequestSpec(txn_type, required_keys),
+                                   kwargs)
 
     def authorise(self, **kwargs):
         """
         Authorizes a transaction.
         Must be completed within 7 days using the "Complete" TxnType
         """
-        request = self._get_request(AUTH, kwargs, [
-            'card_holder', 'card_number', 'cvc2', 'amount',
-        ])
+        request = self._build_request(self.authorise_spec, kwargs)
         return self._fetch_response(request)
 
     def complete(self, **kwargs):
@@ -256,9 +619,25 @@ class Gateway(object):
         The DpsTxnRef value returned by the original approved Auth transaction
         must be supplied.
         """
-        request = self._get_request(COMPLETE, kwargs, ['dps_txn_ref', ])
+        request = self._build_request(self.complete_spec, kwargs)
         return self._fetch_response(request)
 
+    def complete_batch(self, batch, max_workers=DEFAULT_MAX_WORKERS):
+        """
+        Completes many pre-approved Auth Transactions concurrently.
+        Takes an iterable of keyword argument dicts, as accepted by
+        ``complete``, and returns a list holding either the ``Response`` or
+        the exception raised for each one, in the same order.
+        """
+        return self._call_batch(self.complete, batch, max_workers)
+
+    def _call_batch(self, method, batch, max_workers):
+        results = []
+        for kwargs, response, error in bounded_map(
+                lambda kwargs: method(**kwargs), batch, max_workers):
+            results.append(error if error is not None else response)
+        return results
+
     def purchase(self, **kwargs):
         """
         Purchase - Funds are transferred immediately.
@@ -268,14 +647,11 @@ class Gateway(object):
         return self._purchase_on_existing_card(**kwargs)
 
     def _purchase_on_new_card(self, **kwargs):
-        request = self._get_request(PURCHASE, kwargs, [
-            'card_holder', 'card_number', 'card_expiry', 'cvc2',
-            'merchant_ref', 'enable_add_bill_card',
-        ])
+        request = self._build_request(self.purchase_spec, kwargs)
         return self._fetch_response(request)
 
     def _purchase_on_existing_card(self, **kwargs):
-        request = self._get_request(PURCHASE, kwargs, ['dps_billing_id'])
+        request = self._build_request(self.billing_purchase_spec, kwargs)
         return self._fetch_response(request)
 
     def validate(self, **kwargs):
@@ -285,9 +661,7 @@ class Gateway(object):
         Often utilised with the EnableAddBillCard property set to 1 to
         automatically add to Billing Database if the transaction is approved.
         """
-        request = self._get_request(AUTH, kwargs, [
-            'card_holder', 'card_number', 'cvc2', 'card_expiry',
-        ])
+        request = self._build_request(self.validate_spec, kwargs)
         return self._fetch_response(request)
 
     def refund(self, **kwargs):
@@ -295,7 +669,26 @@ class Gateway(object):
         Refund - Funds transferred immediately.
         Must be enabled as a special option.
         """
-        request = self._get_request(REFUND, kwargs, [
-            'dps_txn_ref', 'merchant_ref',
-        ])
+        request = self._build_request(self.refund_spec, kwargs)
         return self._fetch_response(request)
+
+    def status(self, **kwargs):
+        """
+        Status - looks up the outcome of an earlier transaction by the TxnId
+        it was sent with, without repeating it.  PX POST echoes the TxnId
+        back as TxnRef, so ``txn_ref`` is accepted in its place.
+        """
+        if 'txn_id' not in kwargs and 'txn_ref' in kwargs:
+            kwargs['txn_id'] = kwargs.pop('txn_ref')
+        request = self._build_request(self.status_spec, kwargs)
+        return self._fetch_response(request)
+
+    def status_batch(self, txn_ids, max_workers=DEFAULT_MAX_WORKERS):
+        """
+        Looks up many transactions concurrently.  Returns a list holding
+        either the ``Response`` or the exception raised for each TxnId, in
+        the same order.
+        """
+        return self._call_batch(self.status,
+                                ({'txn_id': txn_id} for txn_id in txn_ids),
+                                max_workers)
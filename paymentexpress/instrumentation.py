@@ -0,0 +1,193 @@
+"""
+Timings and outcome counters for gateway and facade calls.
+
+Nothing is measured until a sink is attached with ``add_sink``.  A sink is
+any object with ``timing(name, seconds, tags)`` and ``increment(name,
+tags)`` methods; ``SignalSink``, ``StatsdSink`` and ``CallbackSink`` are
+provided.  The metrics are:
+
+* ``gateway.build`` - writing the request XML
+* ``gateway.rate_limit`` - waiting for the account's rate limiter
+* ``gateway.network`` - each round-trip to PX POST, including retries
+* ``gateway.parse`` - parsing the reply
+* ``facade.persist`` - recording the ``OrderTransaction``
+* ``facade.call`` - the whole facade call
+* ``gateway.response`` and ``facade.response`` - counters of approved,
+  declined and error outcomes
+* ``facade.coalesced`` - counter of calls answered by an identical call
+  (see ``paymentexpress.coalescing``)
+* ``tokens.lookup`` - counter of stored card lookups, tagged with the
+  ``source`` (``cache`` or ``database``) that answered them
+
+each tagged with ``txn_type`` and, for counters, ``outcome`` and
+``response_code``.
+"""
+import time
+
+from django.dispatch import Signal
+
+try:
+    _clock = time.perf_counter
+except AttributeError:
+    _clock = time.time
+
+APPROVED = 'approved'
+DECLINED = 'declined'
+ERROR = 'error'
+
+# Sent by ``SignalSink`` with ``name``, ``value`` and ``tags`` arguments
+timing_recorded = Signal()
+count_recorded = Signal()
+
+_sinks = []
+
+
+def add_sink(sink):
+    if sink not in _sinks:
+        _sinks.append(sink)
+
+
+def remove_sink(sink):
+    if sink in _sinks:
+        _sinks.remove(sink)
+
+
+def is_enabled():
+    return bool(_sinks)
+
+
+class _Timer(object):
+    __slots__ = ('name', 'tags', 'start')
+
+    def __init__(self, name, tags):
+        self.name = name
+        self.tags = tags
+
+    def __enter__(self):
+        self.start = _clock()
+        return self
+
+    def __exit__(self, *args):
+        elapsed = _clock() - self.start
+        for sink in _sinks:
+            sink.timing(self.name, elapsed, self.tags)
+
+
+class _NullTimer(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+_NULL_TIMER = _NullTimer()
+
+
+def timed(name, **tags):
+    """
+    Return a context manager timing its block, or a shared no-op one when
+    no sinks are attached
+    """
+    if not _sinks:
+        return _NULL_TIMER
+    return _Timer(name, tags)
+
+
+def count(name, **tags):
+    for sink in _sinks:
+        sink.increment(name, tags)
+
+
+def get_outcome(response):
+    if response.is_successful():
+        return APPROVED
+    if response.is_declined():
+        return DECLINED
+    return ERROR
+
+
+def record_response(txn_type, response):
+    """
+    Parse a gateway response under the ``gateway.parse`` timer and count its
+    outcome.  Responses stay unparsed when no sinks are attached.
+    """
+    if not _sinks:
+        return
+    with _Timer('gateway.parse', {'txn_type': txn_type}):
+        response.data
+    count_outcome('gateway', txn_type, response)
+
+
+def count_outcome(layer, txn_type, response):
+    if _sinks:
+        count('%s.response' % layer, txn_type=txn_type,
+              outcome=get_outcome(response),
+              response_code=response.get('response_code', ''))
+
+
+def record_error(layer, txn_type):
+    """
+    Count a call which failed without a usable response
+    """
+    if _sinks:
+        count('%s.response' % layer, txn_type=txn_type, outcome=ERROR,
+              response_code='')
+
+
+class SignalSink(object):
+    """
+    Sends the ``timing_recorded`` and ``count_recorded`` Django signals
+    """
+
+    def timing(self, name, seconds, tags):
+        timing_recorded.send(sender=self.__class__, name=name, value=seconds,
+                             tags=tags)
+
+    def increment(self, name, tags):
+        count_recorded.send(sender=self.__class__, name=name, value=1,
+                            tags=tags)
+
+
+class StatsdSink(object):
+    """
+    Reports to a statsd-style client, such as ``statsd.StatsClient``, with
+    ``timing(stat, milliseconds)`` and ``incr(stat)`` methods.  Tags are
+    appended to the stat name, eg
+    ``paymentexpress.gateway.response.Purchase.declined.05``.
+    """
+    TAG_ORDER = ('txn_type', 'outcome', 'response_code')
+
+    def __init__(self, client, prefix='paymentexpress'):
+        self.client = client
+        self.prefix = prefix
+
+    def get_stat(self, name, tags):
+        parts = [self.prefix, name]
+        for key in self.TAG_ORDER:
+            if tags.get(key):
+                parts.append(str(tags[key]))
+        return '.'.join(parts)
+
+    def timing(self, name, seconds, tags):
+        self.client.timing(self.get_stat(name, tags), seconds * 1000)
+
+    def increment(self, name, tags):
+        self.client.incr(self.get_stat(name, tags))
+
+
+class CallbackSink(object):
+    """
+    Calls ``callback(kind, name, value, tags)``, where ``kind`` is
+    ``'timing'`` (with ``value`` in seconds) or ``'count'``
+    """
+
+    def __init__(self, callback):
+        self.callback = callback
+
+    def timing(self, name, seconds, tags):
+        self.callback('timing', name, seconds, tags)
+
+    def increment(self, name, tags):
+        self.callback('count', name, 1, tags)
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+OPTION_TYPES = {'string': str, 'int': int, 'float': float}
+
+
+class OptionListCommand(BaseCommand):
+    """
+    A command whose options are declared in ``option_list``, as older
+    versions of Django expect
+    """
+    option_list = getattr(BaseCommand, 'option_list', ())
+
+    def add_arguments(self, parser):
+        # Newer versions of Django build the parser with argparse and no
+        # longer read option_list
+        parser.add_argument('args', nargs='*')
+        for option in self.option_list:
+            kwargs = {'dest': option.dest, 'default': option.default,
+                      'help': option.help}
+            if option.action == 'store':
+                kwargs['type'] = OPTION_TYPES[option.type]
+            else:
+                kwargs['action'] = option.action
+            parser.add_argument(*option._long_opts, **kwargs)
@@ -0,0 +1,53 @@
+import sys
+import time
+from optparse import make_option
+
+from django.core.management.base import CommandError
+
+from paymentexpress.backfill import backfill, DEFAULT_CHUNK_SIZE
+from paymentexpress.management.commands import OptionListCommand
+
+
+class Command(OptionListCommand):
+    help = ("Parses the stored reply XML of transactions recorded before "
+            "their auth code, card, merchant reference, RxDate and settled "
+            "amount were kept as columns, and fills those columns in.  "
+            "Rows already filled in are skipped, so the command can be "
+            "interrupted and run again.")
+
+    option_list = OptionListCommand.option_list + (
+        make_option('--chunk-size', dest='chunk_size', type='int',
+                    default=DEFAULT_CHUNK_SIZE,
+                    help="Primary keys read and updated at a time"),
+        make_option('--processes', dest='processes', type='int', default=1,
+                    help="Number of worker processes parsing chunks"),
+        make_option('--all', action='store_true', dest='refill',
+                    default=False,
+                    help="Parse every transaction again, not just those "
+                         "not yet filled in"),
+    )
+
+    def handle(self, *args, **options):
+        if args:
+            raise CommandError("This command takes no arguments")
+        self.stderr = getattr(self, 'stderr', sys.stderr)
+        chunk_size = options.get('chunk_size') or DEFAULT_CHUNK_SIZE
+        processes = options.get('processes') or 1
+        if chunk_size < 1 or processes < 1:
+            raise CommandError("--chunk-size and --processes must be "
+                               "positive")
+        read = updated = 0
+        start = time.time()
+        for chunk_read, chunk_updated in backfill(
+                chunk_size, processes, options.get('refill', False)):
+            read += chunk_read
+            updated += chunk_updated
+            if chunk_read:
+                self.write_progress(read, updated, start)
+        if not read:
+            self.write_progress(read, updated, start)
+
+    def write_progress(self, read, updated, start):
+        elapsed = time.time() - start
+        self.stderr.write("%d rows in %.1fs (%.1f/s): %d updated\n" % (
+            read, elapsed, read / elapsed if elapsed else 0, updated))
@@ -0,0 +1,95 @@
+import sys
+import time
+from optparse import make_option
+
+from django.core.management.base import CommandError
+
+from paymentexpress.facade import Facade
+from paymentexpress.management.commands import OptionListCommand
+from paymentexpress.refunds import (open_csv, read_rows, write_results,
+                                    DEFAULT_CHUNK_SIZE, REFUNDED, DECLINED,
+                                    FAILED, INVALID, SKIPPED, PENDING)
+
+STATUSES = (REFUNDED, SKIPPED, DECLINED, PENDING, FAILED, INVALID)
+
+
+class Command(OptionListCommand):
+    args = '<input.csv>'
+    help = ("Refunds each order_number,amount,dps_txn_ref row of a CSV file "
+            "('-' for stdin).  Rows already refunded are skipped, and rows "
+            "left pending looked up, so an interrupted run can be restarted "
+            "with the same rows.")
+
+    option_list = OptionListCommand.option_list + (
+        make_option('--output', dest='output', default='-',
+                    help="CSV file to write results to as they complete "
+                         "(default stdout)"),
+        make_option('--workers', dest='workers', type='int', default=None,
+                    help="Number of refunds sent at once"),
+        make_option('--rate', dest='rate', type='float', default=None,
+                    help="Maximum refunds sent per second"),
+        make_option('--chunk-size', dest='chunk_size', type='int',
+                    default=DEFAULT_CHUNK_SIZE,
+                    help="Rows checked against recorded refunds at a time"),
+        make_option('--account', dest='account', default=None,
+                    help="PaymentExpress account to refund through"),
+        make_option('--currency', dest='currency', default=None,
+                    help="Currency to refund in"),
+        make_option('--batch', dest='batch', default='',
+                    help="Name telling this run's rows from identical rows "
+                         "refunded by other runs"),
+        make_option('--no-resume', action='store_false', dest='resume',
+                    default=True,
+                    help="Refund rows even if already refunded"),
+        make_option('--progress-every', dest='progress_every', type='int',
+                    default=100,
+                    help="Rows between progress reports on stderr"),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("Usage: %s" % self.args)
+        stdout = getattr(self, 'stdout', sys.stdout)
+        self.stderr = getattr(self, 'stderr', sys.stderr)
+
+        input_file = sys.stdin if args[0] == '-' else open_csv(args[0])
+        output = options.get('output') or '-'
+        output_file = stdout if output == '-' else open_csv(output, 'w')
+        try:
+            facade = Facade()
+            results = facade.refund_many(
+                read_rows(input_file),
+                max_workers=options.get('workers'),
+                rate=options.get('rate'),
+                resume=options.get('resume', True),
+                account=options.get('account'),
+                currency=options.get('currency'),
+                chunk_size=options.get('chunk_size') or DEFAULT_CHUNK_SIZE,
+                batch=options.get('batch') or '')
+            self.report(write_results(results, output_file),
+                        options.get('progress_every') or 100)
+        finally:
+            if input_file is not sys.stdin:
+                input_file.close()
+            if output_file is not stdout:
+                output_file.close()
+
+    def report(self, results, every):
+        counts = dict.fromkeys(STATUSES, 0)
+        total = 0
+        start = time.time()
+        for result in results:
+            counts[result.status] += 1
+            total += 1
+            if total % every == 0:
+                self.write_progress(total, counts, start)
+        if total % every or not total:
+            self.write_progress(total, counts, start)
+        return counts
+
+    def write_progress(self, total, counts, start):
+        elapsed = time.time() - start
+        self.stderr.write("%d rows in %.1fs (%.1f/s): %s\n" % (
+            total, elapsed, total / elapsed if elapsed else 0,
+            ', '.join('%d %s' % (counts[status], status)
+                      for status in STATUSES)))
@@ -0,0 +1,38 @@
+import re
+
+# Replacement text for each sensitive request element.  Card numbers keep
+# their last four digits.
+MASKED_ELEMENTS = {
+    'CardNumber': None,
+    'Cvc2': 'XXX',
+    'PostPassword': 'XXX',
+    'Track2': 'XXX',
+    'DateExpiry': 'XXXX',
+}
+
+_MASK_REGEX = re.compile(r'<(%s)>([^<]*)</\1>' % '|'.join(MASKED_ELEMENTS))
+
+
+def _mask_card_number(number):
+    number = number.strip()
+    return 'X' * (len(number) - 4) + number[-4:]
+
+
+def _mask_element(match):
+    tag, value = match.group(1), match.group(2)
+    replacement = MASKED_ELEMENTS[tag]
+    if replacement is None:
+        replacement = _mask_card_number(value)
+    return '<%s>%s</%s>' % (tag, replacement, tag)
+
+
+def mask_xml(xml):
+    """
+    Mask the card number, CVC, password, track data and expiry date
+    elements of a PX POST request in a single pass.  Only the contents of
+    those elements are changed; everything else is left untouched, and
+    masking already-masked XML changes nothing.
+    """
+    if not xml:
+        return xml
+    return _MASK_REGEX.sub(_mask_element, xml)
@@ -0,0 +1,73 @@
+# encoding: utf-8
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        
+        # Adding model 'OrderTransactionXml'
+        db.create_table('paymentexpress_ordertransactionxml', (
+            ('key', self.gf('django.db.models.fields.CharField')(max_length=32, primary_key=True)),
+            ('request_xml', self.gf('django.db.models.fields.TextField')()),
+            ('response_xml', self.gf('django.db.models.fields.TextField')()),
+        ))
+        db.send_create_signal('paymentexpress', ['OrderTransactionXml'])
+
+        # Adding field 'OrderTransaction.xml'
+        db.add_column('paymentexpress_ordertransaction', 'xml', self.gf('django.db.models.fields.related.ForeignKey')(to=orm['paymentexpress.OrderTransactionXml'], null=True, on_delete=models.SET_NULL, blank=True), keep_default=False)
+
+        # Adding index on 'OrderTransaction', fields ['txn_ref']
+        db.create_index('paymentexpress_ordertransaction', ['txn_ref'])
+
+        # Adding index on 'OrderTransaction', fields ['date_created']
+        db.create_index('paymentexpress_ordertransaction', ['date_created'])
+
+        # Adding index on 'OrderTransaction', fields ['order_number', 'txn_type']
+        db.create_index('paymentexpress_ordertransaction', ['order_number', 'txn_type'])
+
+
+    def backwards(self, orm):
+        
+        # Removing index on 'OrderTransaction', fields ['order_number', 'txn_type']
+        db.delete_index('paymentexpress_ordertransaction', ['order_number', 'txn_type'])
+
+        # Removing index on 'OrderTransaction', fields ['date_created']
+        db.delete_index('paymentexpress_ordertransaction', ['date_created'])
+
+        # Removing index on 'OrderTransaction', fields ['txn_ref']
+        db.delete_index('paymentexpress_ordertransaction', ['txn_ref'])
+
+        # Deleting field 'OrderTransaction.xml'
+        db.delete_column('paymentexpress_ordertransaction', 'xml_id')
+
+        # Deleting model 'OrderTransactionXml'
+        db.delete_table('paymentexpress_ordertransactionxml')
+
+
+    models = {
+        'paymentexpress.ordertransaction': {
+            'Meta': {'ordering': "('-date_created',)", 'object_name': 'OrderTransaction'},
+            'amount': ('django.db.models.fields.DecimalField', [], {'null': 'True', 'max_digits': '12', 'decimal_places': '2', 'blank': 'True'}),
+            'date_created': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'db_index': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'order_number': ('django.db.models.fields.CharField', [], {'max_length': '128', 'null': 'True', 'db_index': 'True'}),
+            'request_xml': ('django.db.models.fields.TextField', [], {}),
+            'response_code': ('django.db.models.fields.CharField', [], {'max_length': '2'}),
+            'response_message': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'response_xml': ('django.db.models.fields.TextField', [], {}),
+            'txn_ref': ('django.db.models.fields.CharField', [], {'max_length': '16', 'db_index': 'True'}),
+            'txn_type': ('django.db.models.fields.CharField', [], {'max_length': '12'}),
+            'xml': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['paymentexpress.OrderTransactionXml']", 'null': 'True', 'on_delete': 'models.SET_NULL', 'blank': 'True'})
+        },
+        'paymentexpress.ordertransactionxml': {
+            'Meta': {'object_name': 'OrderTransactionXml'},
+            'key': ('django.db.models.fields.CharField', [], {'max_length': '32', 'primary_key': 'True'}),
+            'request_xml': ('django.db.models.fields.TextField', [], {}),
+            'response_xml': ('django.db.models.fields.TextField', [], {})
+        }
+    }
+
+    complete_apps = ['paymentexpress']
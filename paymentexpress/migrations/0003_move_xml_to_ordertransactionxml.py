@@ -0,0 +1,60 @@
+# encoding: utf-8
+import datetime
+import uuid
+from south.db import db
+from south.v2 import DataMigration
+from django.db import models
+
+CHUNK_SIZE = 500
+
+
+class Migration(DataMigration):
+
+    def forwards(self, orm):
+        "Copy the XML of existing transactions into OrderTransactionXml"
+        Txn = orm['paymentexpress.OrderTransaction']
+        Xml = orm['paymentexpress.OrderTransactionXml']
+        while True:
+            txns = list(Txn.objects.filter(xml__isnull=True)
+                        .order_by('pk')[:CHUNK_SIZE])
+            if not txns:
+                break
+            for txn in txns:
+                xml = Xml.objects.create(key=uuid.uuid4().hex,
+                                         request_xml=txn.request_xml,
+                                         response_xml=txn.response_xml)
+                Txn.objects.filter(pk=txn.pk).update(xml=xml)
+
+    def backwards(self, orm):
+        "Copy the XML back onto each transaction"
+        Txn = orm['paymentexpress.OrderTransaction']
+        for txn in Txn.objects.filter(xml__isnull=False).select_related('xml').iterator():
+            Txn.objects.filter(pk=txn.pk).update(
+                request_xml=txn.xml.request_xml,
+                response_xml=txn.xml.response_xml)
+
+
+    models = {
+        'paymentexpress.ordertransaction': {
+            'Meta': {'ordering': "('-date_created',)", 'object_name': 'OrderTransaction'},
+            'amount': ('django.db.models.fields.DecimalField', [], {'null': 'True', 'max_digits': '12', 'decimal_places': '2', 'blank': 'True'}),
+            'date_created': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'db_index': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'order_number': ('django.db.models.fields.CharField', [], {'max_length': '128', 'null': 'True', 'db_index': 'True'}),
+            'request_xml': ('django.db.models.fields.TextField', [], {}),
+            'response_code': ('django.db.models.fields.CharField', [], {'max_length': '2'}),
+            'response_message': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'response_xml': ('django.db.models.fields.TextField', [], {}),
+            'txn_ref': ('django.db.models.fields.CharField', [], {'max_length': '16', 'db_index': 'True'}),
+            'txn_type': ('django.db.models.fields.CharField', [], {'max_length': '12'}),
+            'xml': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['paymentexpress.OrderTransactionXml']", 'null': 'True', 'on_delete': 'models.SET_NULL', 'blank': 'True'})
+        },
+        'paymentexpress.ordertransactionxml': {
+            'Meta': {'object_name': 'OrderTransactionXml'},
+            'key': ('django.db.models.fields.CharField', [], {'max_length': '32', 'primary_key': 'True'}),
+            'request_xml': ('django.db.models.fields.TextField', [], {}),
+            'response_xml': ('django.db.models.fields.TextField', [], {})
+        }
+    }
+
+    complete_apps = ['paymentexpress']
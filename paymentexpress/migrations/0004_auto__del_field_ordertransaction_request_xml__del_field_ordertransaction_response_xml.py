@@ -0,0 +1,48 @@
+# encoding: utf-8
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        
+        # Deleting field 'OrderTransaction.request_xml'
+        db.delete_column('paymentexpress_ordertransaction', 'request_xml')
+
+        # Deleting field 'OrderTransaction.response_xml'
+        db.delete_column('paymentexpress_ordertransaction', 'response_xml')
+
+
+    def backwards(self, orm):
+        
+        # Adding field 'OrderTransaction.request_xml'
+        db.add_column('paymentexpress_ordertransaction', 'request_xml', self.gf('django.db.models.fields.TextField')(default=''), keep_default=False)
+
+        # Adding field 'OrderTransaction.response_xml'
+        db.add_column('paymentexpress_ordertransaction', 'response_xml', self.gf('django.db.models.fields.TextField')(default=''), keep_default=False)
+
+
+    models = {
+        'paymentexpress.ordertransaction': {
+            'Meta': {'ordering': "('-date_created',)", 'object_name': 'OrderTransaction'},
+            'amount': ('django.db.models.fields.DecimalField', [], {'null': 'True', 'max_digits': '12', 'decimal_places': '2', 'blank': 'True'}),
+            'date_created': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'db_index': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'order_number': ('django.db.models.fields.CharField', [], {'max_length': '128', 'null': 'True', 'db_index': 'True'}),
+            'response_code': ('django.db.models.fields.CharField', [], {'max_length': '2'}),
+            'response_message': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'txn_ref': ('django.db.models.fields.CharField', [], {'max_length': '16', 'db_index': 'True'}),
+            'txn_type': ('django.db.models.fields.CharField', [], {'max_length': '12'}),
+            'xml': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['paymentexpress.OrderTransactionXml']", 'null': 'True', 'on_delete': 'models.SET_NULL', 'blank': 'True'})
+        },
+        'paymentexpress.ordertransactionxml': {
+            'Meta': {'object_name': 'OrderTransactionXml'},
+            'key': ('django.db.models.fields.CharField', [], {'max_length': '32', 'primary_key': 'True'}),
+            'request_xml': ('django.db.models.fields.TextField', [], {}),
+            'response_xml': ('django.db.models.fields.TextField', [], {})
+        }
+    }
+
+    complete_apps = ['paymentexpress']
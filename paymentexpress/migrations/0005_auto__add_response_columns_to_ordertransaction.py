@@ -0,0 +1,85 @@
+# encoding: utf-8
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        
+        # Adding field 'OrderTransaction.auth_code'
+        db.add_column('paymentexpress_ordertransaction', 'auth_code', self.gf('django.db.models.fields.CharField')(default='', max_length=22, db_index=True, blank=True), keep_default=False)
+
+        # Adding field 'OrderTransaction.card_name'
+        db.add_column('paymentexpress_ordertransaction', 'card_name', self.gf('django.db.models.fields.CharField')(default='', max_length=16, db_index=True, blank=True), keep_default=False)
+
+        # Adding field 'OrderTransaction.card_number'
+        db.add_column('paymentexpress_ordertransaction', 'card_number', self.gf('django.db.models.fields.CharField')(default='', max_length=20, db_index=True, blank=True), keep_default=False)
+
+        # Adding field 'OrderTransaction.merchant_reference'
+        db.add_column('paymentexpress_ordertransaction', 'merchant_reference', self.gf('django.db.models.fields.CharField')(default='', max_length=64, db_index=True, blank=True), keep_default=False)
+
+        # Adding field 'OrderTransaction.dps_billing_id'
+        db.add_column('paymentexpress_ordertransaction', 'dps_billing_id', self.gf('django.db.models.fields.CharField')(default='', max_length=16, db_index=True, blank=True), keep_default=False)
+
+        # Adding field 'OrderTransaction.rx_date'
+        db.add_column('paymentexpress_ordertransaction', 'rx_date', self.gf('django.db.models.fields.DateTimeField')(null=True, db_index=True, blank=True), keep_default=False)
+
+        # Adding field 'OrderTransaction.amount_settled'
+        db.add_column('paymentexpress_ordertransaction', 'amount_settled', self.gf('django.db.models.fields.DecimalField')(null=True, max_digits=12, decimal_places=2, db_index=True, blank=True), keep_default=False)
+
+
+    def backwards(self, orm):
+        
+        # Deleting field 'OrderTransaction.auth_code'
+        db.delete_column('paymentexpress_ordertransaction', 'auth_code')
+
+        # Deleting field 'OrderTransaction.card_name'
+        db.delete_column('paymentexpress_ordertransaction', 'card_name')
+
+        # Deleting field 'OrderTransaction.card_number'
+        db.delete_column('paymentexpress_ordertransaction', 'card_number')
+
+        # Deleting field 'OrderTransaction.merchant_reference'
+        db.delete_column('paymentexpress_ordertransaction', 'merchant_reference')
+
+        # Deleting field 'OrderTransaction.dps_billing_id'
+        db.delete_column('paymentexpress_ordertransaction', 'dps_billing_id')
+
+        # Deleting field 'OrderTransaction.rx_date'
+        db.delete_column('paymentexpress_ordertransaction', 'rx_date')
+
+        # Deleting field 'OrderTransaction.amount_settled'
+        db.delete_column('paymentexpress_ordertransaction', 'amount_settled')
+
+
+    models = {
+        'paymentexpress.ordertransaction': {
+            'Meta': {'ordering': "('-date_created',)", 'object_name': 'OrderTransaction'},
+            'amount': ('django.db.models.fields.DecimalField', [], {'null': 'True', 'max_digits': '12', 'decimal_places': '2', 'blank': 'True'}),
+            'amount_settled': ('django.db.models.fields.DecimalField', [], {'null': 'True', 'max_digits': '12', 'decimal_places': '2', 'db_index': 'True', 'blank': 'True'}),
+            'auth_code': ('django.db.models.fields.CharField', [], {'max_length': '22', 'db_index': 'True', 'blank': 'True'}),
+            'card_name': ('django.db.models.fields.CharField', [], {'max_length': '16', 'db_index': 'True', 'blank': 'True'}),
+            'card_number': ('django.db.models.fields.CharField', [], {'max_length': '20', 'db_index': 'True', 'blank': 'True'}),
+            'date_created': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'db_index': 'True', 'blank': 'True'}),
+            'dps_billing_id': ('django.db.models.fields.CharField', [], {'max_length': '16', 'db_index': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'merchant_reference': ('django.db.models.fields.CharField', [], {'max_length': '64', 'db_index': 'True', 'blank': 'True'}),
+            'order_number': ('django.db.models.fields.CharField', [], {'max_length': '128', 'null': 'True', 'db_index': 'True'}),
+            'response_code': ('django.db.models.fields.CharField', [], {'max_length': '2'}),
+            'response_message': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'rx_date': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'db_index': 'True', 'blank': 'True'}),
+            'txn_ref': ('django.db.models.fields.CharField', [], {'max_length': '16', 'db_index': 'True'}),
+            'txn_type': ('django.db.models.fields.CharField', [], {'max_length': '12'}),
+            'xml': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['paymentexpress.OrderTransactionXml']", 'null': 'True', 'on_delete': 'models.SET_NULL', 'blank': 'True'})
+        },
+        'paymentexpress.ordertransactionxml': {
+            'Meta': {'object_name': 'OrderTransactionXml'},
+            'key': ('django.db.models.fields.CharField', [], {'max_length': '32', 'primary_key': 'True'}),
+            'request_xml': ('django.db.models.fields.TextField', [], {}),
+            'response_xml': ('django.db.models.fields.TextField', [], {})
+        }
+    }
+
+    complete_apps = ['paymentexpress']
@@ -0,0 +1,113 @@
+# encoding: utf-8
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+try:
+    from django.contrib.auth import get_user_model
+except ImportError:
+    from django.contrib.auth.models import User
+else:
+    User = get_user_model()
+
+user_orm_label = '%s.%s' % (User._meta.app_label, User._meta.object_name)
+user_model_label = '%s.%s' % (User._meta.app_label, User._meta.module_name)
+
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        
+        # Adding model 'BillingToken'
+        db.create_table('paymentexpress_billingtoken', (
+            ('id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('user', self.gf('django.db.models.fields.related.ForeignKey')(related_name='paymentexpress_billing_tokens', to=orm[user_orm_label])),
+            ('account', self.gf('django.db.models.fields.CharField')(max_length=64)),
+            ('fingerprint', self.gf('django.db.models.fields.CharField')(max_length=64)),
+            ('dps_billing_id', self.gf('django.db.models.fields.CharField')(max_length=16)),
+            ('card_type', self.gf('django.db.models.fields.CharField')(max_length=16)),
+            ('last_digits', self.gf('django.db.models.fields.CharField')(max_length=4)),
+            ('expiry', self.gf('django.db.models.fields.CharField')(max_length=4)),
+            ('date_created', self.gf('django.db.models.fields.DateTimeField')(auto_now_add=True, blank=True)),
+        ))
+        db.send_create_signal('paymentexpress', ['BillingToken'])
+
+        # Adding unique constraint on 'BillingToken', fields ['user', 'account', 'fingerprint']
+        db.create_unique('paymentexpress_billingtoken', ['user_id', 'account', 'fingerprint'])
+
+
+    def backwards(self, orm):
+        
+        # Removing unique constraint on 'BillingToken', fields ['user', 'account', 'fingerprint']
+        db.delete_unique('paymentexpress_billingtoken', ['user_id', 'account', 'fingerprint'])
+
+        # Deleting model 'BillingToken'
+        db.delete_table('paymentexpress_billingtoken')
+
+
+    models = {
+        'auth.group': {
+            'Meta': {'object_name': 'Group'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '80'}),
+            'permissions': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Permission']", 'symmetrical': 'False', 'blank': 'True'})
+        },
+        'auth.permission': {
+            'Meta': {'ordering': "('content_type__app_label', 'content_type__model', 'codename')", 'unique_together': "(('content_type', 'codename'),)", 'object_name': 'Permission'},
+            'codename': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['contenttypes.ContentType']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '50'})
+        },
+        user_model_label: {
+            'Meta': {'object_name': User.__name__, 'db_table': "'%s'" % User._meta.db_table},
+            User._meta.pk.attname: ('django.db.models.fields.AutoField', [], {'primary_key': 'True', 'db_column': "'%s'" % User._meta.pk.column}),
+        },
+        'contenttypes.contenttype': {
+            'Meta': {'ordering': "('name',)", 'unique_together': "(('app_label', 'model'),)", 'object_name': 'ContentType', 'db_table': "'django_content_type'"},
+            'app_label': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'model': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        },
+        'paymentexpress.billingtoken': {
+            'Meta': {'unique_together': "(('user', 'account', 'fingerprint'),)", 'object_name': 'BillingToken'},
+            'account': ('django.db.models.fields.CharField', [], {'max_length': '64'}),
+            'card_type': ('django.db.models.fields.CharField', [], {'max_length': '16'}),
+            'date_created': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            'dps_billing_id': ('django.db.models.fields.CharField', [], {'max_length': '16'}),
+            'expiry': ('django.db.models.fields.CharField', [], {'max_length': '4'}),
+            'fingerprint': ('django.db.models.fields.CharField', [], {'max_length': '64'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'last_digits': ('django.db.models.fields.CharField', [], {'max_length': '4'}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'paymentexpress_billing_tokens'", 'to': "orm['%s']" % user_orm_label})
+        },
+        'paymentexpress.ordertransaction': {
+            'Meta': {'ordering': "('-date_created',)", 'object_name': 'OrderTransaction'},
+            'amount': ('django.db.models.fields.DecimalField', [], {'null': 'True', 'max_digits': '12', 'decimal_places': '2', 'blank': 'True'}),
+            'amount_settled': ('django.db.models.fields.DecimalField', [], {'null': 'True', 'max_digits': '12', 'decimal_places': '2', 'db_index': 'True', 'blank': 'True'}),
+            'auth_code': ('django.db.models.fields.CharField', [], {'max_length': '22', 'db_index': 'True', 'blank': 'True'}),
+            'card_name': ('django.db.models.fields.CharField', [], {'max_length': '16', 'db_index': 'True', 'blank': 'True'}),
+            'card_number': ('django.db.models.fields.CharField', [], {'max_length': '20', 'db_index': 'True', 'blank': 'True'}),
+            'date_created': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'db_index': 'True', 'blank': 'True'}),
+            'dps_billing_id': ('django.db.models.fields.CharField', [], {'max_length': '16', 'db_index': 'True', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'merchant_reference': ('django.db.models.fields.CharField', [], {'max_length': '64', 'db_index': 'True', 'blank': 'True'}),
+            'order_number': ('django.db.models.fields.CharField', [], {'max_length': '128', 'null': 'True', 'db_index': 'True'}),
+            'response_code': ('django.db.models.fields.CharField', [], {'max_length': '2'}),
+            'response_message': ('django.db.models.fields.CharField', [], {'max_length': '255'}),
+            'rx_date': ('django.db.models.fields.DateTimeField', [], {'null': 'True', 'db_index': 'True', 'blank': 'True'}),
+            'txn_ref': ('django.db.models.fields.CharField', [], {'max_length': '16', 'db_index': 'True'}),
+            'txn_type': ('django.db.models.fields.CharField', [], {'max_length': '12'}),
+            'xml': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['paymentexpress.OrderTransactionXml']", 'null': 'True', 'on_delete': 'models.SET_NULL', 'blank': 'True'})
+        },
+        'paymentexpress.ordertransactionxml': {
+            'Meta': {'object_name': 'OrderTransactionXml'},
+            'key': ('django.db.models.fields.CharField', [], {'max_length': '32', 'primary_key': 'True'}),
+            'request_xml': ('django.db.models.fields.TextField', [], {}),
+            'response_xml': ('django.db.models.fields.TextField', [], {})
+        }
+    }
+
+    complete_apps = ['paymentexpress']
@@ -1,13 +1,93 @@
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+from django.conf import settings
 from django.db import models
+from paymentexpress.masking import mask_xml
 from xml.dom.minidom import parseString
 import re
+import uuid
+
+try:
+    from datetime import timezone as _timezone
+    utc = _timezone.utc
+except ImportError:
+    from django.utils.timezone import utc
 
 
 def pretty_print_xml(xml_string):
+    if not xml_string:
+        return ''
     line_regex = re.compile(r'\n\n')
     return line_regex.sub('', parseString(xml_string).toprettyxml())
 
 
+AUTH_USER_MODEL = getattr(settings, 'AUTH_USER_MODEL', 'auth.User')
+
+
+def store_xml():
+    return getattr(settings, 'PAYMENTEXPRESS_STORE_XML', True)
+
+
+# Columns copied from each reply's parsed data, which uses the same keys
+RESPONSE_COLUMNS = ('auth_code', 'card_name', 'card_number',
+                    'merchant_reference', 'dps_billing_id', 'rx_date',
+                    'amount_settled')
+
+
+def parse_rx_date(value):
+    """
+    Return PX POST's ``RxDate`` (UTC, as yyyymmddhhmmss) as a datetime, or
+    None if it is missing or malformed
+    """
+    try:
+        value = datetime.strptime(value, '%Y%m%d%H%M%S')
+    except (TypeError, ValueError):
+        return None
+    if getattr(settings, 'USE_TZ', False):
+        value = value.replace(tzinfo=utc)
+    return value
+
+
+def parse_amount(value):
+    try:
+        return Decimal(value).quantize(Decimal('0.01'))
+    except (TypeError, ValueError, InvalidOperation):
+        return None
+
+
+class OrderTransactionXml(models.Model):
+    """
+    The raw request and response XML of a transaction.  Kept out of the
+    ``OrderTransaction`` table so that scans of it stay narrow.
+    """
+    # Assigned before saving (rather than by the database) so that
+    # transactions and their XML can both be bulk inserted
+    key = models.CharField(max_length=32, primary_key=True)
+
+    request_xml = models.TextField()
+    response_xml = models.TextField()
+
+
+class OrderTransactionManager(models.Manager):
+
+    def record_many(self, txns):
+        """
+        Insert unsaved transactions, and their XML, with a bulk insert per
+        table.  Request XML is masked as on ``save``.
+        """
+        logs = []
+        for txn in txns:
+            txn.mask_request_xml()
+            if txn.xml_id is not None:
+                if store_xml():
+                    logs.append(txn.xml)
+                else:
+                    txn.xml = None
+        if logs:
+            OrderTransactionXml.objects.bulk_create(logs)
+        return self.bulk_create(txns)
+
+
 class OrderTransaction(models.Model):
 
     # Note we don't use a foreign key as the order hasn't been created
@@ -16,7 +96,9 @@ class OrderTransaction(models.Model):
 
     # Transaction type
     txn_type = models.CharField(max_length=12)
-    txn_ref = models.CharField(max_length=16)
+    txn_ref = models.CharField(max_length=16, db_index=True)
+    # The TxnId it was sent under, where known, to look its outcome up by
+    txn_id = models.CharField(max_length=16, blank=True, db_index=True)
     amount = models.DecimalField(decimal_places=2,
                                  max_digits=12,
                                  blank=True,
@@ -26,30 +108,102 @@ class OrderTransaction(models.Model):
     response_code = models.CharField(max_length=2)
     response_message = models.CharField(max_length=255)
 
-    # For debugging purposes
-    request_xml = models.TextField()
-    response_xml = models.TextField()
-
-    date_created = models.DateTimeField(auto_now_add=True)
+    # Parsed from the reply when the transaction is recorded, so that they
+    # can be searched without reading the XML
+    auth_code = models.CharField(max_length=22, blank=True, db_index=True)
+    card_name = models.CharField(max_length=16, blank=True, db_index=True)
+    card_number = models.CharField(max_length=20, blank=True,
+                                   db_index=True)
+    merchant_reference = models.CharField(max_length=64, blank=True,
+                                          db_index=True)
+    dps_billing_id = models.CharField(max_length=16, blank=True,
+                                      db_index=True)
+    rx_date = models.DateTimeField(null=True, blank=True, db_index=True)
+    amount_settled = models.DecimalField(decimal_places=2, max_digits=12,
+                                         blank=True, null=True,
+                                         db_index=True)
+    # Whether the columns above have been filled in from the reply, when it
+    # was recorded or by the backfill_response_columns command
+    columns_filled = models.BooleanField(default=False, db_index=True)
+
+    # For debugging purposes.  Not stored when PAYMENTEXPRESS_STORE_XML is
+    # False.
+    xml = models.ForeignKey(OrderTransactionXml, null=True, blank=True,
+                            on_delete=models.SET_NULL)
+
+    date_created = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    objects = OrderTransactionManager()
 
     class Meta:
+        # Migration 0002 also adds a composite index on
+        # (order_number, txn_type)
         ordering = ('-date_created',)
 
+    def _get_xml_record(self):
+        if self.xml_id is None:
+            self.xml = OrderTransactionXml(key=uuid.uuid4().hex,
+                                           request_xml='', response_xml='')
+        return self.xml
+
+    def _get_request_xml(self):
+        if self.xml_id is None:
+            return ''
+        return self.xml.request_xml
+
+    def _set_request_xml(self, value):
+        self._get_xml_record().request_xml = value
+
+    request_xml = property(_get_request_xml, _set_request_xml)
+
+    def _get_response_xml(self):
+        if self.xml_id is None:
+            return ''
+        return self.xml.response_xml
+
+    def _set_response_xml(self, value):
+        self._get_xml_record().response_xml = value
+
+    response_xml = property(_get_response_xml, _set_response_xml)
+
+    @classmethod
+    def response_columns(cls, response):
+        """
+        Return the values of ``RESPONSE_COLUMNS`` held in a gateway
+        ``Response``, blank if it could not be parsed
+        """
+        data = response.data
+        if data is None:
+            return {}
+        columns = {
+            'rx_date': parse_rx_date(data['rx_date']),
+            'amount_settled': parse_amount(data['amount_settled']),
+        }
+        for name in RESPONSE_COLUMNS:
+            if name not in columns:
+                max_length = cls._meta.get_field(name).max_length
+                columns[name] = data[name].strip()[:max_length]
+        return columns
+
     def save(self, *args, **kwargs):
         if not self.pk:
-            cc_regex = re.compile(r'\d{12}')
-            self.request_xml = cc_regex.sub('XXXXXXXXXXXX', self.request_xml)
-            ccv_regex = re.compile(r'<Cvc2>\d+</Cvc2>')
-
-            self.request_xml = ccv_regex.sub('<Cvc2>XXX</Cvc2>',
-                                             self.request_xml)
-
-            pw_regex = re.compile(r'<PostPassword>.*</PostPassword>')
-            self.request_xml = pw_regex.sub('<PostPassword>XXX</PostPassword>',
-                                            self.request_xml)
-
+            self.mask_request_xml()
+            if self.xml_id is not None:
+                if store_xml():
+                    self.xml.save(force_insert=True)
+                else:
+                    self.xml = None
         super(OrderTransaction, self).save(*args, **kwargs)
 
+    def mask_request_xml(self):
+        """
+        Mask card details and passwords in the request XML.  Called on first
+        save and by ``OrderTransaction.objects.record_many``.
+        """
+        if self.xml_id is None:
+            return
+        self.request_xml = mask_xml(self.request_xml)
+
     def __unicode__(self):
         return u'%s txn for order %s - ref: %s, message: %s' % (
             self.txn_type,
@@ -65,3 +219,31 @@ class OrderTransaction(models.Model):
     @property
     def pretty_response_xml(self):
         return pretty_print_xml(self.response_xml)
+
+
+class BillingToken(models.Model):
+    """
+    A customer's card held in an account's PX POST billing database, which
+    can be charged by its ``DpsBillingId``.  Cards are identified by their
+    fingerprint (see ``paymentexpress.cards``), never their number.
+    """
+    user = models.ForeignKey(AUTH_USER_MODEL,
+                             related_name='paymentexpress_billing_tokens',
+                             on_delete=models.CASCADE)
+    # Billing ids are only valid with the account that issued them
+    account = models.CharField(max_length=64)
+    fingerprint = models.CharField(max_length=64)
+    dps_billing_id = models.CharField(max_length=16)
+
+    card_type = models.CharField(max_length=16)
+    last_digits = models.CharField(max_length=4)
+    expiry = models.CharField(max_length=4)
+
+    date_created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = (('user', 'account', 'fingerprint'),)
+
+    def __unicode__(self):
+        return u'%s ending %s, expiring %s' % (
+            self.card_type, self.last_digits, self.expiry)
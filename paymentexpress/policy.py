@@ -0,0 +1,309 @@
+import errno
+import random
+import threading
+import time
+
+import requests
+from requests.exceptions import ConnectTimeout, ConnectionError, ReadTimeout
+
+try:
+    from requests.packages.urllib3.exceptions import NewConnectionError
+except ImportError:
+    from requests.packages.urllib3.exceptions import (
+        ConnectTimeoutError as NewConnectionError)
+
+try:
+    from aiohttp import ClientConnectorError
+except ImportError:
+    ClientConnectorError = None
+
+from paymentexpress.transport import ConnectFailed
+
+DEFAULT_CONNECT_TIMEOUT = 5
+DEFAULT_READ_TIMEOUT = 60
+DEFAULT_MAX_RETRIES = 2
+DEFAULT_RETRY_BACKOFF = 0.5
+DEFAULT_MAX_RETRY_BACKOFF = 8
+DEFAULT_FAILURE_THRESHOLD = 5
+DEFAULT_RESET_TIMEOUT = 30
+
+# Transaction types which only read PX POST's records, and so can safely be
+# sent again when their reply is lost
+READ_ONLY_TXN_TYPES = frozenset(['Status'])
+
+_policies = {}
+_policies_lock = threading.Lock()
+
+
+class GatewayUnavailable(ConnectionError):
+    """
+    Raised, without contacting PX POST, when a request cannot be sent now
+    """
+
+
+class CircuitOpenError(GatewayUnavailable):
+    """
+    Raised while the circuit breaker for PX POST's URL is open
+    """
+
+
+class ServerError(requests.HTTPError):
+    """
+    Raised when PX POST replies with a 5xx status instead of a transaction
+    """
+
+
+def is_connect_failure(error):
+    """
+    Whether a transport error happened before the request could have reached
+    PX POST, in which case it is always safe to send it again
+    """
+    if isinstance(error, GatewayUnavailable):
+        return False
+    if isinstance(error, (ConnectTimeout, ConnectFailed)):
+        return True
+    if ClientConnectorError is not None and \
+            isinstance(error, ClientConnectorError):
+        return True
+    if isinstance(error, ConnectionError) and \
+            not isinstance(error, ReadTimeout):
+        reason = getattr(error.args[0] if error.args else None, 'reason',
+                         None)
+        return isinstance(reason, NewConnectionError) or \
+            _is_refused(error)
+    return False
+
+
+def _is_refused(error, depth=0):
+    """
+    Whether an error, or one it wraps, is a refused connection.  Older
+    urllib3 releases raise ``ProtocolError('Connection aborted.',
+    error(111, ...))`` for one.
+    """
+    if getattr(error, 'errno', None) == errno.ECONNREFUSED:
+        return True
+    if depth >= 3:
+        return False
+    return any(_is_refused(arg, depth + 1)
+               for arg in getattr(error, 'args', ())
+               if isinstance(arg, BaseException))
+
+
+class CircuitBreaker(object):
+    """
+    Fails fast after ``failure_threshold`` consecutive failures.  Once
+    ``reset_timeout`` seconds have passed a single trial request is let
+    through; the circuit closes again if it succeeds.
+    """
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+
+    def __init__(self, failure_threshold=DEFAULT_FAILURE_THRESHOLD,
+                 reset_timeout=DEFAULT_RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def allow_request(self):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and \
+                    time.time() - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or \
+                    self.failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self.opened_at = time.time()
+
+    def record_unsent(self):
+        """
+        Record that a request let through was not sent after all, so that a
+        half-open circuit lets the next one through instead
+        """
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self.state = self.OPEN
+
+
+class RetryPolicy(object):
+    """
+    Timeouts, retries and circuit breaking for gateway requests.
+
+    A request is only sent again when that cannot cause a second charge:
+    the connection could not be made at all, or the request carries a TxnId
+    and its reply is flagged with ``Retry``.  A lost reply (a read timeout,
+    an error status or an empty reply) is only retried for a ``Status``
+    lookup; the outcome of a charge is looked up instead, by the facade.
+    Retries wait a jittered, exponentially growing delay.
+    """
+
+    def __init__(self, connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+                 read_timeout=DEFAULT_READ_TIMEOUT,
+                 max_retries=DEFAULT_MAX_RETRIES,
+                 backoff=DEFAULT_RETRY_BACKOFF,
+                 max_backoff=DEFAULT_MAX_RETRY_BACKOFF,
+                 failure_threshold=DEFAULT_FAILURE_THRESHOLD,
+                 reset_timeout=DEFAULT_RESET_TIMEOUT):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._breakers = {}
+        self._breakers_lock = threading.Lock()
+
+    @property
+    def timeout(self):
+        return (self.connect_timeout, self.read_timeout)
+
+    @property
+    def max_duration(self):
+        """
+        The longest ``execute`` can take: every attempt timing out, with the
+        longest delay between each
+        """
+        return ((self.max_retries + 1) * sum(self.timeout) +
+                self.max_retries * self.max_backoff)
+
+    def get_breaker(self, url):
+        """
+        Return the circuit breaker for a PX POST URL
+        """
+        breaker = self._breakers.get(url)
+        if breaker is None:
+            with self._breakers_lock:
+                breaker = self._breakers.setdefault(
+                    url, CircuitBreaker(self.failure_threshold,
+                                        self.reset_timeout))
+        return breaker
+
+    def reset(self):
+        """
+        Close every circuit breaker, forgetting past failures
+        """
+        with self._breakers_lock:
+            self._breakers.clear()
+
+    def is_idempotent(self, request):
+        return bool(request.data.get('txn_id'))
+
+    def is_read_only(self, request):
+        return request.data.get('txn_type') in READ_ONLY_TXN_TYPES
+
+    def should_retry(self, request, attempt, error=None, response=None):
+        if attempt >= self.max_retries:
+            return False
+        if error is not None:
+            return is_connect_failure(error) or (
+                self.is_idempotent(request) and self.is_read_only(request)
+                and not isinstance(error, GatewayUnavailable))
+        if not self.is_idempotent(request):
+            return False
+        if response.is_empty():
+            return self.is_read_only(request)
+        return response['retry'] == 1 and response['allow_retry'] != 0
+
+    def get_delay(self, attempt):
+        return random.uniform(0, min(self.max_backoff,
+                                     self.backoff * 2 ** attempt))
+
+    def execute(self, url, request, send,
+                errors=(requests.RequestException,)):
+        """
+        Call ``send(timeout)`` until it returns a response that needn't be
+        retried, or raises an error that mustn't be.
+        """
+        breaker = self.get_breaker(url)
+        attempt = 0
+        while True:
+            if not breaker.allow_request():
+                raise CircuitOpenError("PX POST at %s is unavailable" % url)
+            response = None
+            failed, sent = True, True
+            try:
+                response = send(self.timeout)
+                failed = response.is_empty()
+            except GatewayUnavailable:
+                # Turned away before sending, such as by the rate limiter
+                sent = False
+                raise
+            except errors as e:
+                if not self.should_retry(request, attempt, error=e):
+                    raise
+            finally:
+                # Any other exception counts as a failure, so that a
+                # half-open trial always ends
+                if not sent:
+                    breaker.record_unsent()
+                elif failed:
+                    breaker.record_failure()
+                else:
+                    breaker.record_success()
+            if response is not None and not self.should_retry(
+                    request, attempt, response=response):
+                return response
+            time.sleep(self.get_delay(attempt))
+            attempt += 1
+
+
+def get_policy(**kwargs):
+    """
+    Return the process-wide policy for the given configuration, so that
+    circuit breakers are shared by every gateway using it
+    """
+    key = tuple(sorted(kwargs.items()))
+    policy = _policies.get(key)
+    if policy is None:
+        with _policies_lock:
+            policy = _policies.setdefault(key, RetryPolicy(**kwargs))
+    return policy
+
+
+def reset_policies():
+    """
+    Close the circuit breakers of every shared policy, as between tests
+    """
+    with _policies_lock:
+        policies = list(_policies.values())
+    for policy in policies:
+        policy.reset()
+
+
+def get_policy_from_settings():
+    """
+    Return the shared policy configured by the PAYMENTEXPRESS_* settings
+    """
+    from django.conf import settings
+    return get_policy(
+        connect_timeout=getattr(settings, 'PAYMENTEXPRESS_CONNECT_TIMEOUT',
+                                DEFAULT_CONNECT_TIMEOUT),
+        read_timeout=getattr(settings, 'PAYMENTEXPRESS_READ_TIMEOUT',
+                             DEFAULT_READ_TIMEOUT),
+        max_retries=getattr(settings, 'PAYMENTEXPRESS_MAX_RETRIES',
+                            DEFAULT_MAX_RETRIES),
+        backoff=getattr(settings, 'PAYMENTEXPRESS_RETRY_BACKOFF',
+                        DEFAULT_RETRY_BACKOFF),
+        max_backoff=getattr(settings, 'PAYMENTEXPRESS_MAX_RETRY_BACKOFF',
+                            DEFAULT_MAX_RETRY_BACKOFF),
+        failure_threshold=getattr(
+            settings, 'PAYMENTEXPRESS_CIRCUIT_FAILURE_THRESHOLD',
+            DEFAULT_FAILURE_THRESHOLD),
+        reset_timeout=getattr(settings,
+                              'PAYMENTEXPRESS_CIRCUIT_RESET_TIMEOUT',
+                              DEFAULT_RESET_TIMEOUT))
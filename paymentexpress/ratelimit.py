@@ -0,0 +1,159 @@
+"""
+Client-side rate limiting of PX POST requests.
+
+Each account can be given a token bucket per transaction type, so that
+bursts of traffic queue for a short while instead of being turned away by
+PX POST.  Buckets live in the process unless a lock directory is given, in
+which case their state is kept in files shared, under ``fcntl`` locks, by
+every process on the host.
+"""
+import os
+import re
+import threading
+import time
+
+from paymentexpress.policy import GatewayUnavailable
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+DEFAULT_MAX_WAIT = 10
+
+# Key of the limit applied to transaction types without one of their own
+ANY_TXN_TYPE = '*'
+
+
+class RateLimitExceeded(GatewayUnavailable):
+    """
+    Raised, without contacting PX POST, when a request could not be sent
+    within the rate limiter's maximum wait
+    """
+
+
+class TokenBucket(object):
+    """
+    Allows ``rate`` requests a second on average, and bursts of up to
+    ``capacity``
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None
+                              else max(1, rate))
+        self.tokens = self.capacity
+        self.updated = time.time()
+        self._lock = threading.Lock()
+
+    def _take(self, tokens, updated, now):
+        """
+        Return the new state and the seconds to wait before a token is
+        available, taking one if there is
+        """
+        tokens = min(self.capacity,
+                     tokens + max(0, now - updated) * self.rate)
+        if tokens >= 1:
+            return tokens - 1, now, 0
+        return tokens, now, (1 - tokens) / self.rate
+
+    def try_acquire(self):
+        """
+        Take a token and return 0, or return the seconds until one will be
+        available
+        """
+        with self._lock:
+            self.tokens, self.updated, wait = self._take(
+                self.tokens, self.updated, time.time())
+        return wait
+
+
+class FileTokenBucket(TokenBucket):
+    """
+    A ``TokenBucket`` whose state is kept in ``path``, so that every process
+    using the same file shares the one bucket
+    """
+
+    def __init__(self, rate, capacity=None, path=None):
+        if fcntl is None:
+            raise ImportError("fcntl is needed to share rate limits between "
+                              "processes")
+        super(FileTokenBucket, self).__init__(rate, capacity)
+        self.path = path
+
+    def try_acquire(self):
+        with self._lock:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                state = os.read(fd, 64).split()
+                now = time.time()
+                if len(state) == 2:
+                    tokens, updated = float(state[0]), float(state[1])
+                else:
+                    tokens, updated = self.capacity, now
+                tokens, updated, wait = self._take(tokens, updated, now)
+                os.lseek(fd, 0, os.SEEK_SET)
+                os.ftruncate(fd, 0)
+                os.write(fd, ('%r %r' % (tokens, updated)).encode('ascii'))
+            finally:
+                os.close(fd)
+        return wait
+
+
+class RateLimiter(object):
+    """
+    Token buckets for one PX POST account, keyed by transaction type.
+
+    ``limits`` maps a transaction type, or ``'*'`` for any other, to a rate
+    per second or a ``(rate, burst)`` pair.  Requests wait for a token for
+    at most ``max_wait`` seconds before ``RateLimitExceeded`` is raised.
+    """
+
+    def __init__(self, limits, max_wait=DEFAULT_MAX_WAIT, lock_dir=None,
+                 name='default'):
+        self.max_wait = max_wait
+        self.buckets = {}
+        for txn_type, limit in limits.items():
+            if isinstance(limit, (tuple, list)):
+                rate, capacity = limit
+            else:
+                rate, capacity = limit, None
+            if lock_dir:
+                path = os.path.join(lock_dir, 'paymentexpress-%s-%s.bucket'
+                                    % (_safe_name(name), _safe_name(txn_type)))
+                bucket = FileTokenBucket(rate, capacity, path)
+            else:
+                bucket = TokenBucket(rate, capacity)
+            self.buckets[txn_type] = bucket
+
+    def get_bucket(self, txn_type):
+        bucket = self.buckets.get(txn_type)
+        if bucket is None:
+            bucket = self.buckets.get(ANY_TXN_TYPE)
+        return bucket
+
+    def acquire(self, txn_type):
+        """
+        Wait until a request of ``txn_type`` may be sent, returning the
+        seconds waited
+        """
+        bucket = self.get_bucket(txn_type)
+        if bucket is None:
+            return 0
+        waited = 0
+        while True:
+            wait = bucket.try_acquire()
+            if not wait:
+                return waited
+            if waited + wait > self.max_wait:
+                raise RateLimitExceeded(
+                    "Rate limit for %s requests exceeded" % txn_type)
+            time.sleep(wait)
+            waited += wait
+
+
+def _safe_name(name):
+    if name == ANY_TXN_TYPE:
+        return 'any'
+    return re.sub(r'[^A-Za-z0-9_.-]', '_', name)
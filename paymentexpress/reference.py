@@ -0,0 +1,55 @@
+import os
+import threading
+import time
+import uuid
+
+_lock = threading.Lock()
+_last_sequence = [0]
+# The process id the token was drawn in, and the token
+_process = [None, None]
+
+
+def _next_sequence():
+    """
+    Return a number which increases on every call within the process.  It is
+    the current time in milliseconds, bumped along when called more than
+    once in the same millisecond (or if the clock goes backwards).
+    """
+    with _lock:
+        sequence = max(int(time.time() * 1000), _last_sequence[0] + 1)
+        _last_sequence[0] = sequence
+        return sequence
+
+
+def _process_token():
+    """
+    Return a random token drawn once per process, and again in a forked
+    child
+    """
+    pid = os.getpid()
+    with _lock:
+        if _process[0] != pid:
+            _process[:] = [pid, uuid.uuid4().hex[:8]]
+        return _process[1]
+
+
+def generate_merchant_reference(order_number, txn_type):
+    """
+    Return a merchant reference of the form ORDER_TYPE_SEQUENCE_TOKEN.
+
+    SEQUENCE is a millisecond timestamp that is unique and monotonic within
+    the process, and TOKEN is 32 random bits drawn by each process, so
+    references from different processes or hosts are very unlikely to clash
+    (one in four billion for two started in the same millisecond), and no
+    database read is needed.
+    """
+    return u'%s_%s_%d_%s' % (order_number, txn_type.upper(),
+                             _next_sequence(), _process_token())
+
+
+def generate_txn_id():
+    """
+    Return a random 16 character TxnId, the most PX POST accepts.  It
+    identifies one transaction across retries and status lookups.
+    """
+    return uuid.uuid4().hex[:16]
@@ -0,0 +1,318 @@
+"""
+Bulk refunds from a CSV of ``order_number,amount,dps_txn_ref`` rows.
+
+Rows are read, checked and refunded as a stream, so memory use grows only by
+a counter per distinct row.  Refunds are sent through a bounded pool of
+worker threads, optionally no faster than a given rate, and each one is
+recorded as an ``OrderTransaction`` as soon as it completes.
+
+Each row is sent with a merchant reference worked out from its contents, so
+an interrupted run can simply be started again with the same rows, even if
+the file has been renamed, re-sorted or edited: rows already refunded under
+their reference are skipped, and rows whose outcome was never known are
+looked up by TxnId rather than refunded again.
+"""
+import csv
+import hashlib
+import itertools
+import sys
+import threading
+import time
+from collections import namedtuple
+from decimal import Decimal, InvalidOperation
+
+from paymentexpress.concurrency import bounded_map, DEFAULT_MAX_WORKERS
+from paymentexpress.gateway import REFUND
+from paymentexpress.models import OrderTransaction
+from paymentexpress.policy import GatewayUnavailable, is_connect_failure
+from paymentexpress.reference import generate_txn_id
+
+from oscar.apps.payment.exceptions import UnableToTakePayment
+from requests.exceptions import ConnectionError, ReadTimeout
+
+try:
+    _clock = time.perf_counter
+except AttributeError:
+    _clock = time.time
+
+DEFAULT_CHUNK_SIZE = 500
+
+# Response codes of the refunds a resumed run skips
+APPROVED_RESPONSE_CODES = ('00',)
+
+HEADER = ('order_number', 'amount', 'dps_txn_ref')
+OUTPUT_HEADER = ('line', 'order_number', 'amount', 'dps_txn_ref', 'status',
+                 'txn_reference', 'message')
+
+# Refund statuses
+REFUNDED = 'refunded'
+DECLINED = 'declined'
+FAILED = 'failed'
+INVALID = 'invalid'
+SKIPPED = 'skipped'
+PENDING = 'pending'
+
+
+class RefundResult(namedtuple('RefundResult', ['line', 'order_number',
+                                               'amount', 'dps_txn_ref',
+                                               'status', 'result',
+                                               'error'])):
+    """
+    The outcome of one row of a bulk refund.  ``result`` holds the dict
+    ``Facade.refund`` would have returned, or ``error`` the exception it
+    would have raised.
+    """
+
+    def is_successful(self):
+        return self.status in (REFUNDED, SKIPPED)
+
+    def get_message(self):
+        if self.error is not None:
+            return u'%s' % self.error
+        return u''
+
+
+def open_csv(path, mode='r'):
+    """
+    Open a CSV file as the csv module expects on this version of Python
+    """
+    if sys.version_info[0] < 3:
+        return open(path, mode + 'b')
+    return open(path, mode, newline='')
+
+
+def read_rows(fileobj):
+    """
+    Yield ``(line, fields)`` for each non-blank row of a CSV file, skipping
+    a leading header row
+    """
+    for line, fields in enumerate(csv.reader(fileobj), 1):
+        if not any(field.strip() for field in fields):
+            continue
+        if line == 1 and tuple(field.strip().lower()
+                               for field in fields) == HEADER:
+            continue
+        yield line, fields
+
+
+def generate_row_reference(order_number, amount, dps_txn_ref, occurrence=1,
+                           batch=u''):
+    """
+    Return the merchant reference a row of a bulk refund is sent with.  It
+    depends only on the row's contents and ``occurrence``, which counts off
+    identical rows, so it is the same wherever the row is read from.
+    ``batch`` optionally tells the rows of separate refund runs apart.
+    """
+    digest = hashlib.sha1()
+    for part in (batch, order_number, amount, dps_txn_ref, occurrence):
+        if not isinstance(part, bytes):
+            part = (u'%s' % part).encode('utf-8')
+        digest.update(part + b'\n')
+    # Truncated from the left, so a long order number can't drop the digest
+    return (u'%s_REFUND_%s' % (order_number, digest.hexdigest()[:16]))[-64:]
+
+
+def parse_row(fields):
+    """
+    Return ``(order_number, amount, dps_txn_ref)`` from a row's fields,
+    raising ``ValueError`` if they are malformed
+    """
+    if len(fields) != 3:
+        raise ValueError("Expected 3 fields, got %d" % len(fields))
+    order_number, amount, dps_txn_ref = [field.strip() for field in fields]
+    if not order_number or not dps_txn_ref:
+        raise ValueError("Order number and DpsTxnRef are required")
+    try:
+        amount = Decimal(amount).quantize(Decimal('0.01'))
+    except InvalidOperation:
+        raise ValueError("Invalid amount '%s'" % amount)
+    if amount <= 0:
+        raise ValueError("Amount must be greater than zero")
+    return order_number, amount, dps_txn_ref
+
+
+class Throttle(object):
+    """
+    Spaces calls, from any number of threads, at least ``1 / rate`` seconds
+    apart
+    """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = _clock()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+class BulkRefund(object):
+    """
+    Refunds a stream of CSV rows through a ``Facade``.  ``rate`` limits the
+    refunds sent per second, and ``chunk_size`` is how many rows are checked
+    against recorded refunds at a time.  ``batch``, if given, tells the
+    rows of this run from identical rows of other runs.
+    """
+
+    def __init__(self, facade, max_workers=DEFAULT_MAX_WORKERS, rate=None,
+                 chunk_size=DEFAULT_CHUNK_SIZE, resume=True, account=None,
+                 currency=None, batch=u''):
+        self.facade = facade
+        self.batch = batch
+        self.max_workers = max_workers
+        self.throttle = Throttle(rate) if rate else None
+        self.chunk_size = chunk_size
+        self.resume = resume
+        self.gateway = facade._get_gateway(account, currency)
+
+    def run(self, rows):
+        """
+        Refund ``(line, fields)`` rows, yielding a ``RefundResult`` for each
+        one in input order as it completes
+        """
+        occurrences = {}
+        for args, response, error in bounded_map(
+                self._send, self._get_items(rows, occurrences),
+                self.max_workers):
+            yield self._get_outcome(args, response, error)
+
+    def _get_items(self, rows, occurrences):
+        rows = iter(rows)
+        while True:
+            chunk = list(itertools.islice(rows, self.chunk_size))
+            if not chunk:
+                return
+            items = []
+            for line, fields in chunk:
+                try:
+                    order_number, amount, dps_txn_ref = parse_row(fields)
+                except ValueError as e:
+                    items.append((RefundResult(line, None, None, None,
+                                               INVALID, None, e), None))
+                else:
+                    key = (order_number, amount, dps_txn_ref)
+                    occurrences[key] = occurrences.get(key, 0) + 1
+                    items.append((
+                        RefundResult(line, order_number, amount,
+                                     dps_txn_ref, None, None, None),
+                        generate_row_reference(order_number, amount,
+                                               dps_txn_ref,
+                                               occurrences[key],
+                                               self.batch)))
+            refunded, pending = self._get_recorded(
+                [merchant_ref for item, merchant_ref in items
+                 if merchant_ref is not None])
+            for item, merchant_ref in items:
+                if merchant_ref in refunded:
+                    yield item._replace(status=SKIPPED), None, None, False
+                elif merchant_ref in pending:
+                    yield item, merchant_ref, pending[merchant_ref], True
+                elif item.status is None:
+                    yield item, merchant_ref, generate_txn_id(), False
+                else:
+                    yield item, None, None, False
+
+    def _get_recorded(self, merchant_refs):
+        """
+        Return the merchant references of rows already refunded, and a dict
+        of the TxnIds of those whose last refund has an unknown outcome
+        """
+        refunded, pending = set(), {}
+        if not self.resume or not merchant_refs:
+            return refunded, pending
+        for merchant_ref, response_code, txn_id in \
+                OrderTransaction.objects.filter(
+                    merchant_reference__in=merchant_refs, txn_type=REFUND
+                ).order_by('id').values_list('merchant_reference',
+                                             'response_code', 'txn_id'):
+            if response_code in APPROVED_RESPONSE_CODES:
+                refunded.add(merchant_ref)
+            elif not response_code and txn_id:
+                pending[merchant_ref] = txn_id
+            else:
+                pending.pop(merchant_ref, None)
+        return refunded, pending
+
+    def _send(self, args):
+        item, merchant_ref, txn_id, lookup = args
+        if item.status is not None:
+            return None
+        if self.throttle is not None:
+            self.throttle.wait()
+        if lookup:
+            return self.facade._resolve(self.gateway, txn_id)
+        return self.facade._send(self.gateway, self.gateway.refund,
+                                 txn_id=txn_id,
+                                 amount=item.amount,
+                                 dps_txn_ref=item.dps_txn_ref,
+                                 merchant_ref=merchant_ref)
+
+    def _get_outcome(self, args, response, error):
+        item, merchant_ref, txn_id, lookup = args
+        if item.status is not None:
+            return item
+        if error is not None:
+            if not self._is_unsettled(error):
+                return item._replace(status=FAILED, error=error)
+            self._record_pending(item, merchant_ref, txn_id, error)
+            return item._replace(status=PENDING, error=error)
+        try:
+            result = self.facade._handle_response(
+                REFUND, item.order_number, item.amount, response,
+                merchant_reference=merchant_ref, txn_id=txn_id)
+        except UnableToTakePayment as e:
+            return item._replace(status=DECLINED, error=e)
+        except Exception as e:
+            return item._replace(status=FAILED, error=e)
+        return item._replace(status=REFUNDED, result=result)
+
+    def _is_unsettled(self, error):
+        """
+        Whether a refund may have reached PX POST without its outcome being
+        known
+        """
+        # TransactionPending, raised once a status lookup could not settle
+        # it either, carries the TxnId to look up
+        if getattr(error, 'txn_id', None) is not None:
+            return True
+        # Nothing reached PX POST if the connection was never made
+        return isinstance(error, (ReadTimeout, ConnectionError)) and \
+            not isinstance(error, GatewayUnavailable) and \
+            not is_connect_failure(error)
+
+    def _record_pending(self, item, merchant_ref, txn_id, error):
+        """
+        Record a refund without a reply, to be looked up by a resumed run
+        """
+        self.facade._record_transaction(OrderTransaction(
+            order_number=item.order_number,
+            txn_type=REFUND,
+            amount=item.amount,
+            response_message=(u'%s' % error)[:255],
+            merchant_reference=merchant_ref,
+            txn_id=txn_id))
+
+
+def write_results(results, fileobj):
+    """
+    Write each result to a CSV file as it arrives, yielding it on
+    """
+    writer = csv.writer(fileobj)
+    writer.writerow(OUTPUT_HEADER)
+    for result in results:
+        writer.writerow([
+            result.line,
+            result.order_number or '',
+            result.amount if result.amount is not None else '',
+            result.dps_txn_ref or '',
+            result.status,
+            (result.result or {}).get('txn_reference') or '',
+            result.get_message(),
+        ])
+        fileobj.flush()
+        yield result
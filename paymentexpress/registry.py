@@ -0,0 +1,209 @@
+"""
+Gateways for each PX POST account and currency, built once per process.
+
+Accounts are configured with the ``PAYMENTEXPRESS_ACCOUNTS`` setting::
+
+    PAYMENTEXPRESS_ACCOUNTS = {
+        'default': {
+            'POST_URL': 'https://sec.paymentexpress.com/pxpost.aspx',
+            'USERNAME': '...',
+            'PASSWORD': '...',
+            'CURRENCIES': ['AUD', 'NZD'],
+            'RATE_LIMITS': {'Purchase': (10, 20), '*': 5},
+        },
+        'outlet': {...},
+    }
+
+The first of an account's currencies is used when none is asked for.
+``RATE_LIMITS``, if given, holds the requests per second (or a ``(rate,
+burst)`` pair) allowed for each transaction type, ``'*'`` covering any other
+(see ``paymentexpress.ratelimit``).  ``PREFLIGHT`` and ``CARD_TYPES``
+override ``PAYMENTEXPRESS_PREFLIGHT`` and ``PAYMENTEXPRESS_CARD_TYPES`` (see
+``paymentexpress.cards``), and ``TRANSPORT`` overrides
+``PAYMENTEXPRESS_TRANSPORT`` (see ``paymentexpress.transport``).
+Without ``PAYMENTEXPRESS_ACCOUNTS`` there is a single ``default`` account
+built from ``PAYMENTEXPRESS_POST_URL``, ``PAYMENTEXPRESS_USERNAME``,
+``PAYMENTEXPRESS_PASSWORD`` and ``PAYMENTEXPRESS_CURRENCY``.
+"""
+import threading
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+try:
+    from django.core.signals import setting_changed
+except ImportError:
+    # Django < 1.8 only sends it from the test utilities
+    from django.test.signals import setting_changed
+
+from paymentexpress.gateway import Gateway
+from paymentexpress.policy import get_policy_from_settings
+from paymentexpress.ratelimit import RateLimiter, DEFAULT_MAX_WAIT
+from paymentexpress.transport import (get_transport, DEFAULT_TRANSPORT,
+                                      DEFAULT_POOL_CONNECTIONS,
+                                      DEFAULT_POOL_MAXSIZE,
+                                      DEFAULT_KEEPALIVE_TIMEOUT)
+
+DEFAULT_ACCOUNT = 'default'
+
+
+def get_accounts():
+    """
+    Return the configured accounts, keyed by name
+    """
+    accounts = getattr(settings, 'PAYMENTEXPRESS_ACCOUNTS', None)
+    if accounts is not None:
+        return accounts
+    return {
+        DEFAULT_ACCOUNT: {
+            'POST_URL': settings.PAYMENTEXPRESS_POST_URL,
+            'USERNAME': settings.PAYMENTEXPRESS_USERNAME,
+            'PASSWORD': settings.PAYMENTEXPRESS_PASSWORD,
+            'CURRENCIES': [getattr(settings, 'PAYMENTEXPRESS_CURRENCY',
+                                   'AUD')],
+            'RATE_LIMITS': getattr(settings, 'PAYMENTEXPRESS_RATE_LIMITS',
+                                   None),
+        }
+    }
+
+
+def get_pool_config(config):
+    """
+    Return the ``(pool_connections, pool_maxsize, keepalive_timeout)`` an
+    account's gateways are built with
+    """
+    return (
+        config.get('POOL_CONNECTIONS', getattr(
+            settings, 'PAYMENTEXPRESS_POOL_CONNECTIONS',
+            DEFAULT_POOL_CONNECTIONS)),
+        config.get('POOL_MAXSIZE', getattr(
+            settings, 'PAYMENTEXPRESS_POOL_MAXSIZE', DEFAULT_POOL_MAXSIZE)),
+        config.get('KEEPALIVE_TIMEOUT', getattr(
+            settings, 'PAYMENTEXPRESS_KEEPALIVE_TIMEOUT',
+            DEFAULT_KEEPALIVE_TIMEOUT)),
+    )
+
+
+class GatewayRegistry(object):
+    """
+    Builds and keeps a ``Gateway`` per (account, currency).  Gateways using
+    the same transport and pool configuration share one keep-alive session.
+    """
+
+    def __init__(self, accounts, default_account=DEFAULT_ACCOUNT):
+        for name, config in accounts.items():
+            for key in ('POST_URL', 'USERNAME', 'PASSWORD', 'CURRENCIES'):
+                if key not in config:
+                    raise ImproperlyConfigured(
+                        "PaymentExpress account '%s' has no %s" % (name, key))
+            if not config['CURRENCIES']:
+                raise ImproperlyConfigured(
+                    "PaymentExpress account '%s' has no currencies" % name)
+        if default_account not in accounts:
+            raise ImproperlyConfigured(
+                "No PaymentExpress account named '%s'" % default_account)
+        self.accounts = accounts
+        self.default_account = default_account
+        self._gateways = {}
+        self._limiters = {}
+        self._lock = threading.Lock()
+
+    def get_gateway(self, account=None, currency=None):
+        """
+        Return the gateway for an account and currency, defaulting to the
+        default account and that account's first currency
+        """
+        key = (account, currency)
+        gateway = self._gateways.get(key)
+        if gateway is None:
+            with self._lock:
+                gateway = self._gateways.get(key)
+                if gateway is None:
+                    gateway = self._get_or_build(account, currency)
+                    # Also cache under the key asked for, so that defaulted
+                    # lookups skip resolving the defaults next time
+                    self._gateways[key] = gateway
+        return gateway
+
+    def _get_or_build(self, account, currency):
+        if account is None:
+            account = self.default_account
+        if account not in self.accounts:
+            raise ValueError("Unknown PaymentExpress account '%s'" % account)
+        config = self.accounts[account]
+        if currency is None:
+            currency = config['CURRENCIES'][0]
+        if currency not in config['CURRENCIES']:
+            raise ValueError("PaymentExpress account '%s' does not accept %s"
+                             % (account, currency))
+        key = (account, currency)
+        if key not in self._gateways:
+            self._gateways[key] = self._build(config, currency,
+                                              self._get_limiter(account))
+        return self._gateways[key]
+
+    def _get_limiter(self, account):
+        """
+        Return the rate limiter shared by all of an account's gateways, if it
+        has ``RATE_LIMITS``
+        """
+        limits = self.accounts[account].get('RATE_LIMITS')
+        if not limits:
+            return None
+        if account not in self._limiters:
+            self._limiters[account] = RateLimiter(
+                limits,
+                max_wait=getattr(settings, 'PAYMENTEXPRESS_RATE_LIMIT_WAIT',
+                                 DEFAULT_MAX_WAIT),
+                lock_dir=getattr(settings, 'PAYMENTEXPRESS_RATE_LIMIT_DIR',
+                                 None),
+                name=account)
+        return self._limiters[account]
+
+    def _build(self, config, currency, limiter=None):
+        pool_connections, pool_maxsize, keepalive_timeout = \
+            get_pool_config(config)
+        transport = config.get('TRANSPORT', getattr(
+            settings, 'PAYMENTEXPRESS_TRANSPORT', DEFAULT_TRANSPORT))
+        return Gateway(
+            config['POST_URL'],
+            config['USERNAME'],
+            config['PASSWORD'],
+            currency,
+            session=get_transport(transport, pool_connections, pool_maxsize,
+                                  keepalive_timeout),
+            policy=get_policy_from_settings(),
+            limiter=limiter,
+            preflight=config.get('PREFLIGHT', getattr(
+                settings, 'PAYMENTEXPRESS_PREFLIGHT', True)),
+            card_types=config.get('CARD_TYPES', getattr(
+                settings, 'PAYMENTEXPRESS_CARD_TYPES', None))
+        )
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_registry():
+    """
+    Return the process-wide registry, configured from settings
+    """
+    global _registry
+    if _registry is None:
+        with _registry_lock:
+            if _registry is None:
+                _registry = GatewayRegistry(
+                    get_accounts(),
+                    getattr(settings, 'PAYMENTEXPRESS_DEFAULT_ACCOUNT',
+                            DEFAULT_ACCOUNT))
+    return _registry
+
+
+def _reset_registry(sender, setting, **kwargs):
+    global _registry
+    if setting.startswith('PAYMENTEXPRESS_'):
+        _registry = None
+
+
+setting_changed.connect(_reset_registry)
@@ -0,0 +1,359 @@
+"""
+A standalone PX POST simulator for load and integration testing.
+
+It accepts the ``Txn`` XML sent by ``Gateway`` and answers with approved,
+declined or error replies, after a configurable latency.  Cards stored with
+``EnableAddBillCard`` are issued billing ids that later purchases can use,
+and replies are remembered by TxnId for ``Status`` lookups.  Run it with::
+
+    python -m paymentexpress.simulator --port=8080 --latency=lognormal:50:0.5
+
+and set ``PAYMENTEXPRESS_POST_URL = 'http://127.0.0.1:8080/pxpost.aspx'``.
+"""
+import itertools
+import math
+import random
+import re
+import threading
+import time
+from collections import OrderedDict
+from optparse import OptionParser
+from xml.sax.saxutils import escape, unescape
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+DEFAULT_PORT = 8080
+# Replies remembered for Status lookups and repeated TxnIds
+DEFAULT_MAX_REMEMBERED = 100000
+
+_FIELD_REGEX = re.compile(r'<(\w+)>([^<]*)</\1>')
+
+# (success, ReCo, ResponseText, CardHolderResponseText, HelpText)
+APPROVED = ('1', '00', 'APPROVED', 'APPROVED',
+            'The transaction was approved')
+DECLINED = ('0', '05', 'DO NOT HONOUR', 'DECLINED (05)',
+            'The transaction was not approved')
+TIMED_OUT = ('0', 'U9', 'TIMEOUT', 'TIMEOUT',
+             'The transaction timed out - please try again')
+INVALID_TXN_TYPE = ('0', 'QG', 'INVALID TXNTYPE', 'INVALID TXNTYPE',
+                    'TxnType must be "Purchase", "Auth", "Refund", '
+                    '"Complete" or "Status"')
+MISSING_FIELDS = ('0', 'QK', 'INVALID REQUEST', 'INVALID REQUEST',
+                  'The request is missing required fields')
+UNKNOWN_BILLING_ID = ('0', 'QB', 'INVALID BILLING ID', 'INVALID BILLING ID',
+                      'The billing id is not recognised')
+NOT_FOUND = ('0', 'QT', 'TXN NOT FOUND', 'TXN NOT FOUND',
+             'No transaction was found for the TxnId')
+
+REPLY_TEMPLATE = (
+    '<Txn>'
+    '<Transaction success="%(success)s" reco="%(reco)s" '
+    'responseText="%(response_text)s" pxTxn="true">'
+    '<Authorized>%(success)s</Authorized>'
+    '<ReCo>%(reco)s</ReCo>'
+    '<RxDate>%(rx_date)s</RxDate>'
+    '<MerchantReference>%(merchant_ref)s</MerchantReference>'
+    '<CardName>%(card_name)s</CardName>'
+    '<Retry>%(retry)s</Retry>'
+    '<StatusRequired>0</StatusRequired>'
+    '<AuthCode>%(auth_code)s</AuthCode>'
+    '<Amount>%(amount)s</Amount>'
+    '<InputCurrencyName>%(currency)s</InputCurrencyName>'
+    '<CardHolderName>%(card_holder)s</CardHolderName>'
+    '<TxnType>%(txn_type)s</TxnType>'
+    '<CardNumber>%(card_number)s</CardNumber>'
+    '<DateExpiry>%(card_expiry)s</DateExpiry>'
+    '<CardHolderResponseText>%(card_holder_text)s</CardHolderResponseText>'
+    '<CardHolderHelpText>%(help_text)s</CardHolderHelpText>'
+    '<DpsTxnRef>%(dps_txn_ref)s</DpsTxnRef>'
+    '<AllowRetry>%(retry)s</AllowRetry>'
+    '<DpsBillingId>%(dps_billing_id)s</DpsBillingId>'
+    '</Transaction>'
+    '<ReCo>%(reco)s</ReCo>'
+    '<ResponseText>%(response_text)s</ResponseText>'
+    '<HelpText>%(help_text)s</HelpText>'
+    '<Success>%(success)s</Success>'
+    '<DpsTxnRef>%(dps_txn_ref)s</DpsTxnRef>'
+    '<TxnRef>%(txn_id)s</TxnRef>'
+    '</Txn>'
+)
+
+CARD_NAMES = (('4', 'Visa'), ('5', 'MasterCard'), ('34', 'Amex'),
+              ('37', 'Amex'), ('36', 'Diners'))
+
+
+def parse_latency(spec):
+    """
+    Return a function giving a latency in seconds from a specification in
+    milliseconds: ``N`` or ``fixed:N``, ``uniform:LOW:HIGH``,
+    ``exponential:MEAN`` or ``lognormal:MEDIAN:SIGMA``
+    """
+    parts = spec.split(':')
+    kind, args = parts[0], [float(arg) for arg in parts[1:]]
+    if not args:
+        kind, args = 'fixed', [float(kind)]
+    if kind == 'fixed' and len(args) == 1:
+        return lambda: args[0] / 1000.0
+    if kind == 'uniform' and len(args) == 2:
+        return lambda: random.uniform(*args) / 1000.0
+    if kind == 'exponential' and len(args) == 1:
+        return lambda: random.expovariate(1.0 / args[0]) / 1000.0
+    if kind == 'lognormal' and len(args) == 2:
+        mu = math.log(args[0])
+        return lambda: random.lognormvariate(mu, args[1]) / 1000.0
+    raise ValueError("Invalid latency specification: %s" % spec)
+
+
+def parse_request(body):
+    """
+    Return the fields of a ``Txn`` request, keyed by tag
+    """
+    return dict((tag, unescape(value, {'&quot;': '"'}))
+                for tag, value in _FIELD_REGEX.findall(body))
+
+
+def mask_card_number(card_number):
+    if len(card_number) < 8:
+        return card_number
+    return card_number[:6] + '.' * (len(card_number) - 8) + card_number[-2:]
+
+
+def get_card_name(card_number):
+    for prefix, name in CARD_NAMES:
+        if card_number.startswith(prefix):
+            return name
+    return ''
+
+
+class Simulator(object):
+    """
+    Decides and renders the reply to each request.  ``decline_rate`` and
+    ``error_rate`` are the fractions of otherwise valid charges that are
+    declined or time out; ``drop_rate`` the fraction answered with an empty
+    body, as when PX POST's reply is lost.
+    """
+
+    def __init__(self, latency=None, decline_rate=0.0, error_rate=0.0,
+                 drop_rate=0.0, max_remembered=DEFAULT_MAX_REMEMBERED,
+                 seed=None):
+        self.latency = latency
+        self.decline_rate = decline_rate
+        self.error_rate = error_rate
+        self.drop_rate = drop_rate
+        self.max_remembered = max_remembered
+        self.random = random.Random(seed)
+        self.billing_ids = {}
+        self.replies = OrderedDict()
+        self.stats = {}
+        self._counter = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def handle(self, body):
+        """
+        Return the reply body for a request body, after the simulated latency
+        """
+        if self.latency is not None:
+            time.sleep(self.latency())
+        fields = parse_request(body)
+        txn_type = fields.get('TxnType', '')
+        txn_id = fields.get('TxnId', '')
+
+        if txn_type == 'Status':
+            with self._lock:
+                reply = self.replies.get(txn_id)
+            if reply is None:
+                reply = self.render(NOT_FOUND, fields)
+            self.count('Status')
+            return reply
+
+        with self._lock:
+            # PX POST answers a repeated TxnId with the original reply
+            if txn_id and txn_id in self.replies:
+                self.stats['duplicate'] = self.stats.get('duplicate', 0) + 1
+                return self.replies[txn_id]
+            roll = self.random.random()
+            dropped = self.random.random() < self.drop_rate
+
+        outcome, billing_id = self.decide(txn_type, fields, roll)
+        reply = self.render(outcome, fields, billing_id)
+        self.count(outcome[2])
+        if txn_id and outcome is not TIMED_OUT:
+            self.remember(txn_id, reply)
+        if dropped:
+            self.count('dropped')
+            return ''
+        return reply
+
+    def decide(self, txn_type, fields, roll):
+        """
+        Return the outcome of a request and any billing id issued for it
+        """
+        if txn_type not in ('Purchase', 'Auth', 'Complete', 'Refund'):
+            return INVALID_TXN_TYPE, ''
+        if not fields.get('Amount'):
+            return MISSING_FIELDS, ''
+        billing_id = fields.get('DpsBillingId', '')
+        if txn_type in ('Complete', 'Refund'):
+            if not fields.get('DpsTxnRef'):
+                return MISSING_FIELDS, ''
+        elif billing_id:
+            with self._lock:
+                card = self.billing_ids.get(billing_id)
+            if card is None:
+                return UNKNOWN_BILLING_ID, ''
+            fields.update(card)
+        elif not fields.get('CardNumber'):
+            return MISSING_FIELDS, ''
+
+        if roll < self.error_rate:
+            return TIMED_OUT, ''
+        if roll < self.error_rate + self.decline_rate:
+            return DECLINED, ''
+        if fields.get('EnableAddBillCard') == '1' and not billing_id:
+            billing_id = '%016d' % next(self._counter)
+            with self._lock:
+                self.billing_ids[billing_id] = {
+                    'CardNumber': fields['CardNumber'],
+                    'CardHolderName': fields.get('CardHolderName', ''),
+                    'DateExpiry': fields.get('DateExpiry', ''),
+                }
+        return APPROVED, billing_id
+
+    def render(self, outcome, fields, billing_id=''):
+        success, reco, response_text, card_holder_text, help_text = outcome
+        card_number = fields.get('CardNumber', '')
+        values = {
+            'success': success,
+            'reco': reco,
+            'response_text': response_text,
+            'card_holder_text': card_holder_text,
+            'help_text': help_text,
+            'retry': 1 if outcome is TIMED_OUT else 0,
+            'rx_date': time.strftime('%Y%m%d%H%M%S', time.gmtime()),
+            'merchant_ref': fields.get('MerchantReference', ''),
+            'card_name': get_card_name(card_number),
+            'auth_code': ('%06d' % self.random.randint(0, 999999)
+                          if success == '1' else ''),
+            'amount': fields.get('Amount', ''),
+            'currency': fields.get('InputCurrency', ''),
+            'card_holder': fields.get('CardHolderName', ''),
+            'txn_type': fields.get('TxnType', ''),
+            'card_number': mask_card_number(card_number),
+            'card_expiry': fields.get('DateExpiry', ''),
+            'dps_txn_ref': ('%016x' % next(self._counter)
+                            if reco not in ('QG', 'QK') else ''),
+            'dps_billing_id': billing_id,
+            'txn_id': fields.get('TxnId', ''),
+        }
+        for key, value in values.items():
+            values[key] = escape(u'%s' % (value,), {'"': '&quot;'})
+        return REPLY_TEMPLATE % values
+
+    def remember(self, txn_id, reply):
+        with self._lock:
+            self.replies[txn_id] = reply
+            while len(self.replies) > self.max_remembered:
+                self.replies.popitem(last=False)
+
+    def count(self, name):
+        with self._lock:
+            self.stats[name] = self.stats.get(name, 0) + 1
+
+
+class _SimulatorHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length).decode('utf-8')
+        reply = self.server.simulator.handle(body).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml; charset=utf-8')
+        self.send_header('Content-Length', str(len(reply)))
+        self.end_headers()
+        self.wfile.write(reply)
+
+    def log_message(self, *args):
+        pass
+
+
+class _ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+class SimulatorServer(object):
+    """
+    An HTTP server answering PX POST requests with a ``Simulator``.  Use as
+    a context manager to run it in a background thread; ``url`` is the PX
+    POST URL to configure.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, **kwargs):
+        self.simulator = Simulator(**kwargs)
+        self.server = _ThreadedHTTPServer((host, port), _SimulatorHandler)
+        self.server.simulator = self.simulator
+        self.url = 'http://%s:%d/pxpost.aspx' % (
+            host, self.server.server_address[1])
+        self._thread = None
+
+    def serve_forever(self):
+        self.server.serve_forever()
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+def main(argv=None):
+    parser = OptionParser(usage="python -m paymentexpress.simulator "
+                                "[options]")
+    parser.add_option('--host', default='127.0.0.1')
+    parser.add_option('--port', type='int', default=DEFAULT_PORT)
+    parser.add_option('--latency', default=None,
+                      help="Latency in ms: N, uniform:LOW:HIGH, "
+                           "exponential:MEAN or lognormal:MEDIAN:SIGMA")
+    parser.add_option('--decline-rate', type='float', default=0.0)
+    parser.add_option('--error-rate', type='float', default=0.0)
+    parser.add_option('--drop-rate', type='float', default=0.0)
+    parser.add_option('--seed', type='int', default=None)
+    (options, args) = parser.parse_args(argv)
+
+    server = SimulatorServer(
+        options.host, options.port,
+        latency=parse_latency(options.latency) if options.latency else None,
+        decline_rate=options.decline_rate,
+        error_rate=options.error_rate,
+        drop_rate=options.drop_rate,
+        seed=options.seed)
+    print("PX POST simulator listening on %s" % server.url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server.server_close()
+        print("Replies sent: %s" % ', '.join(
+            '%s=%d' % item for item in sorted(server.simulator.stats.items())))
+
+
+if __name__ == '__main__':
+    main()
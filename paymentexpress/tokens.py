@@ -0,0 +1,135 @@
+"""
+Lookup of customers' stored cards, with a read-through cache.
+
+The ``DpsBillingId`` of each card added to PX POST's billing database is
+kept as a ``BillingToken``, indexed by customer, account and card
+fingerprint.  Lookups are answered from a Django cache where possible, and
+cards with no token are cached too, so a repeat checkout resolves its
+billing id without querying the database.  Tokens should be saved and
+removed through the ``TokenStore`` so that the cache is kept in step.
+"""
+import hashlib
+import threading
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+
+try:
+    from django.core.signals import setting_changed
+except ImportError:
+    # Django < 1.8 only sends it from the test utilities
+    from django.test.signals import setting_changed
+
+from paymentexpress import instrumentation
+from paymentexpress.cards import get_card_type, get_fingerprint, normalise
+from paymentexpress.coalescing import get_cache
+from paymentexpress.models import BillingToken
+
+DEFAULT_TOKEN_CACHE = 'default'
+DEFAULT_TOKEN_CACHE_TTL = 24 * 60 * 60
+
+CACHE_KEY_PREFIX = 'paymentexpress:token'
+
+# Cached for cards without a token
+_MISSING = ''
+
+try:
+    atomic = transaction.atomic
+except AttributeError:
+    atomic = transaction.commit_on_success
+
+
+class TokenStore(object):
+    """
+    Saves and looks up billing tokens, caching each lookup in ``cache`` for
+    ``ttl`` seconds
+    """
+
+    def __init__(self, cache, ttl=DEFAULT_TOKEN_CACHE_TTL):
+        self.cache = cache
+        self.ttl = ttl
+
+    def _get_cache_key(self, user_id, account, fingerprint):
+        key = u'%s:%s:%s' % (user_id, account, fingerprint)
+        return '%s:%s' % (CACHE_KEY_PREFIX,
+                          hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    def get_billing_id(self, user, account, card_number, expiry):
+        """
+        Return the billing id of a customer's card, or None if it has not
+        been stored
+        """
+        fingerprint = get_fingerprint(card_number, expiry)
+        key = self._get_cache_key(user.pk, account, fingerprint)
+        billing_id = self.cache.get(key)
+        if billing_id is not None:
+            instrumentation.count('tokens.lookup', source='cache')
+        else:
+            instrumentation.count('tokens.lookup', source='database')
+            billing_ids = BillingToken.objects.filter(
+                user=user, account=account,
+                fingerprint=fingerprint).values_list('dps_billing_id',
+                                                     flat=True)[:1]
+            billing_id = billing_ids[0] if billing_ids else _MISSING
+            self.cache.set(key, billing_id, self.ttl)
+        return billing_id or None
+
+    def save(self, user, account, card_number, expiry, billing_id):
+        """
+        Store the billing id of a customer's card, replacing any it had
+        """
+        number = normalise(card_number)
+        fingerprint = get_fingerprint(number, expiry)
+        tokens = BillingToken.objects.filter(user=user, account=account,
+                                             fingerprint=fingerprint)
+        if not tokens.update(dps_billing_id=billing_id):
+            try:
+                with atomic():
+                    BillingToken.objects.create(
+                        user=user, account=account, fingerprint=fingerprint,
+                        dps_billing_id=billing_id,
+                        card_type=get_card_type(number),
+                        last_digits=number[-4:], expiry=normalise(expiry))
+            except IntegrityError:
+                # Saved by a concurrent checkout in the meantime
+                tokens.update(dps_billing_id=billing_id)
+        self.cache.set(self._get_cache_key(user.pk, account, fingerprint),
+                       billing_id, self.ttl)
+
+    def delete(self, token):
+        """
+        Remove a stored card, for example when the customer asks for it to
+        be forgotten
+        """
+        token.delete()
+        self.cache.delete(self._get_cache_key(token.user_id, token.account,
+                                              token.fingerprint))
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_token_store():
+    """
+    Return the process-wide token store configured from settings
+    """
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = TokenStore(
+                    get_cache(getattr(settings, 'PAYMENTEXPRESS_TOKEN_CACHE',
+                                      DEFAULT_TOKEN_CACHE)),
+                    ttl=getattr(settings, 'PAYMENTEXPRESS_TOKEN_CACHE_TTL',
+                                DEFAULT_TOKEN_CACHE_TTL))
+    return _store
+
+
+def _reset_store(sender, setting, **kwargs):
+    global _store
+    if setting.startswith('PAYMENTEXPRESS_'):
+        _store = None
+
+
+setting_changed.connect(_reset_store)
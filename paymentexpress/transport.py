@@ -0,0 +1,370 @@
+"""
+HTTP transports used by ``Gateway`` to POST requests to PX POST.
+
+A transport has a ``post(url, data, auth=None, timeout=None)`` method
+returning an object with the reply's ``status_code`` and raw ``content``,
+and a ``close()`` method.  Failures are raised as the ``requests``
+exceptions the retry policy understands, whichever library sent the
+request.  The transports available are:
+
+* ``requests`` - a pooled ``requests`` session (the default)
+* ``urllib3`` - a ``urllib3`` pool manager, without ``requests``' overhead
+* ``http.client`` - the standard library's keep-alive connections, pooled
+  per host
+* ``memory`` - an in-process ``paymentexpress.simulator.Simulator``, for
+  tests and development without a network
+
+``PAYMENTEXPRESS_TRANSPORT`` (or an account's ``TRANSPORT``) names one of
+these, or gives the dotted path of a class taking the same pool arguments.
+"""
+import base64
+import importlib
+import select
+import socket
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError, ConnectTimeout, ReadTimeout
+
+try:
+    import urllib3
+except ImportError:
+    from requests.packages import urllib3
+
+# Older urllib3 releases, such as the one bundled with requests 2.4, raise
+# a ``ProtocolError`` wrapping the socket error instead
+_NEW_CONNECTION_ERRORS = tuple(
+    error for error in [getattr(urllib3.exceptions, 'NewConnectionError',
+                                None)]
+    if error is not None)
+
+try:
+    from http.client import HTTPConnection, HTTPSConnection, HTTPException
+    from urllib.parse import urlsplit
+except ImportError:
+    from httplib import HTTPConnection, HTTPSConnection, HTTPException
+    from urlparse import urlsplit
+
+DEFAULT_POOL_CONNECTIONS = 10
+DEFAULT_POOL_MAXSIZE = 10
+DEFAULT_KEEPALIVE_TIMEOUT = 60
+
+DEFAULT_TRANSPORT = 'requests'
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+class ConnectFailed(ConnectionError):
+    """
+    Raised by transports when no connection could be made, so the request
+    cannot have reached PX POST
+    """
+
+
+class TransportResponse(object):
+    """
+    A reply received by a transport other than ``requests``
+    """
+    __slots__ = ('status_code', 'content')
+
+    def __init__(self, status_code, content):
+        self.status_code = status_code
+        self.content = content
+
+
+def _split_timeout(timeout):
+    """
+    Return the connect and read timeouts of a ``requests`` style timeout
+    """
+    if isinstance(timeout, tuple):
+        return timeout
+    return timeout, timeout
+
+
+def _get_headers(auth):
+    headers = {'Content-Type': 'text/xml; charset=utf-8'}
+    if auth:
+        credentials = ('%s:%s' % auth).encode('latin-1')
+        headers['Authorization'] = 'Basic %s' % (
+            base64.b64encode(credentials).decode('ascii'))
+    return headers
+
+
+class PooledSession(object):
+    """
+    A persistent, keep-alive HTTP session for PX POST requests.
+
+    Connections are pooled per host by urllib3, which is thread-safe, so a
+    single instance can be shared by every gateway and worker thread in the
+    process.  Connections which have sat idle for longer than
+    ``keepalive_timeout`` seconds are discarded before the next request
+    rather than being reused after the server has dropped them.
+    """
+
+    def __init__(self, pool_connections=DEFAULT_POOL_CONNECTIONS,
+                 pool_maxsize=DEFAULT_POOL_MAXSIZE,
+                 keepalive_timeout=DEFAULT_KEEPALIVE_TIMEOUT):
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.keepalive_timeout = keepalive_timeout
+        self._lock = threading.Lock()
+        self._last_used = time.time()
+        self.adapter = HTTPAdapter(pool_connections=pool_connections,
+                                   pool_maxsize=pool_maxsize)
+        self.session = requests.Session()
+        self.session.mount('https://', self.adapter)
+        self.session.mount('http://', self.adapter)
+
+    def _expire_idle_connections(self):
+        now = time.time()
+        with self._lock:
+            idle = now - self._last_used
+            self._last_used = now
+            if self.keepalive_timeout and idle > self.keepalive_timeout:
+                self.adapter.poolmanager.clear()
+
+    def post(self, url, data, **kwargs):
+        self._expire_idle_connections()
+        return self.session.post(url, data, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+
+class Urllib3Transport(object):
+    """
+    Sends requests through a ``urllib3`` pool manager, which is thread-safe
+    and keeps connections alive per host
+    """
+
+    def __init__(self, pool_connections=DEFAULT_POOL_CONNECTIONS,
+                 pool_maxsize=DEFAULT_POOL_MAXSIZE,
+                 keepalive_timeout=DEFAULT_KEEPALIVE_TIMEOUT):
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.keepalive_timeout = keepalive_timeout
+        self._lock = threading.Lock()
+        self._last_used = time.time()
+        self.pool = urllib3.PoolManager(num_pools=pool_connections,
+                                        maxsize=pool_maxsize)
+
+    def _expire_idle_connections(self):
+        now = time.time()
+        with self._lock:
+            idle = now - self._last_used
+            self._last_used = now
+            if self.keepalive_timeout and idle > self.keepalive_timeout:
+                self.pool.clear()
+
+    def post(self, url, data, auth=None, timeout=None):
+        self._expire_idle_connections()
+        connect, read = _split_timeout(timeout)
+        try:
+            response = self.pool.urlopen(
+                'POST', url, body=data, headers=_get_headers(auth),
+                timeout=urllib3.Timeout(connect=connect, read=read),
+                retries=False, redirect=False)
+        except _NEW_CONNECTION_ERRORS as e:
+            raise ConnectFailed(e)
+        except urllib3.exceptions.ConnectTimeoutError as e:
+            raise ConnectTimeout(e)
+        except urllib3.exceptions.ReadTimeoutError as e:
+            raise ReadTimeout(e)
+        except urllib3.exceptions.HTTPError as e:
+            raise ConnectionError(e)
+        return TransportResponse(response.status, response.data)
+
+    def close(self):
+        self.pool.clear()
+
+
+class HTTPClientTransport(object):
+    """
+    Sends requests over the standard library's ``http.client`` connections.
+    These are not thread-safe, so each is taken out of a shared pool for one
+    request at a time.  Up to ``pool_maxsize`` idle connections are kept
+    alive for each of up to ``pool_connections`` hosts; any more are closed
+    once used.
+    """
+
+    def __init__(self, pool_connections=DEFAULT_POOL_CONNECTIONS,
+                 pool_maxsize=DEFAULT_POOL_MAXSIZE,
+                 keepalive_timeout=DEFAULT_KEEPALIVE_TIMEOUT):
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.keepalive_timeout = keepalive_timeout
+        self._lock = threading.Lock()
+        # Idle (connection, last used) pairs, most recently used last, by
+        # (scheme, host, port)
+        self._idle = {}
+
+    def _get_idle_connection(self, key):
+        while True:
+            with self._lock:
+                idle = self._idle.get(key)
+                if not idle:
+                    return None
+                connection, last_used = idle.pop()
+            if self._is_reusable(connection, last_used):
+                return connection
+            connection.close()
+
+    def _put_idle_connection(self, key, connection):
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle is None and len(self._idle) < self.pool_connections:
+                idle = self._idle[key] = []
+            if idle is not None and len(idle) < self.pool_maxsize:
+                idle.append((connection, time.time()))
+                return
+        connection.close()
+
+    def _is_reusable(self, connection, last_used):
+        if connection.sock is None:
+            return False
+        if self.keepalive_timeout and \
+                time.time() - last_used > self.keepalive_timeout:
+            return False
+        # An idle connection is only readable once the server has closed it
+        return not select.select([connection.sock], [], [], 0)[0]
+
+    def _connect(self, scheme, host, port, timeout):
+        cls = HTTPSConnection if scheme == 'https' else HTTPConnection
+        connection = cls(host, port, timeout=timeout)
+        try:
+            connection.connect()
+        except socket.timeout as e:
+            raise ConnectTimeout(e)
+        except (socket.error, HTTPException) as e:
+            raise ConnectFailed(e)
+        return connection
+
+    def post(self, url, data, auth=None, timeout=None):
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.hostname, parts.port)
+        connect, read = _split_timeout(timeout)
+        connection = self._get_idle_connection(key)
+        if connection is None:
+            connection = self._connect(parts.scheme, parts.hostname,
+                                       parts.port, connect)
+        path = parts.path or '/'
+        if parts.query:
+            path = '%s?%s' % (path, parts.query)
+        try:
+            connection.sock.settimeout(read)
+            connection.request('POST', path, data, _get_headers(auth))
+            response = connection.getresponse()
+            content = response.read()
+        except socket.timeout as e:
+            connection.close()
+            raise ReadTimeout(e)
+        except (socket.error, HTTPException) as e:
+            connection.close()
+            raise ConnectionError(e)
+        if response.will_close:
+            connection.close()
+        else:
+            self._put_idle_connection(key, connection)
+        return TransportResponse(response.status, content)
+
+    def close(self):
+        with self._lock:
+            for idle in self._idle.values():
+                for connection, _ in idle:
+                    connection.close()
+            self._idle.clear()
+
+
+class InMemoryTransport(object):
+    """
+    Answers requests with a ``paymentexpress.simulator.Simulator`` in the
+    same process, without any network I/O
+    """
+
+    def __init__(self, pool_connections=DEFAULT_POOL_CONNECTIONS,
+                 pool_maxsize=DEFAULT_POOL_MAXSIZE,
+                 keepalive_timeout=DEFAULT_KEEPALIVE_TIMEOUT,
+                 simulator=None):
+        if simulator is None:
+            from paymentexpress.simulator import Simulator
+            simulator = Simulator()
+        self.simulator = simulator
+        # The number of requests answered, counted across threads
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def post(self, url, data, auth=None, timeout=None):
+        with self._lock:
+            self.requests += 1
+        if isinstance(data, bytes):
+            data = data.decode('utf-8')
+        reply = self.simulator.handle(data)
+        return TransportResponse(200, reply.encode('utf-8'))
+
+    def close(self):
+        pass
+
+
+TRANSPORTS = {
+    'requests': PooledSession,
+    'urllib3': Urllib3Transport,
+    'http.client': HTTPClientTransport,
+    'memory': InMemoryTransport,
+}
+
+
+def get_transport_class(name):
+    """
+    Return the transport class registered as ``name``, or found at that
+    dotted path
+    """
+    if name in TRANSPORTS:
+        return TRANSPORTS[name]
+    module_name, _, class_name = name.rpartition('.')
+    try:
+        return getattr(importlib.import_module(module_name), class_name)
+    except (ImportError, AttributeError, ValueError):
+        raise ValueError("Unknown PaymentExpress transport '%s'" % name)
+
+
+def get_transport(name=DEFAULT_TRANSPORT,
+                  pool_connections=DEFAULT_POOL_CONNECTIONS,
+                  pool_maxsize=DEFAULT_POOL_MAXSIZE,
+                  keepalive_timeout=DEFAULT_KEEPALIVE_TIMEOUT):
+    """
+    Return the process-wide transport of the given kind and pool
+    configuration, creating it on first use.
+    """
+    key = (name, pool_connections, pool_maxsize, keepalive_timeout)
+    session = _sessions.get(key)
+    if session is None:
+        with _sessions_lock:
+            session = _sessions.get(key)
+            if session is None:
+                session = get_transport_class(name)(*key[1:])
+                _sessions[key] = session
+    return session
+
+
+def get_session(pool_connections=DEFAULT_POOL_CONNECTIONS,
+                pool_maxsize=DEFAULT_POOL_MAXSIZE,
+                keepalive_timeout=DEFAULT_KEEPALIVE_TIMEOUT):
+    """
+    Return the process-wide ``requests`` session for the given pool
+    configuration, creating it on first use.
+    """
+    return get_transport(DEFAULT_TRANSPORT, pool_connections, pool_maxsize,
+                         keepalive_timeout)
+
+
+def close_sessions():
+    """
+    Close and forget every shared transport
+    """
+    with _sessions_lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+"""
+Runs the benchmark suite and saves its results, optionally comparing them
+with the results of an earlier run::
+
+    ./run_benchmarks.py --output=results-0.1.1.json
+    ./run_benchmarks.py --compare=results-0.1.1.json
+
+Exits with a non-zero status if any benchmark has regressed.
+"""
+import sys
+from optparse import OptionParser
+
+from django.conf import settings
+
+from benchmarks.harness import DEFAULT_TOLERANCE
+
+if not settings.configured:
+    settings.configure(
+            DATABASES={
+                'default': {
+                    'ENGINE': 'django.db.backends.sqlite3',
+                    }
+                },
+            INSTALLED_APPS=[
+                'django.contrib.auth',
+                'django.contrib.contenttypes',
+                'paymentexpress',
+                ],
+            DEBUG=False,
+            PAYMENTEXPRESS_POST_URL='http://127.0.0.1/pxpost.aspx',
+            PAYMENTEXPRESS_USERNAME='TestUsername',
+            PAYMENTEXPRESS_PASSWORD='TestPassword',
+            PAYMENTEXPRESS_CURRENCY='AUD',
+        )
+
+
+def run_benchmarks(options):
+    import django
+    if hasattr(django, 'setup'):
+        django.setup()
+    from django.db import connection
+    connection.creation.create_test_db(verbosity=0)
+
+    from benchmarks import harness, suite
+    from tests import StubPxPostServer
+
+    with StubPxPostServer() as server:
+        results = harness.run(suite.get_benchmarks(server.url),
+                              scale=options.scale)
+
+    if options.output:
+        harness.save_results(results, options.output)
+        print("Results saved to %s" % options.output)
+
+    if options.compare:
+        regressions = harness.compare(harness.load_results(options.compare),
+                                      results, options.tolerance)
+        for name, before, after in regressions:
+            print("REGRESSION %s: p50 %.1f us -> %.1f us" % (name, before,
+                                                            after))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    parser = OptionParser()
+    parser.add_option('--output', default='benchmark-results.json',
+                      help="File to save results to")
+    parser.add_option('--compare', default=None,
+                      help="Results file of an earlier run to compare with")
+    parser.add_option('--tolerance', type='float',
+                      default=DEFAULT_TOLERANCE,
+                      help="Fraction by which a median may grow before it "
+                           "counts as a regression (default 0.1)")
+    parser.add_option('--scale', type='float', default=1.0,
+                      help="Multiplier for the number of iterations")
+    (options, args) = parser.parse_args()
+    run_benchmarks(options)
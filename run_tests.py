@@ -55,7 +55,11 @@ def run_tests(*test_args):
     # Run tests
     test_runner = NoseTestSuiteRunner(verbosity=1)
 
-    c = coverage(source=['paymentexpress'], omit=['*migrations*', '*tests*'])
+    omit = ['*migrations*', '*tests*']
+    if sys.version_info < (3, 5):
+        # The asyncio modules cannot be parsed here
+        omit.append('*async_*')
+    c = coverage(source=['paymentexpress'], omit=omit)
     c.start()
     num_failures = test_runner.run_tests(test_args)
     c.stop()
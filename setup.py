@@ -1,6 +1,11 @@
 #!/usr/bin/env python
+import sys
 from setuptools import setup, find_packages
 
+install_requires = ['django-oscar>=0.3', 'requests>=2.4', 'urllib3>=1.9']
+if sys.version_info < (3, 2):
+    install_requires.append('futures>=2.1')
+
 setup(name='django-oscar-paymentexpress',
       version='0.1.1',
       url='https://github.com/tangentlabs/django-oscar-paymentexpress',
@@ -10,8 +15,9 @@ setup(name='django-oscar-paymentexpress',
       long_description=open('README.rst').read(),
       keywords="Payment, PaymentExpress",
       license='BSD',
-      packages=find_packages(exclude=['sandbox*', 'tests*']),
-      install_requires=['django-oscar>=0.3', 'requests>=0.13.5'],
+      packages=find_packages(exclude=['sandbox*', 'tests*', 'benchmarks*']),
+      install_requires=install_requires,
+      extras_require={'async': ['aiohttp>=3.0']},
       include_package_data=True,
       # See http://pypi.python.org/pypi?%3Aaction=list_classifiers
       classifiers=['Environment :: Web Environment',
@@ -1,3 +1,12 @@
+import threading
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
 SAMPLE_SUCCESSFUL_RESPONSE = """
 <Txn>
     <Transaction success="1" reco="00" responseText="APPROVED" pxTxn="true">
@@ -261,3 +270,56 @@ class XmlTestingMixin(object):
                 return
             parent = sub_elements[0]
         self.assertEqual(value, parent.firstChild.data)
+
+
+class _StubPxPostHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately, which Nagle's algorithm would
+    # otherwise hold up on keep-alive connections
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        self.server.requests.append(self.rfile.read(length))
+        body = self.server.response_body.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class _ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class StubPxPostServer(object):
+    """
+    A local HTTP server which answers every POST with a canned PX POST
+    response.  Use as a context manager; ``url`` is set once started.
+    """
+
+    def __init__(self, response_body=SAMPLE_SUCCESSFUL_RESPONSE):
+        self.server = _ThreadedHTTPServer(('127.0.0.1', 0),
+                                          _StubPxPostHandler)
+        self.server.response_body = response_body
+        self.server.requests = []
+        self.url = 'http://127.0.0.1:%d/pxpost.aspx' % (
+            self.server.server_address[1])
+
+    @property
+    def requests(self):
+        return self.server.requests
+
+    def __enter__(self):
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
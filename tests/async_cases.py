@@ -0,0 +1,241 @@
+import asyncio
+import unittest
+
+from django.test import TestCase, TransactionTestCase
+
+from paymentexpress import async_gateway
+from paymentexpress.facade import TransactionPending
+from paymentexpress.gateway import Response, PURCHASE
+from paymentexpress.models import OrderTransaction
+from paymentexpress.ratelimit import RateLimiter, RateLimitExceeded
+from tests import (StubPxPostServer, CARD_VISA, SAMPLE_SUCCESSFUL_RESPONSE,
+                   SAMPLE_DECLINED_RESPONSE)
+
+from oscar.apps.payment.utils import Bankcard
+from oscar.apps.payment.exceptions import UnableToTakePayment
+
+
+def run(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.run_until_complete(loop.shutdown_asyncgens())
+        loop.close()
+
+
+@unittest.skipIf(async_gateway.aiohttp is None, "aiohttp is not installed")
+class AsyncGatewayTests(TestCase):
+
+    def test_authorise_returns_response(self):
+        with StubPxPostServer() as server:
+            async def call():
+                gateway = async_gateway.AsyncGateway(server.url, 'user',
+                                                     'pass', 'AUD')
+                try:
+                    return await gateway.authorise(card_holder='Frankie',
+                                                   card_number=CARD_VISA,
+                                                   cvc2='123',
+                                                   amount=1.23)
+                finally:
+                    await async_gateway.close_async_sessions()
+            response = run(call())
+        self.assertIsInstance(response, Response)
+        self.assertTrue(response.is_successful())
+        self.assertIn(b'<TxnType>Auth</TxnType>', server.requests[0])
+
+    def test_missing_fields_raise_before_sending(self):
+        gateway = async_gateway.AsyncGateway('http://localhost/', 'user',
+                                             'pass', 'AUD')
+        with self.assertRaises(ValueError):
+            run(gateway.complete(amount=1.23))
+
+    def test_concurrent_calls_share_one_session(self):
+        with StubPxPostServer() as server:
+            async def call():
+                gateway = async_gateway.AsyncGateway(server.url, 'user',
+                                                     'pass', 'AUD')
+                try:
+                    responses = await asyncio.gather(*[
+                        gateway.complete(amount=1.23, dps_txn_ref=str(i))
+                        for i in range(20)])
+                    sessions = async_gateway._sessions[
+                        asyncio.get_event_loop()]
+                    return responses, len(sessions)
+                finally:
+                    await async_gateway.close_async_sessions()
+            responses, num_sessions = run(call())
+        self.assertEquals(20, len(server.requests))
+        self.assertTrue(all(r.is_successful() for r in responses))
+        self.assertEquals(1, num_sessions)
+
+    def test_requests_are_rate_limited(self):
+        limiter = RateLimiter({'Complete': (1, 1)}, max_wait=0)
+        with StubPxPostServer() as server:
+            async def call():
+                gateway = async_gateway.AsyncGateway(server.url, 'user',
+                                                     'pass', 'AUD',
+                                                     limiter=limiter)
+                try:
+                    await gateway.complete(amount=1.23, dps_txn_ref='1')
+                    await gateway.complete(amount=1.23, dps_txn_ref='2')
+                finally:
+                    await async_gateway.close_async_sessions()
+            with self.assertRaises(RateLimitExceeded):
+                run(call())
+        self.assertEquals(1, len(server.requests))
+
+    def test_gateway_is_initialised_like_gateway(self):
+        gateway = async_gateway.AsyncGateway('http://localhost/', 'user',
+                                             'pass', 'AUD',
+                                             preflight=False)
+        self.assertIsNone(gateway.session)
+        self.assertIsNone(gateway.limiter)
+        self.assertFalse(gateway.preflight)
+        self.assertIsNotNone(gateway.policy)
+
+
+@unittest.skipIf(async_gateway.aiohttp is None, "aiohttp is not installed")
+class AsyncFacadeTests(TransactionTestCase):
+
+    def setUp(self):
+        self.card = Bankcard(card_number=CARD_VISA,
+                             expiry_date='1299',
+                             name="Frankie", cvv="123",
+                             start_date="1010")
+
+    def purchase(self, server, *args):
+        from paymentexpress.async_facade import AsyncFacade
+
+        async def call():
+            with self.settings(PAYMENTEXPRESS_POST_URL=server.url):
+                facade = AsyncFacade()
+            try:
+                return await facade.purchase(*args)
+            finally:
+                await async_gateway.close_async_sessions()
+        return run(call())
+
+    def test_successful_purchase_is_recorded(self):
+        with StubPxPostServer(SAMPLE_SUCCESSFUL_RESPONSE) as server:
+            result = self.purchase(server, '2000', 1.23, None, self.card)
+        self.assertEquals('000000030884cdc6', result['txn_reference'])
+        txn = OrderTransaction.objects.get(order_number='2000')
+        self.assertEquals(PURCHASE, txn.txn_type)
+
+    def test_invalid_card_raises_without_sending(self):
+        card = Bankcard(card_number='4111111111111112',
+                        expiry_date='1299', name="Frankie", cvv="123")
+        with StubPxPostServer(SAMPLE_SUCCESSFUL_RESPONSE) as server:
+            with self.assertRaises(UnableToTakePayment):
+                self.purchase(server, '2002', 1.23, None, card)
+            self.assertEquals([], server.requests)
+        self.assertEquals(0, OrderTransaction.objects.count())
+
+    def test_card_checks_follow_settings(self):
+        from paymentexpress.async_facade import AsyncFacade
+        with self.settings(PAYMENTEXPRESS_PREFLIGHT=False,
+                           PAYMENTEXPRESS_CARD_TYPES=('Visa',)):
+            gateway = AsyncFacade().gateway
+        self.assertFalse(gateway.preflight)
+        self.assertEquals(('Visa',), gateway.card_types)
+
+    def test_declined_purchase_raises_and_is_recorded(self):
+        with StubPxPostServer(SAMPLE_DECLINED_RESPONSE) as server:
+            with self.assertRaises(UnableToTakePayment):
+                self.purchase(server, '2001', 1.23, 'abc123')
+        self.assertEquals(
+            1, OrderTransaction.objects.filter(order_number='2001').count())
+
+    def test_purchase_is_sent_with_a_txn_id(self):
+        with StubPxPostServer(SAMPLE_SUCCESSFUL_RESPONSE) as server:
+            self.purchase(server, '2003', 1.23, None, self.card)
+        txn_id = server.requests[0].split(b'<TxnId>')[1].split(
+            b'</TxnId>')[0].decode('utf-8')
+        self.assertEquals(
+            txn_id, OrderTransaction.objects.get(order_number='2003').txn_id)
+
+    def test_lost_reply_is_looked_up_not_resent(self):
+        from paymentexpress.async_facade import AsyncFacade
+        facade = AsyncFacade()
+        sent, looked_up = [], []
+
+        async def purchase(**kwargs):
+            sent.append(kwargs['txn_id'])
+            raise asyncio.TimeoutError()
+
+        async def status(txn_id):
+            looked_up.append(txn_id)
+            return Response('', SAMPLE_SUCCESSFUL_RESPONSE)
+
+        facade.gateway.purchase = purchase
+        facade.gateway.status = status
+        result = run(facade.purchase('2004', 1.23, 'abc123'))
+        self.assertEquals('000000030884cdc6', result['txn_reference'])
+        self.assertEquals(1, len(sent))
+        self.assertEquals(sent, looked_up)
+
+    def test_unresolved_reply_leaves_resubmits_pending(self):
+        from paymentexpress.async_facade import AsyncFacade
+        facade = AsyncFacade()
+        sent = []
+
+        async def purchase(**kwargs):
+            sent.append(kwargs['txn_id'])
+            raise asyncio.TimeoutError()
+
+        async def status(txn_id):
+            return Response('', '')
+
+        facade.gateway.purchase = purchase
+        facade.gateway.status = status
+        for attempt in range(2):
+            with self.assertRaises(TransactionPending) as cm:
+                run(facade.purchase('2005', 1.23, 'abc123'))
+            self.assertEquals(sent[0], cm.exception.txn_id)
+        self.assertEquals(1, len(sent))
+        self.assertEquals(0, OrderTransaction.objects.count())
+
+    def test_identical_purchases_are_sent_once(self):
+        from paymentexpress.async_facade import AsyncFacade
+        facade = AsyncFacade()
+        sent = []
+
+        async def purchase(**kwargs):
+            sent.append(kwargs['txn_id'])
+            await asyncio.sleep(0.05)
+            return Response('', SAMPLE_SUCCESSFUL_RESPONSE)
+
+        facade.gateway.purchase = purchase
+
+        async def call():
+            return await asyncio.gather(
+                facade.purchase('2006', 1.23, 'abc123'),
+                facade.purchase('2006', 1.23, 'abc123'))
+        results = run(call())
+        self.assertEquals(1, len(sent))
+        self.assertEquals(results[0], results[1])
+
+    def test_other_accounts_and_sync_helpers_are_unavailable(self):
+        from paymentexpress.async_facade import AsyncFacade
+        facade = AsyncFacade()
+        with self.assertRaises(NotImplementedError):
+            facade._get_gateway('outlet')
+        with self.assertRaises(NotImplementedError):
+            facade.tokenise(None, self.card)
+        with self.assertRaises(NotImplementedError):
+            facade.complete_many([])
+        with self.assertRaises(NotImplementedError):
+            facade.gateway.status_batch(['1'])
+
+    def test_gateway_is_built_from_the_default_account(self):
+        from paymentexpress.async_facade import AsyncFacade
+        accounts = {'default': {'POST_URL': 'http://localhost/',
+                                'USERNAME': 'user', 'PASSWORD': 'pass',
+                                'CURRENCIES': ['NZD'],
+                                'POOL_MAXSIZE': 3}}
+        with self.settings(PAYMENTEXPRESS_ACCOUNTS=accounts):
+            facade = AsyncFacade()
+        self.assertEquals('http://localhost/', facade.gateway.post_url)
+        self.assertEquals('NZD', facade.gateway.currency)
+        self.assertEquals(3, facade.gateway.pool_config[1])
@@ -0,0 +1,8 @@
+"""
+The asyncio tests are written with ``async def``, which older Pythons cannot
+parse, so they are only loaded where the async modules can run.
+"""
+import sys
+
+if sys.version_info >= (3, 5):
+    from tests.async_cases import *  # noqa
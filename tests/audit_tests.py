@@ -0,0 +1,233 @@
+import json
+import os
+import shutil
+import tempfile
+import time
+from datetime import datetime
+from decimal import Decimal
+
+from django.db import connections, DEFAULT_DB_ALIAS
+from django.test import TransactionTestCase
+from mock import patch, Mock
+
+from paymentexpress import audit
+from paymentexpress.audit import AuditWriter
+from paymentexpress.facade import Facade
+from paymentexpress.models import OrderTransaction
+from tests import SAMPLE_PURCHASE_REQUEST, SAMPLE_SUCCESSFUL_RESPONSE
+
+
+def create_txn(order_number):
+    return OrderTransaction(order_number=order_number,
+                            txn_type='Purchase',
+                            txn_ref='0000000600fdd28e',
+                            amount='1.23',
+                            response_code='00',
+                            response_message='Approved',
+                            request_xml=SAMPLE_PURCHASE_REQUEST,
+                            response_xml=SAMPLE_SUCCESSFUL_RESPONSE)
+
+
+def share_connection(connection):
+    if hasattr(connection, 'inc_thread_sharing'):
+        connection.inc_thread_sharing()
+    else:
+        connection.allow_thread_sharing = True
+
+
+class SharedConnectionWriter(AuditWriter):
+    """
+    Inserts from its thread through the test's database connection, as an
+    in-memory SQLite test database cannot be opened from another thread
+    """
+
+    def start(self):
+        self.connection = connections[DEFAULT_DB_ALIAS]
+        share_connection(self.connection)
+        super(SharedConnectionWriter, self).start()
+
+    def _run(self):
+        connections[DEFAULT_DB_ALIAS] = self.connection
+        super(SharedConnectionWriter, self)._run()
+
+
+def fail_once(insert):
+    """
+    Wrap ``insert`` to fail the first time it is called
+    """
+    calls = []
+
+    def wrapper(records):
+        calls.append(records)
+        if len(calls) == 1:
+            raise Exception("Insert failed")
+        return insert(records)
+    return wrapper
+
+
+def fail_for(order_number, insert):
+    """
+    Wrap ``insert`` to fail for batches holding ``order_number``
+    """
+    def wrapper(records):
+        if any(r['order_number'] == order_number for r in records):
+            raise Exception("Insert failed")
+        return insert(records)
+    return wrapper
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+
+
+class AuditWriterTests(TransactionTestCase):
+
+    def setUp(self):
+        self.journal_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.journal_dir)
+
+    def test_submitted_transactions_are_inserted_in_batches(self):
+        writer = SharedConnectionWriter(batch_size=10, flush_interval=0.01)
+        with patch.object(writer, '_insert',
+                          wraps=writer._insert) as insert:
+            for i in range(25):
+                writer.submit(create_txn(str(i)))
+            writer.start()
+            writer.stop()
+        self.assertEquals(25, OrderTransaction.objects.count())
+        self.assertEquals(3, insert.call_count)
+
+    def test_transactions_are_masked_before_being_queued(self):
+        writer = SharedConnectionWriter(journal_dir=self.journal_dir)
+        writer.start()
+        writer.submit(create_txn('1'))
+        writer.stop()
+        txn = OrderTransaction.objects.get(order_number='1')
+        self.assertIn('<Cvc2>XXX</Cvc2>', txn.request_xml)
+
+    def test_journal_is_emptied_once_rows_are_inserted(self):
+        writer = SharedConnectionWriter(journal_dir=self.journal_dir,
+                             flush_interval=0.01)
+        writer.start()
+        writer.submit(create_txn('1'))
+        writer.flush()
+        self.assertEquals(0, os.path.getsize(writer.journal_path))
+        writer.stop()
+        self.assertEquals([], os.listdir(self.journal_dir))
+
+    def test_journal_is_compacted_while_rows_are_queued(self):
+        writer = SharedConnectionWriter(journal_dir=self.journal_dir)
+        writer._open_journal()
+        writer.submit(create_txn('1'))
+        writer.submit(create_txn('2'))
+        writer._write([writer.queue.get_nowait()])
+        with open(writer.journal_path) as journal:
+            self.assertEquals(['2'], [json.loads(line)['order_number']
+                                      for line in journal])
+        writer._write([writer.queue.get_nowait()])
+        self.assertEquals(0, os.path.getsize(writer.journal_path))
+        writer._journal.close()
+
+    def test_full_queue_inserts_immediately(self):
+        writer = SharedConnectionWriter(queue_size=1)
+        writer.submit(create_txn('1'))
+        writer.submit(create_txn('2'))
+        self.assertEquals(['2'], list(OrderTransaction.objects.values_list(
+            'order_number', flat=True)))
+
+    def test_journal_left_by_crashed_writer_is_replayed(self):
+        path = os.path.join(self.journal_dir, 'audit-1-abc.journal')
+        with open(path, 'w') as journal:
+            for i in range(3):
+                journal.write(json.dumps(
+                    audit._to_record(create_txn(str(i)))) + '\n')
+        writer = SharedConnectionWriter(journal_dir=self.journal_dir)
+        writer.start()
+        writer.stop()
+        self.assertEquals(3, OrderTransaction.objects.count())
+        self.assertFalse(os.path.exists(path))
+
+    def test_parsed_columns_are_kept_in_journal(self):
+        txn = create_txn('1')
+        txn.rx_date = datetime(2009, 6, 10, 22, 54, 32)
+        txn.amount_settled = Decimal('1.23')
+        txn.txn_id = 'a1b2c3d4e5f60718'
+        record = json.loads(json.dumps(audit._to_record(txn)))
+        SharedConnectionWriter()._insert([record])
+        txn = OrderTransaction.objects.get(order_number='1')
+        self.assertEquals(datetime(2009, 6, 10, 22, 54, 32), txn.rx_date)
+        self.assertEquals(Decimal('1.23'), txn.amount_settled)
+        self.assertEquals('a1b2c3d4e5f60718', txn.txn_id)
+
+    def test_failed_insert_is_kept_in_journal(self):
+        writer = SharedConnectionWriter(journal_dir=self.journal_dir,
+                             flush_interval=0.01)
+        writer.start()
+        with patch.object(writer, '_insert', side_effect=Exception):
+            writer.submit(create_txn('1'))
+            writer.flush()
+            writer.stop()
+        self.assertEquals(1, len(os.listdir(self.journal_dir)))
+
+        writer = SharedConnectionWriter(journal_dir=self.journal_dir)
+        writer.start()
+        writer.stop()
+        self.assertEquals(1, OrderTransaction.objects.count())
+
+    def test_failed_insert_is_retried(self):
+        writer = SharedConnectionWriter(journal_dir=self.journal_dir,
+                                        flush_interval=0.01)
+        writer.start()
+        with patch.object(writer, '_insert',
+                          side_effect=fail_once(writer._insert)):
+            writer.submit(create_txn('1'))
+            # The journal is emptied just after the row is inserted
+            wait_for(lambda: OrderTransaction.objects.count() and
+                     not os.path.getsize(writer.journal_path))
+        self.assertEquals(1, OrderTransaction.objects.count())
+        self.assertEquals(0, os.path.getsize(writer.journal_path))
+        writer.stop()
+        self.assertEquals([], os.listdir(self.journal_dir))
+
+    def test_journal_keeps_only_failed_rows(self):
+        writer = SharedConnectionWriter(journal_dir=self.journal_dir,
+                                        flush_interval=0.01)
+        writer.start()
+        with patch.object(writer, '_insert',
+                          side_effect=fail_for('1', writer._insert)):
+            writer.submit(create_txn('1'))
+            writer.flush()
+            writer.submit(create_txn('2'))
+            writer.flush()
+            writer.stop()
+        with open(writer.journal_path) as journal:
+            self.assertEquals(['1'], [json.loads(line)['order_number']
+                                      for line in journal])
+
+        writer = SharedConnectionWriter(journal_dir=self.journal_dir)
+        writer.start()
+        writer.stop()
+        self.assertEquals(['1', '2'], sorted(
+            OrderTransaction.objects.values_list('order_number', flat=True)))
+
+
+class DeferredAuditFacadeTests(TransactionTestCase):
+
+    def test_facade_hands_transaction_to_writer(self):
+        writer = SharedConnectionWriter()
+        with patch('requests.Session.post') as post, \
+                patch('paymentexpress.facade.get_audit_writer',
+                      return_value=writer), \
+                self.settings(PAYMENTEXPRESS_DEFERRED_AUDIT=True):
+            post.return_value = Mock(status_code=200,
+                                     content=SAMPLE_SUCCESSFUL_RESPONSE)
+            Facade().complete('4000', 1.23, '000000030884cdc6')
+            self.assertEquals(0, OrderTransaction.objects.count())
+            writer.start()
+            writer.stop()
+        self.assertEquals(1, OrderTransaction.objects.filter(
+            order_number='4000').count())
@@ -0,0 +1,75 @@
+from datetime import datetime
+
+from django.test import TestCase
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+from paymentexpress.backfill import backfill, pk_ranges, pending_transactions
+from paymentexpress.management.commands.backfill_response_columns import (
+    Command)
+from paymentexpress.models import OrderTransaction
+from tests import (SAMPLE_PURCHASE_REQUEST, SAMPLE_SUCCESSFUL_RESPONSE,
+                   SAMPLE_ERROR_RESPONSE)
+
+
+def create_txn(order_number, response_xml=SAMPLE_SUCCESSFUL_RESPONSE):
+    # As recorded before the response columns were added
+    return OrderTransaction.objects.create(
+        order_number=order_number, txn_type='Purchase',
+        txn_ref='0000000600fdd28e', amount='1.23', response_code='00',
+        response_message='Approved', request_xml=SAMPLE_PURCHASE_REQUEST,
+        response_xml=response_xml)
+
+
+class BackfillTests(TestCase):
+
+    def test_ranges_cover_every_key(self):
+        pks = [create_txn(str(i)).pk for i in range(5)]
+        ranges = pk_ranges(OrderTransaction.objects.all(), 2)
+        self.assertEquals(3, len(ranges))
+        self.assertEquals(pks[0], ranges[0][0])
+        self.assertEquals(pks[-1] + 1, ranges[-1][1])
+        self.assertEquals([], pk_ranges(OrderTransaction.objects.none()))
+
+    def test_pending_transactions_are_filled_in(self):
+        for i in range(5):
+            create_txn(str(i))
+        create_txn('broken', '<Txn><Transaction')
+        counts = list(backfill(chunk_size=2))
+        self.assertEquals((6, 5), tuple(map(sum, zip(*counts))))
+        txn = OrderTransaction.objects.get(order_number='3')
+        self.assertEquals('105430', txn.auth_code)
+        self.assertEquals(datetime(2009, 6, 10, 22, 54, 32), txn.rx_date)
+        self.assertEquals(['broken'], list(pending_transactions().values_list(
+            'order_number', flat=True)))
+
+    def test_filled_in_transactions_are_skipped(self):
+        create_txn('1')
+        list(backfill())
+        self.assertEquals([], list(backfill()))
+        self.assertEquals([(1, 1)], list(backfill(refill=True)))
+
+    def test_replies_without_an_rx_date_are_filled_in_once(self):
+        create_txn('1', SAMPLE_ERROR_RESPONSE.replace(
+            '<RxDate>20120808054120</RxDate>', '<RxDate></RxDate>'))
+        create_txn('2', '')
+        self.assertEquals([(2, 1)], list(backfill()))
+        self.assertEquals([], list(backfill()))
+
+    def test_non_ascii_replies_are_filled_in(self):
+        create_txn('1', u'%s' % SAMPLE_SUCCESSFUL_RESPONSE.replace(
+            'Test Transaction', u'Caf\xe9'))
+        self.assertEquals([(1, 1)], list(backfill()))
+        self.assertEquals(u'Caf\xe9', OrderTransaction.objects.get(
+            order_number='1').merchant_reference)
+
+    def test_command_reports_progress(self):
+        create_txn('1')
+        command = Command()
+        command.stderr = StringIO()
+        command.handle(chunk_size=10, processes=1)
+        self.assertIn('1 rows', command.stderr.getvalue())
+        self.assertIn('1 updated', command.stderr.getvalue())
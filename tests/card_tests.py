@@ -0,0 +1,120 @@
+from datetime import date
+
+from django.test import TestCase
+from mock import patch
+
+from paymentexpress import cards
+from paymentexpress.cards import InvalidCard, check_card
+from paymentexpress.facade import Facade
+from paymentexpress.gateway import Gateway
+from paymentexpress.models import OrderTransaction
+from tests import CARD_VISA, CARD_MASTERCARD, CARD_AMEX, CARD_DINERS
+
+from oscar.apps.payment.exceptions import UnableToTakePayment
+from oscar.apps.payment.utils import Bankcard
+
+TODAY = date(2015, 10, 20)
+
+UNIONPAY = '6212345678901232'
+
+
+class CardTests(TestCase):
+
+    def test_card_types_are_detected(self):
+        self.assertEquals(cards.VISA, cards.get_card_type(CARD_VISA))
+        self.assertEquals(cards.MASTERCARD,
+                          cards.get_card_type(CARD_MASTERCARD))
+        self.assertEquals(cards.MASTERCARD,
+                          cards.get_card_type('2221000000000009'))
+        self.assertEquals(cards.AMEX, cards.get_card_type(CARD_AMEX))
+        self.assertEquals(cards.DINERS, cards.get_card_type(CARD_DINERS))
+        self.assertEquals(cards.UNKNOWN, cards.get_card_type('9999'))
+
+    def test_fingerprint_does_not_contain_card_number(self):
+        fingerprint = cards.get_fingerprint('4111 1111 1111 1111', '10/15')
+        self.assertEquals('Visa:1111:1015', fingerprint)
+        self.assertEquals(fingerprint,
+                          cards.get_fingerprint(CARD_VISA, '1015'))
+
+
+class CheckCardTests(TestCase):
+
+    def test_valid_cards_pass(self):
+        self.assertEquals(cards.VISA,
+                          check_card(CARD_VISA, '1015', '123', today=TODAY))
+        self.assertEquals(cards.AMEX,
+                          check_card(CARD_AMEX, '1215', '1234', today=TODAY))
+
+    def test_luhn_failures_are_rejected(self):
+        with self.assertRaises(InvalidCard):
+            check_card('4111111111111112')
+
+    def test_wrong_lengths_are_rejected(self):
+        with self.assertRaises(InvalidCard):
+            check_card('41111111111111111')
+
+    def test_expired_cards_are_rejected(self):
+        with self.assertRaises(InvalidCard):
+            check_card(CARD_VISA, '0915', today=TODAY)
+
+    def test_unsupported_schemes_are_rejected(self):
+        with self.assertRaises(InvalidCard):
+            check_card(CARD_DINERS, card_types=(cards.VISA,))
+        with self.assertRaises(InvalidCard):
+            check_card(UNIONPAY, card_types=(cards.VISA,))
+
+    def test_unknown_schemes_are_checked_loosely(self):
+        self.assertEquals(cards.UNKNOWN,
+                          check_card(UNIONPAY, '1015', '123', today=TODAY))
+        self.assertEquals(cards.UNKNOWN, check_card('6799990000000004',
+                                                    cvc='1234'))
+        for number in ('6212345678901233', '62123456789', '9' * 20):
+            with self.assertRaises(InvalidCard):
+                check_card(number)
+        with self.assertRaises(InvalidCard):
+            check_card(UNIONPAY, '0915', today=TODAY)
+
+    def test_non_ascii_digits_are_rejected(self):
+        for number in (u'\u0664111111111111111', u'\uff14' * 16):
+            with self.assertRaises(InvalidCard):
+                check_card(number)
+        self.assertFalse(cards.is_luhn_valid(u'\u0664\u0661\u0661'))
+        with self.assertRaises(InvalidCard):
+            check_card(CARD_VISA, cvc=u'\u0661\u0662\u0663')
+
+    def test_cvc_length_depends_on_scheme(self):
+        with self.assertRaises(InvalidCard):
+            check_card(CARD_AMEX, cvc='123')
+        with self.assertRaises(InvalidCard):
+            check_card(CARD_VISA, cvc='1234')
+
+
+class PreflightTests(TestCase):
+
+    def test_gateway_rejects_invalid_cards_before_sending(self):
+        gateway = Gateway('http://px.test/', 'user', 'pass', 'AUD')
+        with patch('requests.Session.post') as post:
+            with self.assertRaises(InvalidCard):
+                gateway.purchase(card_holder='Frankie',
+                                 card_number='4111111111111112',
+                                 card_expiry='1299', cvc2='123',
+                                 merchant_ref='1', enable_add_bill_card=1,
+                                 amount=1.23)
+        self.assertFalse(post.called)
+
+    def test_preflight_can_be_turned_off(self):
+        gateway = Gateway('http://px.test/', 'user', 'pass', 'AUD',
+                          preflight=False)
+        gateway._build_request(gateway.validate_spec, {
+            'card_holder': 'Frankie', 'card_number': '4111111111111112',
+            'card_expiry': '0115', 'cvc2': '123', 'amount': 1.00,
+            'enable_add_bill_card': 1})
+
+    def test_facade_raises_unable_to_take_payment(self):
+        card = Bankcard(card_number=CARD_VISA, expiry_date='01/15',
+                        name='Frankie', cvv='123')
+        with patch('requests.Session.post') as post:
+            with self.assertRaises(UnableToTakePayment):
+                Facade().purchase('1000', 1.23, bankcard=card)
+        self.assertFalse(post.called)
+        self.assertEquals(0, OrderTransaction.objects.count())
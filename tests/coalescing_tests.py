@@ -0,0 +1,190 @@
+import threading
+
+from django.core.cache.backends.locmem import LocMemCache
+from django.test import TestCase
+from mock import Mock, patch
+
+from paymentexpress import instrumentation
+from paymentexpress.coalescing import Coalescer, CallPending, get_coalescer
+from paymentexpress.facade import Facade, TransactionPending
+from paymentexpress.gateway import PURCHASE
+from paymentexpress.policy import RetryPolicy, reset_policies
+from tests import SAMPLE_SUCCESSFUL_RESPONSE, SAMPLE_DECLINED_RESPONSE
+
+from oscar.apps.payment.exceptions import UnableToTakePayment
+
+
+class FacadeCoalescingTests(TestCase):
+
+    def setUp(self):
+        reset_policies()
+        self.facade = Facade()
+
+    def tearDown(self):
+        get_coalescer().clear()
+
+    def test_concurrent_identical_purchases_share_one_round_trip(self):
+        started, release = threading.Event(), threading.Event()
+        events = []
+        sink = instrumentation.CallbackSink(
+            lambda *event: events.append(event))
+
+        def post(*args, **kwargs):
+            started.set()
+            release.wait(5)
+            return Mock(status_code=200, content=SAMPLE_SUCCESSFUL_RESPONSE)
+
+        results = []
+
+        def purchase():
+            results.append(self.facade.purchase('6000', 1.23, 'abc123'))
+
+        instrumentation.add_sink(sink)
+        # The test database can't be written from other threads
+        recorder = patch.object(Facade, '_record_transaction')
+        recorder.start()
+        try:
+            with patch('requests.Session.post') as mocked:
+                mocked.side_effect = post
+                first = threading.Thread(target=purchase)
+                first.start()
+                started.wait(5)
+                second = threading.Thread(target=purchase)
+                second.start()
+                # Hold the first call until the second is waiting on it
+                while not any(event[1] == 'facade.coalesced'
+                              for event in events):
+                    second.join(0.01)
+                release.set()
+                first.join(5)
+                second.join(5)
+        finally:
+            recorder.stop()
+            instrumentation.remove_sink(sink)
+        self.assertEquals(1, mocked.call_count)
+        self.assertEquals(2, len(results))
+        self.assertEquals(results[0], results[1])
+
+    def test_waiting_on_a_hung_call_leaves_it_pending(self):
+        started, release = threading.Event(), threading.Event()
+        sent = []
+
+        def post(url, data, **kwargs):
+            sent.append(data)
+            started.set()
+            release.wait(5)
+            return Mock(status_code=200, content=SAMPLE_SUCCESSFUL_RESPONSE)
+
+        recorder = patch.object(Facade, '_record_transaction')
+        recorder.start()
+        try:
+            with patch('requests.Session.post') as mocked:
+                mocked.side_effect = post
+                first = threading.Thread(
+                    target=self.facade.purchase,
+                    args=('6002', 1.23, 'abc123'))
+                first.start()
+                started.wait(5)
+                try:
+                    with patch.object(RetryPolicy, 'max_duration', 0.01):
+                        with self.assertRaises(TransactionPending) as cm:
+                            self.facade.purchase('6002', 1.23, 'abc123')
+                finally:
+                    release.set()
+                    first.join(5)
+        finally:
+            recorder.stop()
+        self.assertEquals(1, mocked.call_count)
+        self.assertTrue(cm.exception.txn_id)
+        self.assertTrue(
+            ('<TxnId>%s</TxnId>' % cm.exception.txn_id).encode('utf-8')
+            in sent[0])
+
+    def test_resubmit_gets_recent_result(self):
+        with patch('requests.Session.post') as post:
+            post.return_value = Mock(status_code=200,
+                                     content=SAMPLE_SUCCESSFUL_RESPONSE)
+            first = self.facade.purchase('6001', 1.23, 'abc123')
+            second = Facade().purchase('6001', 1.23, 'abc123')
+            self.facade.purchase('6001', 4.56, 'abc123')
+        self.assertEquals(first, second)
+        self.assertEquals(2, post.call_count)
+
+    def test_declines_are_not_reused(self):
+        with patch('requests.Session.post') as post:
+            post.return_value = Mock(status_code=200,
+                                     content=SAMPLE_DECLINED_RESPONSE)
+            for attempt in range(2):
+                with self.assertRaises(UnableToTakePayment):
+                    self.facade.purchase('6002', 1.23, 'abc123')
+        self.assertEquals(2, post.call_count)
+
+    def test_can_be_switched_off(self):
+        with self.settings(PAYMENTEXPRESS_COALESCE=False):
+            facade = Facade()
+            with patch('requests.Session.post') as post:
+                post.return_value = Mock(status_code=200,
+                                         content=SAMPLE_SUCCESSFUL_RESPONSE)
+                facade.purchase('6003', 1.23, 'abc123')
+                facade.purchase('6003', 1.23, 'abc123')
+        self.assertIsNone(facade.coalescer)
+        self.assertEquals(2, post.call_count)
+
+    def test_resubmit_after_pending_call_is_left_pending(self):
+        patcher = patch.object(self.facade.gateway, 'policy',
+                               RetryPolicy(max_retries=0, backoff=0))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        with patch('requests.Session.post') as post:
+            post.return_value = Mock(status_code=200, content='')
+            with self.assertRaises(TransactionPending) as first:
+                self.facade.purchase('6004', 1.23, 'abc123')
+            with self.assertRaises(TransactionPending) as second:
+                self.facade.purchase('6004', 1.23, 'abc123')
+        # The purchase and its status lookup
+        self.assertEquals(2, post.call_count)
+        self.assertEquals(first.exception.txn_id, second.exception.txn_id)
+
+
+class SharedCacheTests(TestCase):
+
+    key = (None, None, '7000', PURCHASE, '1.23')
+
+    def setUp(self):
+        self.cache = LocMemCache('paymentexpress-coalescing-tests', {})
+        self.cache.clear()
+
+    def test_result_is_shared_between_processes(self):
+        Coalescer(cache=self.cache).run(self.key, lambda: {'a': 1})
+        func = Mock()
+        self.assertEquals({'a': 1},
+                          Coalescer(cache=self.cache).run(self.key, func))
+        self.assertFalse(func.called)
+
+    def test_waiting_on_another_process_times_out(self):
+        coalescer = Coalescer(cache=self.cache, wait_timeout=0.05,
+                              poll_interval=0.01)
+        self.cache.add(coalescer._get_cache_keys(self.key)[1],
+                       ('abc', False))
+        with self.assertRaises(CallPending) as cm:
+            coalescer.run(self.key, Mock())
+        self.assertEquals('abc', cm.exception.txn_id)
+
+    def test_pending_call_is_not_sent_again_by_another_process(self):
+        def pending():
+            raise TransactionPending("Unknown", 'abc')
+
+        with self.assertRaises(TransactionPending):
+            Coalescer(cache=self.cache).run(self.key, pending, txn_id='abc')
+        func = Mock()
+        with self.assertRaises(CallPending) as cm:
+            Coalescer(cache=self.cache).run(self.key, func)
+        self.assertEquals('abc', cm.exception.txn_id)
+        self.assertFalse(func.called)
+
+    def test_failed_call_can_be_sent_again_by_another_process(self):
+        with self.assertRaises(UnableToTakePayment):
+            Coalescer(cache=self.cache).run(
+                self.key, Mock(side_effect=UnableToTakePayment()))
+        self.assertEquals({'a': 1}, Coalescer(cache=self.cache).run(
+            self.key, lambda: {'a': 1}))
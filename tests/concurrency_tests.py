@@ -0,0 +1,38 @@
+import itertools
+import threading
+
+from django.test import TestCase
+
+from paymentexpress.concurrency import bounded_map
+
+
+class BoundedMapTests(TestCase):
+
+    def test_results_are_returned_in_input_order(self):
+        results = list(bounded_map(lambda x: x * 2, range(50), 4))
+        self.assertEquals(list(range(50)), [item for item, _, _ in results])
+        self.assertEquals([x * 2 for x in range(50)],
+                          [result for _, result, _ in results])
+
+    def test_exceptions_are_returned_not_raised(self):
+        def func(x):
+            if x == 2:
+                raise ValueError(x)
+            return x
+        results = list(bounded_map(func, range(4), 2))
+        self.assertIsInstance(results[2][2], ValueError)
+        self.assertIsNone(results[3][2])
+
+    def test_iterable_is_consumed_lazily(self):
+        consumed = itertools.count()
+        lock = threading.Lock()
+
+        def items():
+            for i in range(1000):
+                with lock:
+                    next(consumed)
+                yield i
+
+        results = bounded_map(lambda x: x, items(), 2)
+        next(results)
+        self.assertTrue(next(consumed) <= 6)
@@ -1,9 +1,16 @@
+import os
+from datetime import datetime
+from decimal import Decimal
+
 from django.test import TestCase
 from mock import Mock, patch
+from requests.exceptions import ConnectTimeout, ReadTimeout
 
-from paymentexpress.facade import Facade
+from paymentexpress.coalescing import get_coalescer
+from paymentexpress.facade import Facade, TransactionPending
 from paymentexpress.gateway import AUTH, PURCHASE
 from paymentexpress.models import OrderTransaction
+from paymentexpress.policy import RetryPolicy, reset_policies
 from tests import (XmlTestingMixin, CARD_VISA, SAMPLE_SUCCESSFUL_RESPONSE,
                    SAMPLE_DECLINED_RESPONSE, SAMPLE_ERROR_RESPONSE)
 
@@ -14,6 +21,13 @@ from oscar.apps.payment.exceptions import (UnableToTakePayment,
 
 class MockedResponseTestCase(TestCase):
 
+    def setUp(self):
+        reset_policies()
+
+    def tearDown(self):
+        # Successful results are handed to identical calls for a while
+        get_coalescer().clear()
+
     def create_mock_response(self, body, status_code=200):
         response = Mock()
         response.content = body
@@ -25,11 +39,12 @@ class MockedResponseTestCase(TestCase):
 class FacadeTests(TestCase, XmlTestingMixin):
 
     def setUp(self):
+        reset_policies()
         self.facade = Facade()
 
     def test_zero_amount_raises_exception(self):
         card = Bankcard(card_number=CARD_VISA,
-                        expiry_date='1015',
+                        expiry_date='1299',
                         name="Frankie", cvv="123",
                         start_date="1010")
         with self.assertRaises(UnableToTakePayment):
@@ -53,7 +68,35 @@ class FacadeTests(TestCase, XmlTestingMixin):
 
     def test_merchant_reference_format(self):
         merchant_ref = self.facade._get_merchant_reference('1000', AUTH)
-        self.assertRegexpMatches(merchant_ref, r'^\d+_[A-Z]+_\d+_\d{4}$')
+        self.assertRegexpMatches(merchant_ref,
+                                 r'^\d+_[A-Z]+_\d+_[0-9a-f]{8}$')
+
+    def test_merchant_reference_token_is_drawn_per_process(self):
+        token = self.facade._get_merchant_reference('1000', AUTH).split(
+            '_')[3]
+        with patch('os.getpid', return_value=os.getpid() + 1):
+            other = self.facade._get_merchant_reference('1000', AUTH).split(
+                '_')[3]
+        self.assertNotEquals(token, other)
+
+    def test_merchant_reference_does_not_query_database(self):
+        with self.assertNumQueries(0):
+            self.facade._get_merchant_reference('1000', AUTH)
+
+    def test_merchant_references_are_unique_and_increasing(self):
+        refs = [self.facade._get_merchant_reference('1000', AUTH)
+                for i in range(1000)]
+        sequences = [int(ref.split('_')[2]) for ref in refs]
+        self.assertEquals(sorted(set(sequences)), sequences)
+
+    def test_legacy_merchant_reference_counts_previous_transactions(self):
+        OrderTransaction.objects.create(order_number='1000', txn_type=AUTH,
+                                        request_xml='', response_xml='')
+        with self.settings(PAYMENTEXPRESS_LEGACY_MERCHANT_REFERENCE=True):
+            with self.assertNumQueries(1):
+                merchant_ref = self.facade._get_merchant_reference('1000',
+                                                                   AUTH)
+        self.assertRegexpMatches(merchant_ref, r'^1000_AUTH_2_\d{4}$')
 
 
 class FacadeSuccessfulResponseTests(MockedResponseTestCase):
@@ -62,14 +105,15 @@ class FacadeSuccessfulResponseTests(MockedResponseTestCase):
     dps_billing_id = '0000080023225598'
 
     def setUp(self):
+        super(FacadeSuccessfulResponseTests, self).setUp()
         self.facade = Facade()
         self.card = Bankcard(card_number=CARD_VISA,
-                             expiry_date='1015',
+                             expiry_date='1299',
                              name="Frankie", cvv="123",
                              start_date="1010")
 
     def test_successful_call_returns_valid_dict(self):
-        with patch('requests.post') as post:
+        with patch('requests.Session.post') as post:
             post.return_value = self.create_mock_response(
                 SAMPLE_SUCCESSFUL_RESPONSE)
 
@@ -88,7 +132,7 @@ class FacadeSuccessfulResponseTests(MockedResponseTestCase):
                     response_dict['partner_reference'])
 
     def test_purchase_with_billing_id_returns_valid_dict(self):
-        with patch('requests.post') as post:
+        with patch('requests.Session.post') as post:
             post.return_value = self.create_mock_response(
                 SAMPLE_SUCCESSFUL_RESPONSE)
 
@@ -96,26 +140,40 @@ class FacadeSuccessfulResponseTests(MockedResponseTestCase):
             self.assertEquals(self.dps_txn_ref, txn_ref['txn_reference'])
 
     def test_purchase_with_bankcard_returns_valid_dict(self):
-        with patch('requests.post') as post:
+        with patch('requests.Session.post') as post:
             post.return_value = self.create_mock_response(
                 SAMPLE_SUCCESSFUL_RESPONSE)
             txn_ref = self.facade.purchase('1000', 1.23, None, self.card)
             self.assertEquals(self.dps_txn_ref, txn_ref['txn_reference'])
 
     def test_successful_call_is_recorded(self):
-        with patch('requests.post') as post:
+        with patch('requests.Session.post') as post:
             post.return_value = self.create_mock_response(
                 SAMPLE_SUCCESSFUL_RESPONSE)
             self.facade.authorise('10001', 10.25, self.card)
             txn = OrderTransaction.objects.filter(order_number='10001')[0]
             self.assertEquals(AUTH, txn.txn_type)
 
+    def test_parsed_response_fields_are_recorded(self):
+        with patch('requests.Session.post') as post:
+            post.return_value = self.create_mock_response(
+                SAMPLE_SUCCESSFUL_RESPONSE)
+            self.facade.complete('10002', 1.23, self.dps_txn_ref)
+        txn = OrderTransaction.objects.get(order_number='10002')
+        self.assertEquals('105430', txn.auth_code)
+        self.assertEquals('Visa', txn.card_name)
+        self.assertEquals('411111........11', txn.card_number)
+        self.assertEquals('Test Transaction', txn.merchant_reference)
+        self.assertEquals(self.dps_billing_id, txn.dps_billing_id)
+        self.assertEquals(datetime(2009, 6, 10, 22, 54, 32), txn.rx_date)
+        self.assertEquals(Decimal('1.23'), txn.amount_settled)
+
     def test_empty_issue_date_is_allowed(self):
-        with patch('requests.post') as post:
+        with patch('requests.Session.post') as post:
             post.return_value = self.create_mock_response(
                 SAMPLE_SUCCESSFUL_RESPONSE)
             card = Bankcard(card_number=CARD_VISA,
-                            expiry_date='1015',
+                            expiry_date='1299',
                             name="Frankie", cvv="123")
             txn_ref = self.facade.authorise('1000', 1.23, card)
             self.assertEquals(self.dps_txn_ref, txn_ref['txn_reference'])
@@ -124,14 +182,15 @@ class FacadeSuccessfulResponseTests(MockedResponseTestCase):
 class FacadeDeclinedResponseTests(MockedResponseTestCase):
 
     def setUp(self):
+        super(FacadeDeclinedResponseTests, self).setUp()
         self.facade = Facade()
         self.card = Bankcard(card_number=CARD_VISA,
-                            expiry_date='1015',
+                            expiry_date='1299',
                             name="Frankie", cvv="123",
                             start_date="1010")
 
     def test_declined_call_raises_an_exception(self):
-        with patch('requests.post') as post:
+        with patch('requests.Session.post') as post:
             post.return_value = self.create_mock_response(
                 SAMPLE_DECLINED_RESPONSE)
 
@@ -154,7 +213,7 @@ class FacadeDeclinedResponseTests(MockedResponseTestCase):
                 self.facade.validate(self.card)
 
     def test_declined_call_is_recorded(self):
-        with patch('requests.post') as post:
+        with patch('requests.Session.post') as post:
             post.return_value = self.create_mock_response(
                 SAMPLE_DECLINED_RESPONSE)
             try:
@@ -169,15 +228,178 @@ class FacadeDeclinedResponseTests(MockedResponseTestCase):
 class FacadeErrorResponseTests(MockedResponseTestCase):
 
     def setUp(self):
+        super(FacadeErrorResponseTests, self).setUp()
         self.facade = Facade()
         self.card = Bankcard(card_number=CARD_VISA,
-                            expiry_date='1015',
+                            expiry_date='1299',
                             name="Frankie", cvv="123",
                             start_date="1010")
 
     def test_error_response_raises_invalid_gateway_request_exception(self):
-        with patch('requests.post') as post:
+        with patch('requests.Session.post') as post:
             post.return_value = self.create_mock_response(
                 SAMPLE_ERROR_RESPONSE)
             with self.assertRaises(InvalidGatewayRequestError):
                 self.facade.purchase('1000', 10.24, None, self.card)
+
+
+class FacadeBatchTests(MockedResponseTestCase):
+
+    def setUp(self):
+        super(FacadeBatchTests, self).setUp()
+        self.facade = Facade()
+
+    def test_complete_many_returns_outcome_per_item(self):
+        responses = {
+            '1': SAMPLE_SUCCESSFUL_RESPONSE,
+            '2': SAMPLE_DECLINED_RESPONSE,
+            '3': SAMPLE_ERROR_RESPONSE,
+        }
+
+        def post(url, body, **kwargs):
+            body = body.decode('utf-8')
+            ref = body.split('<DpsTxnRef>')[1].split('</DpsTxnRef>')[0]
+            return self.create_mock_response(responses[ref])
+
+        with patch('requests.Session.post', side_effect=post):
+            outcomes = self.facade.complete_many([
+                ('3000', 1.23, '1'),
+                ('3001', 0, '9'),
+                ('3002', 1.23, '2'),
+                ('3003', 1.23, '3'),
+            ], max_workers=2)
+
+        self.assertEquals(['3000', '3001', '3002', '3003'],
+                          [o.order_number for o in outcomes])
+        self.assertTrue(outcomes[0].is_successful())
+        self.assertEquals('000000030884cdc6',
+                          outcomes[0].result['txn_reference'])
+        self.assertIsInstance(outcomes[1].error, UnableToTakePayment)
+        self.assertIsInstance(outcomes[2].error, UnableToTakePayment)
+        self.assertIsInstance(outcomes[3].error,
+                              InvalidGatewayRequestError)
+
+    def test_complete_many_records_each_gateway_call_once(self):
+        with patch('requests.Session.post') as post:
+            post.return_value = self.create_mock_response(
+                SAMPLE_SUCCESSFUL_RESPONSE)
+            # One bulk insert for the XML and one for the transactions
+            with self.assertNumQueries(2):
+                self.facade.complete_many([('3100', 1.23, '1'),
+                                           ('3100', 1.23, '2'),
+                                           ('3101', 0, '3')])
+        txns = OrderTransaction.objects.filter(order_number='3100')
+        self.assertEquals(2, txns.count())
+        self.assertNotIn('<PostPassword>', txns[0].request_xml.replace(
+            '<PostPassword>XXX', ''))
+
+    def test_complete_many_counts_legacy_merchant_references(self):
+        with patch('requests.Session.post') as post, self.settings(
+                PAYMENTEXPRESS_LEGACY_MERCHANT_REFERENCE=True):
+            post.return_value = self.create_mock_response(
+                SAMPLE_SUCCESSFUL_RESPONSE)
+            with patch.object(self.facade, '_format_merchant_reference',
+                              wraps=self.facade._format_merchant_reference
+                              ) as format_ref:
+                self.facade.complete_many([('3200', 1.23, '1'),
+                                           ('3200', 1.23, '2')])
+        self.assertEquals([0, 1], [call[0][2]
+                                   for call in format_ref.call_args_list])
+
+
+STATUS_REQUIRED_RESPONSE = """<Txn><Transaction success="0" reco="">
+</Transaction><StatusRequired>1</StatusRequired></Txn>"""
+
+
+class FacadeStatusTests(MockedResponseTestCase):
+
+    def setUp(self):
+        super(FacadeStatusTests, self).setUp()
+        self.facade = Facade()
+        # A private policy, so that failures here don't trip the shared
+        # circuit breaker
+        patcher = patch.object(self.facade.gateway, 'policy',
+                               RetryPolicy(backoff=0))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def txn_types(self, post):
+        return [call[0][1].decode('utf-8').split('<TxnType>')[1]
+                .split('</TxnType>')[0] for call in post.call_args_list]
+
+    def test_charges_carry_a_txn_id(self):
+        with patch('requests.Session.post') as post:
+            post.return_value = self.create_mock_response(
+                SAMPLE_SUCCESSFUL_RESPONSE)
+            self.facade.complete('4000', 1.23, '1234')
+        body = post.call_args[0][1].decode('utf-8')
+        self.assertIn('<TxnId>', body)
+        self.assertEquals(
+            body.split('<TxnId>')[1].split('</TxnId>')[0],
+            OrderTransaction.objects.get(order_number='4000').txn_id)
+
+    def test_lost_reply_is_resolved_by_status_lookup(self):
+        with patch('requests.Session.post') as post:
+            post.side_effect = [
+                ReadTimeout(),
+                self.create_mock_response(SAMPLE_SUCCESSFUL_RESPONSE)]
+            result = self.facade.purchase('4001', 1.23, 'abc123')
+        self.assertEquals('000000030884cdc6', result['txn_reference'])
+        self.assertEquals(['Purchase', 'Status'], self.txn_types(post))
+        txn_ids = set(call[0][1].decode('utf-8').split('<TxnId>')[1]
+                      .split('</TxnId>')[0] for call in post.call_args_list)
+        self.assertEquals(1, len(txn_ids))
+        self.assertEquals(
+            txn_ids, set(OrderTransaction.objects.filter(
+                order_number='4001').values_list('txn_id', flat=True)))
+
+    def test_status_required_is_resolved_by_status_lookup(self):
+        with patch('requests.Session.post') as post:
+            post.side_effect = [
+                self.create_mock_response(STATUS_REQUIRED_RESPONSE),
+                self.create_mock_response(SAMPLE_SUCCESSFUL_RESPONSE)]
+            self.facade.complete('4002', 1.23, '1234')
+        self.assertEquals(['Complete', 'Status'], self.txn_types(post))
+
+    def test_connect_failure_is_not_looked_up(self):
+        with patch('requests.Session.post') as post:
+            post.side_effect = ConnectTimeout()
+            with self.assertRaises(ConnectTimeout):
+                self.facade.complete('4003', 1.23, '1234')
+        self.assertNotIn('Status', self.txn_types(post))
+
+    def test_unresolved_transaction_raises_pending(self):
+        with patch('requests.Session.post') as post:
+            post.return_value = self.create_mock_response(
+                STATUS_REQUIRED_RESPONSE)
+            with self.assertRaises(TransactionPending) as cm:
+                self.facade.complete('4004', 1.23, '1234')
+        self.assertEquals(16, len(cm.exception.txn_id))
+        self.assertFalse(
+            OrderTransaction.objects.filter(order_number='4004').exists())
+
+    def test_reconcile_records_resolved_transactions(self):
+        responses = {
+            'a': SAMPLE_SUCCESSFUL_RESPONSE,
+            'b': SAMPLE_DECLINED_RESPONSE,
+            'c': STATUS_REQUIRED_RESPONSE,
+        }
+
+        def post(url, body, **kwargs):
+            body = body.decode('utf-8')
+            txn_id = body.split('<TxnId>')[1].split('</TxnId>')[0]
+            return self.create_mock_response(responses[txn_id])
+
+        with patch('requests.Session.post', side_effect=post):
+            outcomes = self.facade.reconcile([
+                ('4100', PURCHASE, 1.23, 'a'),
+                ('4101', PURCHASE, 1.23, 'b'),
+                ('4102', PURCHASE, 1.23, 'c'),
+            ], max_workers=2)
+
+        self.assertEquals(['a', 'b', 'c'], [o.txn_id for o in outcomes])
+        self.assertTrue(outcomes[0].is_successful())
+        self.assertIsInstance(outcomes[1].error, UnableToTakePayment)
+        self.assertIsInstance(outcomes[2].error, TransactionPending)
+        self.assertEquals(2, OrderTransaction.objects.filter(
+            order_number__in=['4100', '4101', '4102']).count())
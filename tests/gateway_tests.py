@@ -1,17 +1,24 @@
 from django.test import TestCase
 from mock import patch, Mock
-from paymentexpress.gateway import Request, Response, Gateway, AUTH
+from paymentexpress.gateway import (Request, RequestSpec, Response, Gateway,
+                                    AUTH, PURCHASE, parse_response)
+from paymentexpress.policy import reset_policies
 from xml.dom.minidom import parseString, Document
 from tests import (XmlTestingMixin,
                    SAMPLE_PURCHASE_REQUEST,
                    SAMPLE_DECLINED_RESPONSE,
                    SAMPLE_SUCCESSFUL_RESPONSE,
+                   SAMPLE_ERROR_RESPONSE,
                    CARD_VISA,
+                   CARD_MASTERCARD,
                    )
 
 
 class MockedResponseTestCase(TestCase):
 
+    def setUp(self):
+        reset_policies()
+
     def create_mock_response(self, body, status_code=200):
         response = Mock()
         response.content = body
@@ -55,6 +62,36 @@ class RequestTests(XmlTestingMixin, TestCase):
         self.assertXmlElementEquals(doc, 's3cr3t', 'Txn.PostPassword')
 
 
+    def test_values_are_escaped(self):
+        r = Request('TangentSnowball', 's3cr3t', 'AUD', 'Auth', 12.3)
+        r.set_element('card_holder', 'Smith & <Jones> "Ltd"')
+        doc = parseString(r.request_xml)
+        self.assertXmlElementEquals(doc, 'Smith & <Jones> "Ltd"',
+                                    'Txn.CardHolderName')
+
+    def test_empty_values_are_written_as_empty_elements(self):
+        r = Request('TangentSnowball', 's3cr3t', 'AUD', 'Auth', 12.3)
+        r.set_element('card_issue_date', None)
+        self.assertIn('<DateStart/>', r.request_xml)
+
+    def test_elements_are_written_in_field_order(self):
+        r = Request('TangentSnowball', 's3cr3t', 'AUD', 'Auth', 12.3)
+        r.set_element('merchant_ref', 'abc123')
+        r.set_element('card_number', CARD_VISA)
+        doc = parseString(r.request_xml)
+        tags = [node.tagName for node in doc.documentElement.childNodes]
+        self.assertEquals(['PostUsername', 'PostPassword', 'Amount',
+                           'InputCurrency', 'TxnType', 'CardNumber',
+                           'MerchantReference'], tags)
+
+    def test_request_xml_is_cached_until_changed(self):
+        r = Request('TangentSnowball', 's3cr3t', 'AUD', 'Auth', 12.3)
+        self.assertIs(r.request_xml, r.request_xml)
+        r.set_element('card_holder', 'Frankie')
+        doc = parseString(r.request_xml)
+        self.assertXmlElementEquals(doc, 'Frankie', 'Txn.CardHolderName')
+
+
 class ResponseTests(TestCase):
 
     def test_is_successful_returns_false_on_empty_response(self):
@@ -98,6 +135,135 @@ class ResponseTests(TestCase):
         self.assertTrue(message is not None and message != '')
 
 
+class ResponseBytesTests(TestCase):
+
+    def test_reply_bytes_are_parsed_without_decoding(self):
+        r = Response('', SAMPLE_SUCCESSFUL_RESPONSE.encode('utf-8'))
+        self.assertTrue(r.is_successful())
+        self.assertEquals('000000030884cdc6', r['dps_txn_ref'])
+        self.assertIsNone(r._response_xml)
+        self.assertEquals(SAMPLE_SUCCESSFUL_RESPONSE, r.response_xml)
+
+    def test_declared_encoding_is_honoured(self):
+        reply = (u'<?xml version="1.0" encoding="ISO-8859-1"?><Txn>'
+                 u'<Transaction success="1" reco="00">'
+                 u'<CardHolderName>Ren\xe9e</CardHolderName>'
+                 u'</Transaction></Txn>')
+        r = Response('', reply.encode('iso-8859-1'))
+        self.assertEquals(u'Ren\xe9e', r['CardHolderName'])
+
+    def test_unknown_declared_encoding_is_read_as_latin_1(self):
+        reply = (u'<?xml version="1.0" encoding="x-unknown"?>'
+                 u'<Txn><CardHolderName>Ren\xe9e</CardHolderName></Txn>')
+        r = Response('', reply.encode('iso-8859-1'))
+        self.assertEquals(u'Ren\xe9e', r['CardHolderName'])
+        self.assertEquals(reply, r.response_xml)
+        self.assertIn(u'Ren\xe9e', r.response_xml)
+
+    def test_undeclared_latin_1_is_still_read(self):
+        reply = u'<Txn><CardHolderName>Ren\xe9e</CardHolderName></Txn>'
+        r = Response('', reply.encode('iso-8859-1'))
+        self.assertEquals(u'Ren\xe9e', r['CardHolderName'])
+
+    def test_empty_reply_bytes(self):
+        self.assertTrue(Response('', b'').is_empty())
+        self.assertTrue(Response('', b'<?xml version="1.0" ?>').is_empty())
+
+    def test_request_is_sent_as_utf_8_bytes(self):
+        r = Request('TangentSnowball', 's3cr3t', 'AUD', 'Auth', 12.3)
+        r.set_element('card_holder', u'Ren\xe9e')
+        self.assertEquals(r.request_xml.encode('utf-8'), r.request_bytes)
+        self.assertIs(r.request_bytes, r.request_bytes)
+        r.set_element('card_holder', u'Frankie')
+        self.assertIn(b'Frankie', r.request_bytes)
+
+
+class ParseResponseTests(TestCase):
+
+    def test_extracts_transaction_attributes_and_first_element_text(self):
+        attributes, texts = parse_response(SAMPLE_SUCCESSFUL_RESPONSE,
+                                           ['AuthCode', 'DpsTxnRef'])
+        self.assertEquals('00', attributes['reco'])
+        self.assertEquals('APPROVED', attributes['responseText'])
+        self.assertEquals('105430', texts['AuthCode'])
+        self.assertEquals('000000030884cdc6', texts['DpsTxnRef'])
+
+    def test_missing_and_empty_elements_are_blank(self):
+        _, texts = parse_response(SAMPLE_ERROR_RESPONSE,
+                                  ['AuthCode', 'NoSuchElement'])
+        self.assertEquals('', texts['AuthCode'])
+        self.assertEquals('', texts['NoSuchElement'])
+
+    def test_only_text_before_nested_elements_is_kept(self):
+        _, texts = parse_response(
+            '<Txn><HelpText>Help<Inner>x</Inner>more</HelpText></Txn>',
+            ['HelpText'])
+        self.assertEquals('Help', texts['HelpText'])
+
+    def test_stops_once_all_fields_are_found(self):
+        attributes, texts = parse_response(
+            '<Txn><Transaction reco="00"><AuthCode>1</AuthCode>'
+            '</Transaction><Broken></Txn>', ['AuthCode'])
+        self.assertEquals('1', texts['AuthCode'])
+
+    def test_honours_encoding_declaration(self):
+        _, texts = parse_response(
+            u'<?xml version="1.0" encoding="utf-8"?>'
+            u'<Txn><CardHolderName>Zo\xeb</CardHolderName></Txn>',
+            ['CardHolderName'])
+        self.assertEquals(u'Zo\xeb', texts['CardHolderName'])
+
+    def test_text_is_read_whatever_its_declaration(self):
+        _, texts = parse_response(
+            u'<?xml version="1.0" encoding="iso-8859-1"?>'
+            u'<Txn><CardHolderName>Zo\xeb \u20ac</CardHolderName></Txn>',
+            ['CardHolderName'])
+        self.assertEquals(u'Zo\xeb \u20ac', texts['CardHolderName'])
+
+    def test_response_data_has_every_mapped_key(self):
+        r = Response('', SAMPLE_DECLINED_RESPONSE)
+        self.assertEquals('05', r['response_code'])
+        self.assertEquals('DECLINED (05)', r['card_holder_response_text'])
+        self.assertEquals('000000080985f6b6', r['dps_txn_ref'])
+        self.assertEquals(0, r['success'])
+
+
+class LazyResponseTests(TestCase):
+
+    def test_response_has_no_instance_dict(self):
+        r = Response('', SAMPLE_SUCCESSFUL_RESPONSE)
+        self.assertFalse(hasattr(r, '__dict__'))
+
+    def test_nothing_is_parsed_until_first_access(self):
+        with patch('paymentexpress.gateway.parse_response',
+                   wraps=parse_response) as parse:
+            r = Response('', SAMPLE_SUCCESSFUL_RESPONSE)
+            self.assertFalse(parse.called)
+            self.assertTrue(r.is_successful())
+            r.is_declined()
+            r['dps_txn_ref']
+            self.assertEquals(1, parse.call_count)
+
+    def test_every_element_is_available(self):
+        r = Response('', SAMPLE_SUCCESSFUL_RESPONSE)
+        self.assertEquals('20090610225432', r['RxDate'])
+        self.assertEquals('Visa', r['CardName'])
+        self.assertEquals('1.23', r['Amount'])
+        self.assertEquals('BD43E619', r['TxnMac'])
+        self.assertEquals('', r['ProductId'])
+
+    def test_unknown_element_raises_key_error(self):
+        r = Response('', SAMPLE_SUCCESSFUL_RESPONSE)
+        with self.assertRaises(KeyError):
+            r['NoSuchElement']
+        self.assertIsNone(r.get('NoSuchElement'))
+
+    def test_get_returns_default_on_empty_response(self):
+        r = Response('', '')
+        self.assertEquals('x', r.get('dps_txn_ref', 'x'))
+        self.assertEquals('x', r.get('RxDate', 'x'))
+
+
 class SuccessfulResponseTests(TestCase):
 
     def setUp(self):
@@ -121,6 +287,7 @@ class SuccessfulResponseTests(TestCase):
 class ApiResponseTests(MockedResponseTestCase):
 
     def setUp(self):
+        super(ApiResponseTests, self).setUp()
         self.gateway = Gateway(
             post_url='https://sec.paymentexpress.com/pxpost.aspx',
             username='TestUsername',
@@ -128,7 +295,7 @@ class ApiResponseTests(MockedResponseTestCase):
             currency='AUD')
 
     def test_authorise_returns_response(self):
-        with patch('requests.post') as post:
+        with patch('requests.Session.post') as post:
             post.return_value = self.create_mock_response(
                 SAMPLE_SUCCESSFUL_RESPONSE
             )
@@ -140,7 +307,7 @@ class ApiResponseTests(MockedResponseTestCase):
             )
 
     def test_complete_returns_response(self):
-        with patch('requests.post') as post:
+        with patch('requests.Session.post') as post:
             post.return_value = self.create_mock_response(
                 SAMPLE_SUCCESSFUL_RESPONSE)
             self.assertIsInstance(
@@ -148,7 +315,7 @@ class ApiResponseTests(MockedResponseTestCase):
                 Response)
 
     def test_purchase_with_billing_id_returns_response(self):
-        with patch('requests.post') as post:
+        with patch('requests.Session.post') as post:
             post.return_value = self.create_mock_response(
                 SAMPLE_SUCCESSFUL_RESPONSE
             )
@@ -158,22 +325,78 @@ class ApiResponseTests(MockedResponseTestCase):
             )
 
     def test_purchase_with_bankcard_returns_response(self):
-        with patch('requests.post') as post:
+        with patch('requests.Session.post') as post:
             post.return_value = self.create_mock_response(
                 SAMPLE_SUCCESSFUL_RESPONSE
             )
             self.assertIsInstance(
                 self.gateway.purchase(card_holder='Frankie',
                                       card_number=CARD_VISA,
-                                      card_expiry='1015',
+                                      card_expiry='1299',
                                       cvc2='123',
                                       merchant_ref='abc123',
                                       enable_add_bill_card=1,
                                       amount=1.23), Response
                 )
 
+    def test_response_keeps_masked_request_only(self):
+        with patch('requests.Session.post') as post:
+            post.return_value = self.create_mock_response(
+                SAMPLE_SUCCESSFUL_RESPONSE)
+            response = self.gateway.authorise(card_holder='Frankie',
+                                              card_number=CARD_VISA,
+                                              cvc2='123',
+                                              amount=1.23)
+        self.assertIn(CARD_VISA, post.call_args[0][1].decode('utf-8'))
+        self.assertNotIn(CARD_VISA, response.request_xml)
+        self.assertNotIn('TestPassword', response.request_xml)
+
+    def test_complete_batch_returns_result_per_item_in_order(self):
+        with patch('requests.Session.post') as post:
+            post.return_value = self.create_mock_response(
+                SAMPLE_SUCCESSFUL_RESPONSE)
+            results = self.gateway.complete_batch([
+                {'dps_txn_ref': '1234', 'amount': 1.23},
+                {'dps_txn_ref': '1235'},
+                {'dps_txn_ref': '1236', 'amount': 4.56},
+            ], max_workers=2)
+        self.assertEquals(3, len(results))
+        self.assertIsInstance(results[0], Response)
+        self.assertIsInstance(results[1], ValueError)
+        self.assertIsInstance(results[2], Response)
+
+    def test_status_sends_txn_id_only(self):
+        with patch('requests.Session.post') as post:
+            post.return_value = self.create_mock_response(
+                SAMPLE_SUCCESSFUL_RESPONSE)
+            response = self.gateway.status(txn_id='abcdef0123456789')
+        body = post.call_args[0][1].decode('utf-8')
+        self.assertIsInstance(response, Response)
+        self.assertIn('<TxnType>Status</TxnType>', body)
+        self.assertIn('<TxnId>abcdef0123456789</TxnId>', body)
+        self.assertNotIn('<Amount', body)
+
+    def test_status_accepts_txn_ref(self):
+        with patch('requests.Session.post') as post:
+            post.return_value = self.create_mock_response(
+                SAMPLE_SUCCESSFUL_RESPONSE)
+            self.gateway.status(txn_ref='inv1278')
+        self.assertIn('<TxnId>inv1278</TxnId>', post.call_args[0][1].decode('utf-8'))
+
+    def test_status_requires_txn_id(self):
+        with self.assertRaises(ValueError):
+            self.gateway.status()
+
+    def test_status_batch_returns_result_per_item_in_order(self):
+        with patch('requests.Session.post') as post:
+            post.return_value = self.create_mock_response(
+                SAMPLE_SUCCESSFUL_RESPONSE)
+            results = self.gateway.status_batch(['a', 'b'], max_workers=2)
+        self.assertEquals(2, len(results))
+        self.assertTrue(all(isinstance(r, Response) for r in results))
+
     def test_refund_returns_response(self):
-        with patch('requests.post') as post:
+        with patch('requests.Session.post') as post:
             post.return_value = self.create_mock_response(
                 SAMPLE_SUCCESSFUL_RESPONSE
             )
@@ -184,7 +407,7 @@ class ApiResponseTests(MockedResponseTestCase):
                 )
 
     def test_validate_returns_response(self):
-        with patch('requests.post') as post:
+        with patch('requests.Session.post') as post:
             post.return_value = self.create_mock_response(
                 SAMPLE_SUCCESSFUL_RESPONSE
             )
@@ -192,7 +415,8 @@ class ApiResponseTests(MockedResponseTestCase):
                 self.gateway.validate(card_holder='Frankie',
                                       card_number=CARD_VISA,
                                       cvc2='123',
-                                      card_expiry='1015',
+                                      card_expiry='1299',
+                                      enable_add_bill_card=1,
                                       amount=1.23), Response
                 )
 
@@ -213,6 +437,7 @@ class GatewayTests(TestCase):
     gateway = None
 
     def setUp(self):
+        reset_policies()
         self.gateway = Gateway('http://localhost/', 'TangentSnowball',
             's3cr3t', 'AUD')
 
@@ -220,7 +445,7 @@ class GatewayTests(TestCase):
         with self.assertRaises(ValueError):
             self.gateway.authorise(
                 card_holder='Frankie',
-                card_number='5111222233334444',
+                card_number=CARD_MASTERCARD,
                 amount=1.23
             )
 
@@ -232,7 +457,7 @@ class GatewayTests(TestCase):
     def test_authorise_fields_set(self):
         self.gateway.authorise(
             card_holder='Frankie',
-            card_number='5111222233334444',
+            card_number=CARD_MASTERCARD,
             cvc2='123',
             amount=1.23
         )
@@ -268,13 +493,15 @@ class GatewayTests(TestCase):
         self.gateway.validate(card_holder="Frankie",
                               card_number=CARD_VISA,
                               cvc2="123",
-                              card_expiry="1015",
+                              card_expiry="1299",
+                              enable_add_bill_card=1,
                               amount=1.00)
         with self.assertRaises(ValueError):
             self.gateway.validate(card_holder="Frankie",
                                   card_number=CARD_VISA,
                                   cvc2="123",
-                                  card_expiry="10/15",
+                                  card_expiry="12/99",
+                                  enable_add_bill_card=1,
                                   amount=1.00)
 
     def test_currency_code_has_three_characters(self):
@@ -282,3 +509,47 @@ class GatewayTests(TestCase):
             's3cr3t', 'au')
         with self.assertRaises(ValueError):
             gateway.refund(dps_txn_ref="abc", merchant_ref="123", amount=1.23)
+
+    def test_get_request_leaves_required_keys_alone(self):
+        required_keys = ['card_holder']
+        self.gateway._get_request(AUTH, {'card_holder': 'Frankie',
+                                         'amount': 1.23}, required_keys)
+        self.assertEquals(['card_holder'], required_keys)
+
+
+class RequestSpecTests(TestCase):
+
+    def setUp(self):
+        self.spec = RequestSpec(PURCHASE, ['dps_billing_id'])
+
+    def test_amount_is_required_unless_excluded(self):
+        self.assertEquals(frozenset(['dps_billing_id', 'amount']),
+                          self.spec.required_keys)
+        spec = RequestSpec('Status', ['txn_id'], has_amount=False,
+                           has_currency=False)
+        self.assertEquals(frozenset(['username', 'password', 'txn_type',
+                                     'txn_id']), spec.request_keys)
+
+    def test_build_copies_only_spec_keys(self):
+        request = self.spec.build('user', 'pass', 'AUD', {
+            'dps_billing_id': '123', 'amount': 1.23, 'cvc2': '123'})
+        self.assertEquals({'username': 'user', 'password': 'pass',
+                           'currency': 'AUD', 'txn_type': PURCHASE,
+                           'dps_billing_id': '123', 'amount': 1.23},
+                          request.data)
+        self.assertIs(self.spec.request_keys, request.required_keys)
+
+    def test_build_checks_arguments(self):
+        with self.assertRaises(ValueError):
+            self.spec.build('user', 'pass', 'AUD', {'amount': 1.23})
+        with self.assertRaises(ValueError):
+            self.spec.build('user', 'pass', 'AUD', {
+                'dps_billing_id': '123', 'amount': 1.23,
+                'card_expiry': '13/15'})
+        with self.assertRaises(ValueError):
+            self.spec.build('user', 'pass', 'au', {
+                'dps_billing_id': '123', 'amount': 1.23})
+
+    def test_gateways_share_specs(self):
+        self.assertIs(Gateway('http://px.test/', 'a', 'b', 'AUD').refund_spec,
+                      Gateway('http://px.test/', 'c', 'd', 'NZD').refund_spec)
@@ -0,0 +1,118 @@
+from django.test import TestCase
+from mock import patch, Mock
+from requests.exceptions import ConnectTimeout
+
+from paymentexpress import instrumentation
+from paymentexpress.facade import Facade
+from paymentexpress.gateway import Gateway, PURCHASE
+from paymentexpress.policy import RetryPolicy
+from tests import SAMPLE_SUCCESSFUL_RESPONSE, SAMPLE_DECLINED_RESPONSE
+
+from oscar.apps.payment.exceptions import UnableToTakePayment
+
+
+class InstrumentationTestCase(TestCase):
+
+    def setUp(self):
+        self.events = []
+        self.sink = instrumentation.CallbackSink(
+            lambda *event: self.events.append(event))
+        instrumentation.add_sink(self.sink)
+
+    def tearDown(self):
+        instrumentation.remove_sink(self.sink)
+
+    def timings(self):
+        return [name for kind, name, value, tags in self.events
+                if kind == 'timing']
+
+    def counts(self):
+        return [(name, tags) for kind, name, value, tags in self.events
+                if kind == 'count']
+
+
+class GatewayInstrumentationTests(InstrumentationTestCase):
+
+    def setUp(self):
+        super(GatewayInstrumentationTests, self).setUp()
+        self.gateway = Gateway('http://px.test/', 'user', 'pass', 'AUD',
+                               policy=RetryPolicy(backoff=0))
+
+    def test_each_stage_is_timed(self):
+        with patch('requests.Session.post') as post:
+            post.return_value = Mock(status_code=200,
+                                     content=SAMPLE_SUCCESSFUL_RESPONSE)
+            self.gateway.purchase(dps_billing_id='123', amount=1.23)
+        self.assertEquals(['gateway.build', 'gateway.network',
+                           'gateway.parse'], self.timings())
+
+    def test_outcome_is_counted_by_txn_type_and_response_code(self):
+        with patch('requests.Session.post') as post:
+            post.return_value = Mock(status_code=200,
+                                     content=SAMPLE_DECLINED_RESPONSE)
+            self.gateway.purchase(dps_billing_id='123', amount=1.23)
+        self.assertEquals([('gateway.response', {
+            'txn_type': PURCHASE, 'outcome': 'declined',
+            'response_code': '05'})], self.counts())
+
+    def test_transport_errors_are_counted(self):
+        with patch('requests.Session.post') as post:
+            post.side_effect = ConnectTimeout()
+            with self.assertRaises(ConnectTimeout):
+                self.gateway.purchase(dps_billing_id='123', amount=1.23)
+        self.assertEquals('error', self.counts()[0][1]['outcome'])
+        # One network timing per attempt
+        self.assertEquals(3, self.timings().count('gateway.network'))
+
+
+class FacadeInstrumentationTests(InstrumentationTestCase):
+
+    def test_facade_call_and_persist_are_recorded(self):
+        with patch('requests.Session.post') as post:
+            post.return_value = Mock(status_code=200,
+                                     content=SAMPLE_DECLINED_RESPONSE)
+            with self.assertRaises(UnableToTakePayment):
+                Facade().purchase('5000', 1.23, 'abc123')
+        self.assertIn('facade.persist', self.timings())
+        self.assertEquals('facade.call', self.timings()[-1])
+        self.assertIn(('facade.response', {
+            'txn_type': PURCHASE, 'outcome': 'declined',
+            'response_code': '05'}), self.counts())
+
+
+class SinkTests(TestCase):
+
+    def test_statsd_sink_appends_tags_to_stat_name(self):
+        client = Mock()
+        sink = instrumentation.StatsdSink(client)
+        sink.increment('gateway.response', {'txn_type': PURCHASE,
+                                            'outcome': 'approved',
+                                            'response_code': '00'})
+        sink.timing('gateway.network', 0.25, {'txn_type': PURCHASE})
+        client.incr.assert_called_with(
+            'paymentexpress.gateway.response.Purchase.approved.00')
+        client.timing.assert_called_with(
+            'paymentexpress.gateway.network.Purchase', 250)
+
+    def test_signal_sink_sends_signals(self):
+        received = []
+
+        def receiver(sender, **kwargs):
+            received.append(kwargs['name'])
+
+        instrumentation.count_recorded.connect(receiver)
+        try:
+            instrumentation.SignalSink().increment('facade.response', {})
+        finally:
+            instrumentation.count_recorded.disconnect(receiver)
+        self.assertEquals(['facade.response'], received)
+
+    def test_responses_stay_unparsed_without_sinks(self):
+        gateway = Gateway('http://px.test/', 'user', 'pass', 'AUD',
+                          policy=RetryPolicy())
+        with patch('requests.Session.post') as post:
+            post.return_value = Mock(status_code=200,
+                                     content=SAMPLE_SUCCESSFUL_RESPONSE)
+            with patch('paymentexpress.gateway.parse_response') as parse:
+                gateway.complete(dps_txn_ref='1234', amount=1.23)
+        self.assertFalse(parse.called)
@@ -0,0 +1,39 @@
+from django.test import TestCase
+from xml.dom.minidom import parseString
+
+from paymentexpress.masking import mask_xml
+from tests import XmlTestingMixin, SAMPLE_PURCHASE_REQUEST
+
+
+class MaskXmlTests(TestCase, XmlTestingMixin):
+
+    def setUp(self):
+        self.doc = parseString(mask_xml(SAMPLE_PURCHASE_REQUEST))
+
+    def test_card_number_keeps_last_four_digits(self):
+        self.assertXmlElementEquals(self.doc, 'XXXXXXXXXXXX1111',
+                                    'Txn.CardNumber')
+
+    def test_cvc_password_and_expiry_are_masked(self):
+        self.assertXmlElementEquals(self.doc, 'XXX', 'Txn.Cvc2')
+        self.assertXmlElementEquals(self.doc, 'XXX', 'Txn.PostPassword')
+        self.assertXmlElementEquals(self.doc, 'XXXX', 'Txn.DateExpiry')
+
+    def test_track2_is_masked(self):
+        self.assertEquals('<Txn><Track2>XXX</Track2></Txn>',
+                          mask_xml('<Txn><Track2>;4111111111111111=1512'
+                                   '?</Track2></Txn>'))
+
+    def test_other_numbers_are_left_alone(self):
+        xml = ('<Txn><DpsBillingId>0000080023225598</DpsBillingId>'
+               '<MerchantReference>100000000000_AUTH</MerchantReference>'
+               '</Txn>')
+        self.assertEquals(xml, mask_xml(xml))
+
+    def test_masking_is_idempotent(self):
+        once = mask_xml(SAMPLE_PURCHASE_REQUEST)
+        self.assertEquals(once, mask_xml(once))
+
+    def test_empty_xml_is_returned_unchanged(self):
+        self.assertEquals('', mask_xml(''))
+        self.assertIsNone(mask_xml(None))
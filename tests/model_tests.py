@@ -1,9 +1,13 @@
+from datetime import datetime
+from decimal import Decimal
 from django.test import TestCase
 from tests import (XmlTestingMixin,
                    SAMPLE_PURCHASE_REQUEST,
-                   SAMPLE_SUCCESSFUL_RESPONSE)
+                   SAMPLE_SUCCESSFUL_RESPONSE,
+                   SAMPLE_DECLINED_RESPONSE)
 from xml.dom.minidom import parseString
-from paymentexpress.models import OrderTransaction
+from paymentexpress.gateway import Response
+from paymentexpress.models import OrderTransaction, OrderTransactionXml
 
 
 class TransactionModelTests(TestCase, XmlTestingMixin):
@@ -50,3 +54,74 @@ class TransactionModelTests(TestCase, XmlTestingMixin):
             str(self.txn.pretty_response_xml))
         self.assertTrue('\n\t<Transaction' in
             str(self.txn.pretty_response_xml))
+
+
+class TransactionXmlStorageTests(TestCase):
+
+    def create_txn(self):
+        return OrderTransaction.objects.create(
+            order_number=1001,
+            txn_type='Purchase',
+            txn_ref='0000000600fdd28e',
+            amount=1.23,
+            response_code='00',
+            response_message='The Transaction was approved',
+            request_xml=SAMPLE_PURCHASE_REQUEST,
+            response_xml=SAMPLE_SUCCESSFUL_RESPONSE)
+
+    def test_xml_is_stored_in_separate_table(self):
+        txn = self.create_txn()
+        self.assertEquals(1, OrderTransactionXml.objects.count())
+        txn = OrderTransaction.objects.get(pk=txn.pk)
+        self.assertEquals(SAMPLE_SUCCESSFUL_RESPONSE, txn.response_xml)
+        self.assertIn('<PostPassword>XXX</PostPassword>', txn.request_xml)
+
+    def test_xml_is_not_loaded_with_transaction(self):
+        txn = self.create_txn()
+        with self.assertNumQueries(1):
+            txn = OrderTransaction.objects.get(pk=txn.pk)
+            txn.txn_ref
+
+    def test_xml_is_not_stored_when_disabled(self):
+        with self.settings(PAYMENTEXPRESS_STORE_XML=False):
+            txn = self.create_txn()
+        self.assertEquals(0, OrderTransactionXml.objects.count())
+        txn = OrderTransaction.objects.get(pk=txn.pk)
+        self.assertEquals('', txn.request_xml)
+        self.assertEquals('', txn.pretty_response_xml)
+
+    def test_record_many_inserts_masked_transactions_and_xml(self):
+        txns = [OrderTransaction(order_number=str(i), txn_type='Purchase',
+                                 request_xml=SAMPLE_PURCHASE_REQUEST,
+                                 response_xml=SAMPLE_SUCCESSFUL_RESPONSE)
+                for i in range(3)]
+        with self.assertNumQueries(2):
+            OrderTransaction.objects.record_many(txns)
+        self.assertEquals(3, OrderTransaction.objects.count())
+        for xml in OrderTransactionXml.objects.all():
+            self.assertIn('<Cvc2>XXX</Cvc2>', xml.request_xml)
+
+
+class ResponseColumnsTests(TestCase):
+
+    def test_columns_are_read_from_response(self):
+        columns = OrderTransaction.response_columns(
+            Response('', SAMPLE_DECLINED_RESPONSE))
+        self.assertEquals('Visa', columns['card_name'])
+        self.assertEquals(datetime(2012, 8, 2, 5, 6, 25),
+                          columns['rx_date'])
+        self.assertEquals(Decimal('23.99'), columns['amount_settled'])
+
+    def test_empty_reply_has_no_columns(self):
+        self.assertEquals({}, OrderTransaction.response_columns(
+            Response('', '')))
+
+    def test_malformed_values_are_left_blank(self):
+        columns = OrderTransaction.response_columns(Response('', (
+            '<Txn><Transaction success="1"><RxDate>soon</RxDate>'
+            '<Amount>n/a</Amount><MerchantReference>%s</MerchantReference>'
+            '</Transaction></Txn>') % ('x' * 100)))
+        self.assertIsNone(columns['rx_date'])
+        self.assertIsNone(columns['amount_settled'])
+        self.assertEquals('x' * 64, columns['merchant_reference'])
+        self.assertEquals('', columns['auth_code'])
@@ -0,0 +1,224 @@
+from django.test import TestCase
+from mock import patch, Mock
+from requests.exceptions import ConnectTimeout, ReadTimeout
+
+from paymentexpress.facade import Facade
+from paymentexpress.gateway import Gateway, Response
+from paymentexpress.policy import (CircuitBreaker, CircuitOpenError,
+                                   RetryPolicy, ServerError, get_policy,
+                                   reset_policies)
+from tests import SAMPLE_SUCCESSFUL_RESPONSE
+
+RETRY_RESPONSE = """<Txn><Transaction success="0" reco="U9"></Transaction>
+<Retry>1</Retry><AllowRetry>1</AllowRetry></Txn>"""
+
+
+class CircuitBreakerTests(TestCase):
+
+    def test_opens_after_threshold_failures(self):
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30)
+        breaker.record_failure()
+        self.assertTrue(breaker.allow_request())
+        breaker.record_failure()
+        self.assertFalse(breaker.allow_request())
+
+    def test_success_resets_failure_count(self):
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30)
+        breaker.record_failure()
+        breaker.record_success()
+        breaker.record_failure()
+        self.assertTrue(breaker.allow_request())
+
+    def test_half_opens_after_reset_timeout(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30)
+        with patch('time.time') as now:
+            now.return_value = 1000
+            breaker.record_failure()
+            now.return_value = 1031
+            self.assertTrue(breaker.allow_request())
+            self.assertEquals(CircuitBreaker.HALF_OPEN, breaker.state)
+            # Only one trial request is let through
+            self.assertFalse(breaker.allow_request())
+
+    def test_failed_trial_reopens(self):
+        breaker = CircuitBreaker(failure_threshold=3, reset_timeout=30)
+        breaker.state = CircuitBreaker.HALF_OPEN
+        breaker.record_failure()
+        self.assertEquals(CircuitBreaker.OPEN, breaker.state)
+
+    def test_unsent_trial_lets_another_through(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30)
+        with patch('time.time') as now:
+            now.return_value = 1000
+            breaker.record_failure()
+            now.return_value = 1031
+            self.assertTrue(breaker.allow_request())
+            breaker.record_unsent()
+            self.assertTrue(breaker.allow_request())
+
+
+class GatewayRetryTests(TestCase):
+
+    def setUp(self):
+        self.policy = RetryPolicy(max_retries=2, backoff=0,
+                                  failure_threshold=5)
+        self.gateway = Gateway('http://px.test/', 'user', 'pass', 'AUD',
+                               policy=self.policy)
+
+    def mock_response(self, body):
+        return Mock(status_code=200, content=body)
+
+    def complete(self, **kwargs):
+        return self.gateway.complete(amount=1.23, dps_txn_ref='abc123',
+                                     **kwargs)
+
+    def test_timeout_is_passed_to_session(self):
+        with patch('requests.Session.post') as post:
+            post.return_value = self.mock_response(SAMPLE_SUCCESSFUL_RESPONSE)
+            self.complete()
+        self.assertEquals((5, 60), post.call_args[1]['timeout'])
+
+    def test_connect_failure_is_retried(self):
+        with patch('requests.Session.post') as post:
+            post.side_effect = [
+                ConnectTimeout(),
+                self.mock_response(SAMPLE_SUCCESSFUL_RESPONSE)]
+            response = self.complete()
+        self.assertTrue(response.is_successful())
+        self.assertEquals(2, post.call_count)
+
+    def test_read_timeout_is_not_retried_without_txn_id(self):
+        with patch('requests.Session.post') as post:
+            post.side_effect = ReadTimeout()
+            with self.assertRaises(ReadTimeout):
+                self.complete()
+        self.assertEquals(1, post.call_count)
+
+    def test_read_timeout_is_not_retried_for_charges(self):
+        with patch('requests.Session.post') as post:
+            post.side_effect = ReadTimeout()
+            with self.assertRaises(ReadTimeout):
+                self.complete(txn_id='abcdef0123456789')
+        self.assertEquals(1, post.call_count)
+
+    def test_empty_reply_is_not_retried_for_charges(self):
+        with patch('requests.Session.post') as post:
+            post.return_value = self.mock_response('')
+            self.assertTrue(
+                self.complete(txn_id='abcdef0123456789').is_empty())
+        self.assertEquals(1, post.call_count)
+
+    def test_read_timeout_is_retried_for_status_lookups(self):
+        with patch('requests.Session.post') as post:
+            post.side_effect = [
+                ReadTimeout(),
+                self.mock_response(SAMPLE_SUCCESSFUL_RESPONSE)]
+            response = self.gateway.status(txn_id='abcdef0123456789')
+        self.assertTrue(response.is_successful())
+        self.assertEquals(2, post.call_count)
+        self.assertIn('<TxnId>abcdef0123456789</TxnId>',
+                      post.call_args[0][1].decode('utf-8'))
+
+    def test_retries_are_limited(self):
+        with patch('requests.Session.post') as post:
+            post.side_effect = ConnectTimeout()
+            with self.assertRaises(ConnectTimeout):
+                self.complete()
+        self.assertEquals(3, post.call_count)
+
+    def test_retry_flag_is_honoured_with_txn_id(self):
+        with patch('requests.Session.post') as post:
+            post.side_effect = [
+                self.mock_response(RETRY_RESPONSE),
+                self.mock_response(SAMPLE_SUCCESSFUL_RESPONSE)]
+            response = self.complete(txn_id='abcdef0123456789')
+        self.assertTrue(response.is_successful())
+
+    def test_retry_flag_is_ignored_without_txn_id(self):
+        with patch('requests.Session.post') as post:
+            post.return_value = self.mock_response(RETRY_RESPONSE)
+            response = self.complete()
+        self.assertEquals(1, response['retry'])
+        self.assertEquals(1, post.call_count)
+
+    def test_open_circuit_fails_without_sending(self):
+        breaker = self.policy.get_breaker('http://px.test/')
+        for _ in range(5):
+            breaker.record_failure()
+        with patch('requests.Session.post') as post:
+            with self.assertRaises(CircuitOpenError):
+                self.complete()
+        self.assertFalse(post.called)
+
+    def test_empty_responses_count_as_failures(self):
+        with patch('requests.Session.post') as post:
+            post.return_value = self.mock_response('')
+            self.complete()
+        self.assertEquals(1, self.policy.get_breaker('http://px.test/')
+                          .failures)
+
+    def test_server_errors_count_as_failures(self):
+        with patch('requests.Session.post') as post:
+            post.return_value = Mock(status_code=503,
+                                     content=b'<html>Service Unavailable')
+            for _ in range(5):
+                with self.assertRaises(ServerError):
+                    self.complete()
+            with self.assertRaises(CircuitOpenError):
+                self.complete()
+        self.assertEquals(5, post.call_count)
+
+    def test_any_error_ends_half_open_trial(self):
+        breaker = self.policy.get_breaker('http://px.test/')
+        with patch('time.time') as now:
+            now.return_value = 1000
+            for _ in range(5):
+                breaker.record_failure()
+            now.return_value = 1031
+            with patch('requests.Session.post', side_effect=TypeError):
+                with self.assertRaises(TypeError):
+                    self.complete()
+            self.assertEquals(CircuitBreaker.OPEN, breaker.state)
+            now.return_value = 1062
+            with patch('requests.Session.post') as post:
+                post.return_value = self.mock_response(
+                    SAMPLE_SUCCESSFUL_RESPONSE)
+                self.assertTrue(self.complete().is_successful())
+        self.assertEquals(CircuitBreaker.CLOSED, breaker.state)
+
+
+class ResponseFlagTests(TestCase):
+
+    def test_flags_default_when_absent(self):
+        response = Response('', '<Txn><Transaction success="1"/></Txn>')
+        self.assertEquals(0, response['retry'])
+        self.assertEquals(None, response['allow_retry'])
+        self.assertEquals(0, response['status_required'])
+
+    def test_flags_are_read_as_integers(self):
+        response = Response('', RETRY_RESPONSE)
+        self.assertEquals(1, response['retry'])
+        self.assertEquals(1, response['allow_retry'])
+
+
+class FacadePolicyTests(TestCase):
+
+    def test_policy_settings_are_used_by_facade(self):
+        with self.settings(PAYMENTEXPRESS_CONNECT_TIMEOUT=2,
+                           PAYMENTEXPRESS_READ_TIMEOUT=20,
+                           PAYMENTEXPRESS_MAX_RETRIES=1,
+                           PAYMENTEXPRESS_MAX_RETRY_BACKOFF=3):
+            policy = Facade().gateway.policy
+        self.assertEquals((2, 20), policy.timeout)
+        self.assertEquals(1, policy.max_retries)
+        self.assertEquals(3, policy.max_backoff)
+
+    def test_shared_breakers_can_be_reset(self):
+        breaker = get_policy(failure_threshold=1).get_breaker('http://a/')
+        breaker.record_failure()
+        reset_policies()
+        self.assertTrue(get_policy(failure_threshold=1)
+                        .get_breaker('http://a/').allow_request())
+
+    def test_facades_share_a_policy(self):
+        self.assertIs(Facade().gateway.policy, Facade().gateway.policy)
@@ -0,0 +1,117 @@
+import shutil
+import tempfile
+
+from django.test import TestCase
+from mock import Mock, patch
+from requests.exceptions import ConnectTimeout
+
+from paymentexpress import instrumentation
+from paymentexpress.gateway import Gateway, PURCHASE, REFUND
+from paymentexpress.policy import RetryPolicy
+from paymentexpress.ratelimit import (FileTokenBucket, RateLimiter,
+                                      RateLimitExceeded, TokenBucket)
+from paymentexpress.registry import GatewayRegistry
+from tests import SAMPLE_SUCCESSFUL_RESPONSE
+
+
+class TokenBucketTests(TestCase):
+
+    def test_bursts_up_to_capacity_then_waits(self):
+        bucket = TokenBucket(10, 2)
+        self.assertEquals(0, bucket.try_acquire())
+        self.assertEquals(0, bucket.try_acquire())
+        wait = bucket.try_acquire()
+        self.assertTrue(0 < wait <= 0.1)
+
+    def test_file_buckets_share_state(self):
+        lock_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, lock_dir)
+        path = '%s/bucket' % lock_dir
+        first = FileTokenBucket(1, 1, path)
+        second = FileTokenBucket(1, 1, path)
+        self.assertEquals(0, first.try_acquire())
+        self.assertTrue(second.try_acquire() > 0)
+
+
+class RateLimiterTests(TestCase):
+
+    def test_limits_are_per_txn_type_with_fallback(self):
+        limiter = RateLimiter({PURCHASE: (1, 1), '*': (100, 1)})
+        self.assertIsNot(limiter.get_bucket(PURCHASE),
+                         limiter.get_bucket(REFUND))
+        self.assertIs(limiter.get_bucket(REFUND), limiter.get_bucket('Auth'))
+        self.assertIsNone(RateLimiter({PURCHASE: 1}).get_bucket(REFUND))
+
+    def test_callers_queue_for_a_token(self):
+        limiter = RateLimiter({'*': (50, 1)})
+        self.assertEquals(0, limiter.acquire(PURCHASE))
+        self.assertTrue(limiter.acquire(PURCHASE) > 0)
+
+    def test_wait_is_bounded(self):
+        limiter = RateLimiter({'*': (1, 1)}, max_wait=0.01)
+        limiter.acquire(PURCHASE)
+        with self.assertRaises(RateLimitExceeded):
+            limiter.acquire(PURCHASE)
+
+
+class GatewayRateLimitTests(TestCase):
+
+    def setUp(self):
+        self.gateway = Gateway('http://px.test/', 'user', 'pass', 'AUD',
+                               policy=RetryPolicy(backoff=0),
+                               limiter=RateLimiter({'*': (1, 1)},
+                                                   max_wait=0.01))
+
+    def test_limited_requests_are_not_sent(self):
+        with patch('requests.Session.post') as post:
+            post.return_value = Mock(status_code=200,
+                                     content=SAMPLE_SUCCESSFUL_RESPONSE)
+            self.gateway.complete(dps_txn_ref='1234', amount=1.23)
+            with self.assertRaises(RateLimitExceeded):
+                self.gateway.complete(dps_txn_ref='1234', amount=1.23)
+        self.assertEquals(1, post.call_count)
+
+    def test_retries_count_against_the_limit(self):
+        with patch('requests.Session.post') as post:
+            post.side_effect = [ConnectTimeout(),
+                                Mock(status_code=200,
+                                     content=SAMPLE_SUCCESSFUL_RESPONSE)]
+            with self.assertRaises(RateLimitExceeded):
+                self.gateway.complete(dps_txn_ref='1234', amount=1.23)
+        self.assertEquals(1, post.call_count)
+
+    def test_limited_requests_do_not_trip_the_breaker(self):
+        with patch('requests.Session.post') as post:
+            post.return_value = Mock(status_code=200,
+                                     content=SAMPLE_SUCCESSFUL_RESPONSE)
+            self.gateway.complete(dps_txn_ref='1234', amount=1.23)
+            for attempt in range(self.gateway.policy.failure_threshold):
+                with self.assertRaises(RateLimitExceeded):
+                    self.gateway.complete(dps_txn_ref='1234', amount=1.23)
+        breaker = self.gateway.policy.get_breaker('http://px.test/')
+        self.assertEquals(breaker.CLOSED, breaker.state)
+
+    def test_wait_is_timed(self):
+        events = []
+        sink = instrumentation.CallbackSink(
+            lambda *event: events.append(event))
+        instrumentation.add_sink(sink)
+        try:
+            with patch('requests.Session.post') as post:
+                post.return_value = Mock(status_code=200,
+                                         content=SAMPLE_SUCCESSFUL_RESPONSE)
+                self.gateway.complete(dps_txn_ref='1234', amount=1.23)
+        finally:
+            instrumentation.remove_sink(sink)
+        self.assertIn('gateway.rate_limit',
+                      [name for kind, name, value, tags in events])
+
+    def test_accounts_share_a_limiter_across_currencies(self):
+        registry = GatewayRegistry({'default': {
+            'POST_URL': 'http://px.test/', 'USERNAME': 'user',
+            'PASSWORD': 'pass', 'CURRENCIES': ['AUD', 'NZD'],
+            'RATE_LIMITS': {'*': 5},
+        }})
+        aud, nzd = registry.get_gateway(), registry.get_gateway(None, 'NZD')
+        self.assertIsNotNone(aud.limiter)
+        self.assertIs(aud.limiter, nzd.limiter)
@@ -0,0 +1,189 @@
+import os
+import shutil
+import tempfile
+import time
+from decimal import Decimal
+
+from django.test import TestCase
+from mock import Mock, patch
+from requests.exceptions import ReadTimeout
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+from paymentexpress.facade import Facade
+from paymentexpress.gateway import REFUND
+from paymentexpress.management.commands.bulk_refund import Command
+from paymentexpress.models import OrderTransaction
+from paymentexpress.policy import RetryPolicy, reset_policies
+from paymentexpress.refunds import (Throttle, generate_row_reference,
+                                    open_csv, parse_row, read_rows,
+                                    REFUNDED, DECLINED, FAILED, INVALID,
+                                    SKIPPED, PENDING)
+from tests import SAMPLE_SUCCESSFUL_RESPONSE, SAMPLE_DECLINED_RESPONSE
+
+INPUT = """order_number,amount,dps_txn_ref
+8000,1.23,0000000300000001
+
+8001,abc,0000000300000002
+8002,4.56,0000000300000003
+"""
+
+
+class CsvTests(TestCase):
+
+    def test_header_and_blank_rows_are_skipped(self):
+        rows = list(read_rows(StringIO(INPUT)))
+        self.assertEquals([2, 4, 5], [line for line, fields in rows])
+
+    def test_rows_are_parsed(self):
+        self.assertEquals(('8000', Decimal('1.23'), 'abc'),
+                          parse_row([' 8000', '1.230', 'abc ']))
+        for fields in (['8000', '1.23'], ['8000', 'x', 'abc'],
+                       ['8000', '0', 'abc'], ['', '1.23', 'abc']):
+            with self.assertRaises(ValueError):
+                parse_row(fields)
+
+    def test_row_references_identify_rows(self):
+        reference = generate_row_reference(u'8000', Decimal('1.23'), u'abc')
+        self.assertTrue(reference.startswith(u'8000_REFUND_'))
+        self.assertEquals(reference, generate_row_reference(
+            u'8000', Decimal('1.23'), u'abc', 1, u''))
+        for other in ((u'8000', Decimal('1.24'), u'abc', 1, u''),
+                      (u'8000', Decimal('1.23'), u'abd', 1, u''),
+                      (u'8000', Decimal('1.23'), u'abc', 2, u''),
+                      (u'8000', Decimal('1.23'), u'abc', 1, u'b')):
+            self.assertNotEquals(reference, generate_row_reference(*other))
+        self.assertEquals(64, len(generate_row_reference(
+            u'8' * 100, Decimal('1.23'), u'abc')))
+
+    def test_throttle_spaces_calls(self):
+        throttle = Throttle(100)
+        start = time.time()
+        for _ in range(4):
+            throttle.wait()
+        self.assertTrue(time.time() - start >= 0.025)
+
+
+class RefundManyTests(TestCase):
+
+    def setUp(self):
+        reset_policies()
+
+    def refund(self, body=SAMPLE_SUCCESSFUL_RESPONSE, input=INPUT,
+               side_effect=None, **kwargs):
+        with patch('requests.Session.post') as post:
+            post.return_value = Mock(status_code=200, content=body)
+            post.side_effect = side_effect
+            results = list(Facade().refund_many(
+                read_rows(StringIO(input)), max_workers=2, **kwargs))
+        return post, results
+
+    def txn_types(self, post):
+        return [call[0][1].decode('utf-8').split('<TxnType>')[1]
+                .split('</TxnType>')[0] for call in post.call_args_list]
+
+    def test_each_row_has_an_outcome_in_order(self):
+        post, results = self.refund()
+        self.assertEquals([(2, REFUNDED), (4, INVALID), (5, REFUNDED)],
+                          [(r.line, r.status) for r in results])
+        self.assertEquals(2, post.call_count)
+        self.assertEquals(2, OrderTransaction.objects.filter(
+            txn_type=REFUND).count())
+
+    def test_declines_are_reported(self):
+        post, results = self.refund(SAMPLE_DECLINED_RESPONSE)
+        self.assertEquals(DECLINED, results[0].status)
+        self.assertFalse(results[0].is_successful())
+
+    def test_recorded_refunds_are_skipped(self):
+        self.refund(input=INPUT.split('\n\n')[0])
+        post, results = self.refund()
+        self.assertEquals(SKIPPED, results[0].status)
+        self.assertEquals(1, post.call_count)
+        post, results = self.refund(resume=False)
+        self.assertEquals(REFUNDED, results[0].status)
+
+    def test_resumed_rows_are_matched_by_content(self):
+        self.refund(input='8002,4.56,0000000300000003\n'
+                          '8000,1.23,0000000300000001\n')
+        post, results = self.refund()
+        self.assertEquals([SKIPPED, INVALID, SKIPPED],
+                          [r.status for r in results])
+        self.assertFalse(post.called)
+        post, results = self.refund(batch=u'again')
+        self.assertEquals(2, post.call_count)
+
+    def test_other_errors_fail_without_a_pending_row(self):
+        post, results = self.refund(input=INPUT.split('\n\n')[0],
+                                    side_effect=ValueError('Bad'))
+        self.assertEquals(FAILED, results[0].status)
+        self.assertFalse(OrderTransaction.objects.exists())
+
+    def test_repeat_refunds_of_an_amount_are_sent(self):
+        OrderTransaction.objects.create(
+            order_number='8000', txn_type=REFUND, txn_ref='abc',
+            amount=Decimal('1.23'), response_code='00',
+            response_message='APPROVED')
+        post, results = self.refund(
+            input=INPUT + '8000,1.23,0000000300000001\n')
+        self.assertEquals([REFUNDED, INVALID, REFUNDED, REFUNDED],
+                          [r.status for r in results])
+        self.assertEquals(3, post.call_count)
+
+    def test_pending_refunds_are_looked_up_on_resume(self):
+        facade = Facade()
+        patcher = patch.object(facade.gateway, 'policy',
+                               RetryPolicy(max_retries=0, backoff=0))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        row = INPUT.split('\n\n')[0]
+        post, results = self.refund(
+            input=row, side_effect=[ReadTimeout(), ReadTimeout()])
+        self.assertEquals(PENDING, results[0].status)
+        self.assertEquals(['Refund', 'Status'], self.txn_types(post))
+        txn_id = post.call_args[0][1].decode('utf-8').split(
+            '<TxnId>')[1].split('</TxnId>')[0]
+        pending = OrderTransaction.objects.get(order_number='8000')
+        self.assertEquals(txn_id, pending.txn_id)
+        self.assertEquals('', pending.response_code)
+
+        post, results = self.refund(input=row)
+        self.assertEquals(REFUNDED, results[0].status)
+        self.assertEquals(['Status'], self.txn_types(post))
+        self.assertIn('<TxnId>%s</TxnId>' % txn_id,
+                      post.call_args[0][1].decode('utf-8'))
+
+        post, results = self.refund(input=row)
+        self.assertEquals(SKIPPED, results[0].status)
+        self.assertFalse(post.called)
+
+
+class BulkRefundCommandTests(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.input = os.path.join(self.dir, 'refunds.csv')
+        self.output = os.path.join(self.dir, 'results.csv')
+        with open_csv(self.input, 'w') as f:
+            f.write(INPUT)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_results_are_written_to_output(self):
+        command = Command()
+        command.stdout, command.stderr = StringIO(), StringIO()
+        with patch('requests.Session.post') as post:
+            post.return_value = Mock(status_code=200,
+                                     content=SAMPLE_SUCCESSFUL_RESPONSE)
+            command.handle(self.input, output=self.output, workers=2)
+        with open_csv(self.output) as f:
+            lines = f.read().splitlines()
+        self.assertEquals(4, len(lines))
+        self.assertTrue(lines[1].startswith('2,8000,1.23,'))
+        self.assertIn(',refunded,', lines[1])
+        self.assertIn(',invalid,', lines[2])
+        self.assertIn('2 refunded', command.stderr.getvalue())
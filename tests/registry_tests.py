@@ -0,0 +1,97 @@
+from django.core.exceptions import ImproperlyConfigured
+from django.test import TestCase
+from django.test.utils import override_settings
+from mock import Mock, patch
+
+from paymentexpress.coalescing import get_coalescer
+from paymentexpress.facade import Facade
+from paymentexpress.registry import GatewayRegistry, get_registry
+from tests import SAMPLE_SUCCESSFUL_RESPONSE
+
+ACCOUNTS = {
+    'default': {
+        'POST_URL': 'http://px.test/default',
+        'USERNAME': 'default-user',
+        'PASSWORD': 'default-pass',
+        'CURRENCIES': ['AUD', 'NZD'],
+    },
+    'outlet': {
+        'POST_URL': 'http://px.test/outlet',
+        'USERNAME': 'outlet-user',
+        'PASSWORD': 'outlet-pass',
+        'CURRENCIES': ['USD'],
+        'POOL_MAXSIZE': 4,
+    },
+}
+
+
+class GatewayRegistryTests(TestCase):
+
+    def setUp(self):
+        self.registry = GatewayRegistry(ACCOUNTS)
+
+    def test_defaults_to_first_currency_of_default_account(self):
+        gateway = self.registry.get_gateway()
+        self.assertEquals('http://px.test/default', gateway.post_url)
+        self.assertEquals('AUD', gateway.currency)
+
+    def test_gateway_per_account_and_currency(self):
+        nzd = self.registry.get_gateway(currency='NZD')
+        self.assertEquals('NZD', nzd.currency)
+        self.assertEquals('default-user', nzd.username)
+        outlet = self.registry.get_gateway('outlet')
+        self.assertEquals('USD', outlet.currency)
+        self.assertEquals('outlet-user', outlet.username)
+
+    def test_gateways_are_built_once(self):
+        self.assertIs(self.registry.get_gateway(),
+                      self.registry.get_gateway('default', 'AUD'))
+        self.assertIs(self.registry.get_gateway('outlet'),
+                      self.registry.get_gateway('outlet', 'USD'))
+
+    def test_unknown_account_or_currency_is_rejected(self):
+        with self.assertRaises(ValueError):
+            self.registry.get_gateway('missing')
+        with self.assertRaises(ValueError):
+            self.registry.get_gateway('outlet', 'AUD')
+
+    def test_incomplete_accounts_are_rejected(self):
+        with self.assertRaises(ImproperlyConfigured):
+            GatewayRegistry({'default': {'POST_URL': 'http://px.test/'}})
+        with self.assertRaises(ImproperlyConfigured):
+            GatewayRegistry(ACCOUNTS, 'missing')
+
+
+class FacadeRoutingTests(TestCase):
+
+    def tearDown(self):
+        get_coalescer().clear()
+
+    def purchase(self, **kwargs):
+        with patch('requests.Session.post') as post:
+            post.return_value = Mock(status_code=200,
+                                     content=SAMPLE_SUCCESSFUL_RESPONSE)
+            Facade().purchase('1000', 1.23, billing_id='abc123', **kwargs)
+        url, data = post.call_args[0]
+        return url, data.decode('utf-8')
+
+    @override_settings(PAYMENTEXPRESS_ACCOUNTS=ACCOUNTS)
+    def test_calls_are_routed_to_account_and_currency(self):
+        url, data = self.purchase(account='outlet')
+        self.assertEquals('http://px.test/outlet', url)
+        self.assertIn('<InputCurrency>USD</InputCurrency>', data)
+        url, data = self.purchase(currency='NZD')
+        self.assertEquals('http://px.test/default', url)
+        self.assertIn('<InputCurrency>NZD</InputCurrency>', data)
+
+    def test_legacy_settings_make_the_default_account(self):
+        url, data = self.purchase()
+        self.assertEquals(get_registry().get_gateway().post_url, url)
+        self.assertIn('<InputCurrency>AUD</InputCurrency>', data)
+
+    def test_registry_is_rebuilt_when_settings_change(self):
+        registry = get_registry()
+        with self.settings(PAYMENTEXPRESS_ACCOUNTS=ACCOUNTS):
+            self.assertIsNot(registry, get_registry())
+            self.assertEquals(['default', 'outlet'],
+                              sorted(get_registry().accounts))
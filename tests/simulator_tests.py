@@ -0,0 +1,87 @@
+from django.test import TestCase
+
+from paymentexpress.gateway import Gateway
+from paymentexpress.policy import RetryPolicy
+from paymentexpress.simulator import (SimulatorServer, Simulator,
+                                      parse_latency, parse_request)
+from tests import CARD_VISA, SAMPLE_PURCHASE_REQUEST
+
+
+class SimulatorTests(TestCase):
+
+    def setUp(self):
+        self.server = SimulatorServer()
+        self.server.start()
+        self.gateway = Gateway(self.server.url, 'user', 'pass', 'AUD',
+                               policy=RetryPolicy(max_retries=0))
+
+    def tearDown(self):
+        self.server.stop()
+
+    def purchase(self, **kwargs):
+        return self.gateway.purchase(card_holder='Frankie',
+                                     card_number=CARD_VISA,
+                                     card_expiry='1299',
+                                     cvc2='123',
+                                     merchant_ref='abc123',
+                                     enable_add_bill_card=1,
+                                     amount=1.23, **kwargs)
+
+    def test_purchase_is_approved_and_issues_billing_id(self):
+        response = self.purchase()
+        self.assertTrue(response.is_successful())
+        self.assertEquals('Visa', response['CardName'])
+        self.assertEquals('411111........11', response['CardNumber'])
+        self.assertEquals(16, len(response['dps_billing_id']))
+
+    def test_billing_id_can_be_charged(self):
+        billing_id = self.purchase()['dps_billing_id']
+        response = self.gateway.purchase(dps_billing_id=billing_id,
+                                         amount=4.56)
+        self.assertTrue(response.is_successful())
+        self.assertEquals('Frankie', response['CardHolderName'])
+
+    def test_unknown_billing_id_is_an_error(self):
+        response = self.gateway.purchase(dps_billing_id='0000000000000999',
+                                         amount=4.56)
+        self.assertFalse(response.is_successful())
+        self.assertFalse(response.is_declined())
+
+    def test_declines_at_configured_rate(self):
+        self.server.simulator.decline_rate = 1.0
+        response = self.purchase()
+        self.assertTrue(response.is_declined())
+
+    def test_status_returns_the_original_reply(self):
+        original = self.purchase(txn_id='abcdef0123456789')
+        response = self.gateway.status(txn_id='abcdef0123456789')
+        self.assertEquals(original['dps_txn_ref'], response['dps_txn_ref'])
+
+    def test_repeated_txn_id_is_not_charged_twice(self):
+        first = self.purchase(txn_id='abcdef0123456789')
+        second = self.purchase(txn_id='abcdef0123456789')
+        self.assertEquals(first['dps_txn_ref'], second['dps_txn_ref'])
+        self.assertEquals(1, self.server.simulator.stats['duplicate'])
+
+    def test_dropped_replies_are_empty(self):
+        self.server.simulator.drop_rate = 1.0
+        self.assertTrue(self.purchase().is_empty())
+
+
+class SimulatorParsingTests(TestCase):
+
+    def test_request_fields_are_parsed(self):
+        fields = parse_request(SAMPLE_PURCHASE_REQUEST)
+        self.assertEquals('Purchase', fields['TxnType'])
+        self.assertEquals('4111111111111111', fields['CardNumber'])
+
+    def test_invalid_txn_type_is_an_error(self):
+        reply = Simulator().handle('<Txn><TxnType>Poopies</TxnType></Txn>')
+        self.assertIn('reco="QG"', reply)
+
+    def test_latency_specifications(self):
+        self.assertEquals(0.05, parse_latency('50')())
+        self.assertTrue(0.01 <= parse_latency('uniform:10:20')() <= 0.02)
+        self.assertTrue(parse_latency('lognormal:50:0.5')() > 0)
+        with self.assertRaises(ValueError):
+            parse_latency('bogus:1')
@@ -0,0 +1,113 @@
+from django.contrib.auth.models import User
+from django.test import TestCase
+from mock import Mock, patch
+
+from paymentexpress.coalescing import get_cache, get_coalescer
+from paymentexpress.facade import Facade
+from paymentexpress.models import BillingToken
+from paymentexpress.policy import reset_policies
+from paymentexpress.tokens import TokenStore, get_token_store
+from tests import CARD_VISA, SAMPLE_SUCCESSFUL_RESPONSE
+
+from oscar.apps.payment.utils import Bankcard
+
+BILLING_ID = '0000080023225598'
+
+
+class TokenStoreTests(TestCase):
+
+    def setUp(self):
+        self.cache = get_cache('default')
+        self.store = TokenStore(self.cache)
+        self.user = User.objects.create(username='customer')
+
+    def tearDown(self):
+        self.cache.clear()
+
+    def test_lookups_are_cached(self):
+        self.assertIsNone(self.store.get_billing_id(
+            self.user, 'default', CARD_VISA, '1015'))
+        with self.assertNumQueries(0):
+            self.assertIsNone(self.store.get_billing_id(
+                self.user, 'default', CARD_VISA, '1015'))
+
+    def test_saved_tokens_are_found_without_a_query(self):
+        self.store.get_billing_id(self.user, 'default', CARD_VISA, '1015')
+        self.store.save(self.user, 'default', CARD_VISA, '1015', BILLING_ID)
+        with self.assertNumQueries(0):
+            self.assertEquals(BILLING_ID, self.store.get_billing_id(
+                self.user, 'default', CARD_VISA, '1015'))
+        token = BillingToken.objects.get()
+        self.assertEquals(('Visa', '1111', '1015'),
+                          (token.card_type, token.last_digits, token.expiry))
+
+    def test_tokens_are_per_account_and_expiry(self):
+        self.store.save(self.user, 'default', CARD_VISA, '1015', BILLING_ID)
+        self.assertIsNone(self.store.get_billing_id(
+            self.user, 'outlet', CARD_VISA, '1015'))
+        self.assertIsNone(self.store.get_billing_id(
+            self.user, 'default', CARD_VISA, '1016'))
+
+    def test_deleted_tokens_are_forgotten(self):
+        self.store.save(self.user, 'default', CARD_VISA, '1015', BILLING_ID)
+        self.store.delete(BillingToken.objects.get())
+        self.assertIsNone(self.store.get_billing_id(
+            self.user, 'default', CARD_VISA, '1015'))
+
+
+class FacadeTokenTests(TestCase):
+
+    def setUp(self):
+        reset_policies()
+        self.facade = Facade()
+        self.user = User.objects.create(username='customer')
+        self.card = Bankcard(card_number=CARD_VISA, expiry_date='12/99',
+                             name="Frankie", cvv="123")
+
+    def tearDown(self):
+        get_token_store().cache.clear()
+        get_coalescer().clear()
+
+    def post(self):
+        return patch('requests.Session.post', return_value=Mock(
+            status_code=200, content=SAMPLE_SUCCESSFUL_RESPONSE))
+
+    def test_purchase_stores_new_cards_and_charges_stored_ones(self):
+        with self.post() as post:
+            self.facade.purchase('1000', 1.23, bankcard=self.card,
+                                 user=self.user)
+            self.assertIn('<CardNumber>',
+                          post.call_args[0][1].decode('utf-8'))
+            self.assertEquals(1, BillingToken.objects.count())
+            self.facade.purchase('1001', 1.23, bankcard=self.card,
+                                 user=self.user)
+            body = post.call_args[0][1].decode('utf-8')
+        self.assertNotIn('<CardNumber>', body)
+        self.assertIn('<DpsBillingId>%s</DpsBillingId>' % BILLING_ID, body)
+
+    def test_tokenise_validates_new_cards_only(self):
+        with self.post() as post:
+            self.assertEquals(BILLING_ID,
+                              self.facade.tokenise(self.user, self.card))
+            self.assertEquals(BILLING_ID,
+                              self.facade.tokenise(self.user, self.card))
+        self.assertEquals(1, post.call_count)
+        self.assertIn('<EnableAddBillCard>1</EnableAddBillCard>',
+                      post.call_args[0][1].decode('utf-8'))
+
+    def test_tokenise_adds_card_to_billing_database(self):
+        with self.settings(PAYMENTEXPRESS_TRANSPORT='memory'):
+            billing_id = Facade().tokenise(self.user, self.card)
+        self.assertTrue(billing_id)
+        self.assertEquals(billing_id, BillingToken.objects.get(
+            user=self.user).dps_billing_id)
+
+    def test_tokenise_does_not_store_a_missing_billing_id(self):
+        response = SAMPLE_SUCCESSFUL_RESPONSE.replace(
+            '<DpsBillingId>%s</DpsBillingId>' % BILLING_ID,
+            '<DpsBillingId></DpsBillingId>')
+        with patch('requests.Session.post', return_value=Mock(
+                status_code=200, content=response)):
+            self.assertEquals(None,
+                              self.facade.tokenise(self.user, self.card))
+        self.assertEquals(0, BillingToken.objects.count())
@@ -0,0 +1,266 @@
+import errno
+import socket
+import threading
+
+from django.test import TestCase
+from mock import patch, Mock
+from requests.exceptions import ConnectionError, ReadTimeout
+
+from paymentexpress.facade import Facade
+from paymentexpress.gateway import Gateway
+from paymentexpress.policy import is_connect_failure
+from paymentexpress.transport import (PooledSession, Urllib3Transport,
+                                      HTTPClientTransport, InMemoryTransport,
+                                      get_session, get_transport,
+                                      _get_headers, urllib3)
+from tests import StubPxPostServer, SAMPLE_SUCCESSFUL_RESPONSE, CARD_VISA
+
+
+def unused_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class PooledSessionTests(TestCase):
+
+    def test_adapter_uses_configured_pool_sizes(self):
+        session = PooledSession(pool_connections=2, pool_maxsize=5)
+        self.assertEquals(2, session.adapter._pool_connections)
+        self.assertEquals(5, session.adapter._pool_maxsize)
+
+    def test_adapter_is_mounted_for_http_and_https(self):
+        session = PooledSession()
+        self.assertIs(session.adapter,
+                      session.session.get_adapter('https://localhost/'))
+        self.assertIs(session.adapter,
+                      session.session.get_adapter('http://localhost/'))
+
+    def test_idle_connections_are_dropped_after_keepalive_timeout(self):
+        session = PooledSession(keepalive_timeout=30)
+        session.adapter.poolmanager = Mock()
+        with patch('requests.Session.post'):
+            with patch('time.time') as now:
+                now.return_value = session._last_used + 10
+                session.post('http://localhost/', '<Txn/>')
+                self.assertFalse(session.adapter.poolmanager.clear.called)
+
+                now.return_value = session._last_used + 31
+                session.post('http://localhost/', '<Txn/>')
+                self.assertTrue(session.adapter.poolmanager.clear.called)
+
+
+class SharedSessionTests(TestCase):
+
+    def test_same_configuration_returns_same_session(self):
+        self.assertIs(get_session(3, 3, 10), get_session(3, 3, 10))
+
+    def test_different_configuration_returns_different_session(self):
+        self.assertIsNot(get_session(3, 3, 10), get_session(4, 4, 10))
+
+    def test_gateways_share_the_default_session(self):
+        a = Gateway('http://localhost/', 'user', 'pass', 'AUD')
+        b = Gateway('http://localhost/', 'user', 'pass', 'AUD')
+        self.assertIs(a.session, b.session)
+
+    def test_facades_share_a_session(self):
+        self.assertIs(Facade().gateway.session, Facade().gateway.session)
+
+    def test_pool_settings_are_used_by_facade(self):
+        with self.settings(PAYMENTEXPRESS_POOL_CONNECTIONS=1,
+                           PAYMENTEXPRESS_POOL_MAXSIZE=7,
+                           PAYMENTEXPRESS_KEEPALIVE_TIMEOUT=5):
+            session = Facade().gateway.session
+        self.assertEquals(7, session.pool_maxsize)
+        self.assertEquals(5, session.keepalive_timeout)
+
+
+class TransportTestsMixin(object):
+    transport_class = None
+
+    def setUp(self):
+        self.transport = self.transport_class()
+
+    def tearDown(self):
+        self.transport.close()
+
+    def test_posts_request_and_returns_reply_bytes(self):
+        with StubPxPostServer() as server:
+            response = self.transport.post(server.url, b'<Txn/>',
+                                           auth=('user', 'pass'),
+                                           timeout=(5, 5))
+        self.assertEquals(200, response.status_code)
+        self.assertEquals(SAMPLE_SUCCESSFUL_RESPONSE.encode('utf-8'),
+                          response.content)
+        self.assertEquals([b'<Txn/>'], server.requests)
+
+    def test_sends_consecutive_requests(self):
+        with StubPxPostServer() as server:
+            for _ in range(3):
+                self.transport.post(server.url, b'<Txn/>', timeout=5)
+        self.assertEquals(3, len(server.requests))
+
+    def test_refused_connection_is_a_connect_failure(self):
+        url = 'http://127.0.0.1:%d/pxpost.aspx' % unused_port()
+        with self.assertRaises(Exception) as context:
+            self.transport.post(url, b'<Txn/>', timeout=5)
+        self.assertTrue(is_connect_failure(context.exception))
+
+    def test_aborted_refused_connection_is_a_connect_failure(self):
+        # As raised through the urllib3 bundled with requests 2.4
+        error = ConnectionError(urllib3.exceptions.ProtocolError(
+            'Connection aborted.',
+            socket.error(errno.ECONNREFUSED, 'Connection refused')))
+        self.assertTrue(is_connect_failure(error))
+        error = ConnectionError(urllib3.exceptions.ProtocolError(
+            'Connection aborted.',
+            socket.error(errno.ECONNRESET, 'Connection reset by peer')))
+        self.assertFalse(is_connect_failure(error))
+
+    def test_read_timeout_is_not_a_connect_failure(self):
+        # Connections are accepted by the listen backlog but never answered
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        url = 'http://127.0.0.1:%d/pxpost.aspx' % listener.getsockname()[1]
+        try:
+            with self.assertRaises(ReadTimeout) as context:
+                self.transport.post(url, b'<Txn/>', timeout=(5, 0.1))
+        finally:
+            listener.close()
+        self.assertFalse(is_connect_failure(context.exception))
+
+    def test_gateway_purchase_through_transport(self):
+        with StubPxPostServer() as server:
+            gateway = Gateway(server.url, 'user', 'pass', 'AUD',
+                              session=self.transport)
+            response = gateway.purchase(amount=1.23,
+                                        dps_billing_id='0000080023748351')
+        self.assertTrue(response.is_successful())
+
+
+class RequestsTransportTests(TransportTestsMixin, TestCase):
+    transport_class = PooledSession
+
+
+class Urllib3TransportTests(TransportTestsMixin, TestCase):
+    transport_class = Urllib3Transport
+
+    def test_idle_connections_are_dropped_after_keepalive_timeout(self):
+        transport = Urllib3Transport(keepalive_timeout=30)
+        transport.pool = Mock()
+        with patch('time.time') as now:
+            now.return_value = transport._last_used + 31
+            transport.post('http://localhost/', b'<Txn/>')
+        self.assertTrue(transport.pool.clear.called)
+
+
+class HTTPClientTransportTests(TransportTestsMixin, TestCase):
+    transport_class = HTTPClientTransport
+
+    def idle_connections(self):
+        return [connection for idle in self.transport._idle.values()
+                for connection, _ in idle]
+
+    def test_dropped_connection_is_replaced(self):
+        with StubPxPostServer() as server:
+            self.transport.post(server.url, b'<Txn/>', timeout=5)
+            for connection in self.idle_connections():
+                connection.sock.shutdown(socket.SHUT_RDWR)
+            response = self.transport.post(server.url, b'<Txn/>', timeout=5)
+        self.assertEquals(200, response.status_code)
+
+    def test_connection_is_kept_alive(self):
+        with StubPxPostServer() as server:
+            self.transport.post(server.url, b'<Txn/>', timeout=5)
+            first = self.idle_connections()
+            self.transport.post(server.url, b'<Txn/>', timeout=5)
+            second = self.idle_connections()
+        self.assertEquals(1, len(first))
+        self.assertIs(first[0], second[0])
+
+    def test_connections_are_shared_between_threads(self):
+        with StubPxPostServer() as server:
+            for _ in range(3):
+                thread = threading.Thread(target=self.transport.post,
+                                          args=(server.url, b'<Txn/>'),
+                                          kwargs={'timeout': 5})
+                thread.start()
+                thread.join(5)
+            self.assertEquals(1, len(self.idle_connections()))
+
+    def test_idle_connections_are_bounded_by_pool_size(self):
+        transport = HTTPClientTransport(pool_maxsize=1)
+        self.addCleanup(transport.close)
+        connections = [Mock(), Mock()]
+        for connection in connections:
+            transport._put_idle_connection(('http', 'px.test', None),
+                                           connection)
+        self.assertFalse(connections[0].close.called)
+        self.assertTrue(connections[1].close.called)
+
+
+class InMemoryTransportTests(TestCase):
+
+    def test_requests_are_answered_by_simulator(self):
+        transport = InMemoryTransport()
+        gateway = Gateway('memory://pxpost/', 'user', 'pass', 'AUD',
+                          session=transport)
+        response = gateway.purchase(card_holder='Frankie',
+                                    card_number=CARD_VISA,
+                                    card_expiry='1299', cvc2='123',
+                                    merchant_ref='100001_PURCHASE_1_2008',
+                                    enable_add_bill_card=1, amount=1.23)
+        self.assertTrue(response.is_successful())
+        self.assertEquals(1, transport.requests)
+
+    def test_requests_are_counted_across_threads(self):
+        simulator = Mock()
+        simulator.handle.return_value = ''
+        transport = InMemoryTransport(simulator=simulator)
+
+        def post():
+            for i in range(100):
+                transport.post('memory://pxpost/', b'<Txn/>')
+
+        threads = [threading.Thread(target=post) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(800, transport.requests)
+
+
+class TransportSelectionTests(TestCase):
+
+    def test_requests_is_the_default(self):
+        self.assertIsInstance(Facade().gateway.session, PooledSession)
+
+    def test_transport_is_chosen_by_setting(self):
+        for name, cls in (('urllib3', Urllib3Transport),
+                          ('http.client', HTTPClientTransport),
+                          ('memory', InMemoryTransport)):
+            with self.settings(PAYMENTEXPRESS_TRANSPORT=name):
+                self.assertIsInstance(Facade().gateway.session, cls)
+
+    def test_transport_can_be_given_by_dotted_path(self):
+        with self.settings(PAYMENTEXPRESS_TRANSPORT=(
+                'paymentexpress.transport.InMemoryTransport')):
+            self.assertIsInstance(Facade().gateway.session,
+                                  InMemoryTransport)
+
+    def test_unknown_transport_is_rejected(self):
+        with self.assertRaises(ValueError):
+            get_transport('carrier.pigeon')
+
+    def test_same_configuration_returns_same_transport(self):
+        self.assertIs(get_transport('urllib3', 3, 3, 10),
+                      get_transport('urllib3', 3, 3, 10))
+        self.assertIsNot(get_transport('urllib3', 3, 3, 10),
+                         get_transport('memory', 3, 3, 10))
+
+    def test_basic_auth_header_matches_requests(self):
+        self.assertEquals('Basic dXNlcjpwYXNz',
+                          _get_headers(('user', 'pass'))['Authorization'])